@@ -0,0 +1,435 @@
+# coding=UTF-8
+"""
+Load benchmark comparing the chat variants of this repository.
+
+Every variant is driven through its real protocol: long polling clients use
+GET /message with a cursor and POST /message, websocket clients use
+/socket/<room>. Readers and writers log in through the direct login of the
+variant, so the variant's database (Redis or MongoDB on localhost) has to be
+running. Writers put the time of sending into the message body, readers
+measure the publish-to-deliver latency from it. Example:
+
+    python benchmark/bench.py --variants=all --readers=200 --writers=4 --rate=5
+
+Each variant is booted on its own, measured and shut down again before the
+next one, and one table row is printed per variant. Use --boot=false and
+--pid to measure an already running server.
+"""
+
+# General modules.
+import os
+import os.path
+import math
+import sys
+import time
+import signal
+import urllib
+import logging
+import subprocess
+
+# Tornado modules.
+import tornado.ioloop
+import tornado.options
+import tornado.escape
+import tornado.httpclient
+import tornado.websocket
+from tornado import gen
+
+
+# Directory of the variants.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VARIANTS = {
+    'pymongo': ('chat-pymongo-longpolling', 'longpolling'),
+    'asyncmongo': ('chat-asyncmongo-longpolling', 'longpolling'),
+    'brukva': ('chat-brukva-longpolling', 'longpolling'),
+    'websockets': ('chat-brukva-websockets', 'websocket'),
+}
+# Value of the _xsrf cookie and argument, tornado only compares both.
+XSRF = "benchmark0xsrf0token"
+
+tornado.options.define("variants", default="all",
+                       help="comma separated variants to run: " + ", ".join(sorted(VARIANTS)) + " or all")
+tornado.options.define("port", default=8890, help="port the variants are booted on", type=int)
+tornado.options.define("boot", default=True, help="boot every variant before measuring it", type=bool)
+tornado.options.define("pid", default=0, help="pid of the server if not booted, for measuring RSS", type=int)
+tornado.options.define("server_args", default="",
+                       help="additional command line arguments for the booted variants")
+tornado.options.define("readers", default=100, help="number of reading clients per room", type=int)
+tornado.options.define("writers", default=2, help="number of writing clients per room", type=int)
+tornado.options.define("rooms", default=1,
+                       help="number of chat rooms, long polling variants only have one", type=int)
+tornado.options.define("rate", default=5, help="messages per second per writer", type=float)
+tornado.options.define("duration", default=20, help="seconds messages are written", type=int)
+tornado.options.define("drain", default=5, help="seconds to wait for deliveries after writing", type=int)
+
+
+
+def percentile(values, p):
+    """
+    Returns the p-th percentile of a sorted list by nearest rank.
+    """
+    if not values:
+        return float('nan')
+    rank = int(math.ceil(p / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+def process_rss(pid):
+    """
+    Returns the resident set size in bytes of the process and its children
+    (the workers of a multi-process server) or None without /proc.
+    """
+    if not pid or not os.path.isdir("/proc"):
+        return None
+    pids = set([pid])
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % entry) as f:
+                # The parent pid is the 4th field after the command in braces.
+                if int(f.read().rsplit(")", 1)[1].split()[1]) == pid:
+                    pids.add(int(entry))
+        except (IOError, IndexError, ValueError):
+            pass
+    total = 0
+    for child in pids:
+        try:
+            with open("/proc/%d/status" % child) as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+        except IOError:
+            pass
+    return total
+
+
+@gen.coroutine
+def fetch(http, url, **kwargs):
+    """
+    Fetches the url and returns the response, also for error status codes.
+    """
+    try:
+        response = yield http.fetch(url, **kwargs)
+    except tornado.httpclient.HTTPError, err:
+        if err.response is None:
+            raise
+        response = err.response
+    raise gen.Return(response)
+
+
+def wait_until_ready(port, timeout=30):
+    """
+    Blocks until the server on the port reports that it finished warming up.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if urllib.urlopen("http://127.0.0.1:%d/ready" % port).getcode() == 200:
+                return
+        except IOError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("Server did not become ready on port %d" % port)
+
+
+
+class Stats(object):
+    """
+    Collects the results of one run.
+    """
+    def __init__(self):
+        self.posted = 0
+        self.post_errors = 0
+        self.delivered = 0
+        self.poll_errors = 0
+        self.latencies = []
+
+
+    def deliver(self, messages):
+        """
+        Records the latencies of delivered benchmark messages.
+        """
+        now = time.time()
+        for message in messages:
+            parts = message.get("body", "").split(" ")
+            if len(parts) == 4 and parts[0] == "bench":
+                self.delivered += 1
+                self.latencies.append(now - float(parts[3]))
+
+
+
+class Client(object):
+    """
+    A simulated user logged in through the direct login of the variant.
+    """
+    def __init__(self, base_url, name):
+        self.base_url = base_url
+        self.name = name
+        self.http = tornado.httpclient.AsyncHTTPClient()
+        self.user = None
+
+
+    @gen.coroutine
+    def login(self):
+        """
+        Logs in and keeps the secure user cookie.
+        """
+        query = urllib.urlencode(dict(start_direct_auth=1, name=self.name,
+                                      email=self.name + "@benchmark.local"))
+        response = yield fetch(self.http, self.base_url + "/login?" + query,
+                               follow_redirects=False)
+        for header in response.headers.get_list("Set-Cookie"):
+            if header.startswith("user="):
+                self.user = header.split(";", 1)[0][len("user="):].strip('"')
+        if not self.user:
+            raise RuntimeError("Login failed for " + self.name)
+
+
+    def headers(self):
+        return {"Cookie": 'user="%s"; _xsrf=%s' % (self.user, XSRF)}
+
+
+
+class PollingReader(Client):
+    """
+    Reads messages by long polling like static/app.js of the long polling
+    variants.
+    """
+    def __init__(self, base_url, name, stats):
+        Client.__init__(self, base_url, name)
+        self.stats = stats
+        self.cursor = None
+        self.running = True
+
+
+    @gen.coroutine
+    def run(self):
+        while self.running:
+            url = self.base_url + "/message"
+            if self.cursor:
+                url += "?" + urllib.urlencode(dict(cursor=self.cursor))
+            try:
+                response = yield self.http.fetch(url, headers=self.headers(),
+                                                 request_timeout=120)
+                data = tornado.escape.json_decode(response.body)
+                if "error" in data:
+                    raise ValueError(data.get("textStatus"))
+                messages = data.get("messages", [])
+            except Exception:
+                self.stats.poll_errors += 1
+                yield gen.Task(tornado.ioloop.IOLoop.instance().add_timeout, time.time() + 0.5)
+                continue
+            if messages:
+                self.cursor = messages[-1]["_id"]
+                self.stats.deliver(messages)
+
+
+
+class PollingWriter(Client):
+    """
+    Posts messages like static/app.js of the long polling variants.
+    """
+    @gen.coroutine
+    def post(self, body):
+        data = urllib.urlencode(dict(body=body, _xsrf=XSRF))
+        response = yield fetch(self.http, self.base_url + "/message", method="POST",
+                               body=data, headers=self.headers())
+        raise gen.Return(response.code == 200 and "error" not in response.body)
+
+
+
+class SocketClient(Client):
+    """
+    Reads and writes messages through /socket/<room> like static/app.js of
+    the websocket variant.
+    """
+    def __init__(self, base_url, name, stats, room):
+        Client.__init__(self, base_url, name)
+        self.stats = stats
+        self.room = room
+        self.connection = None
+
+
+    @gen.coroutine
+    def connect(self):
+        url = self.base_url.replace("http://", "ws://") + "/socket/" + self.room
+        request = tornado.httpclient.HTTPRequest(url, headers=self.headers())
+        self.connection = yield tornado.websocket.websocket_connect(request)
+
+
+    @gen.coroutine
+    def run(self):
+        while True:
+            frame = yield self.connection.read_message()
+            if frame is None:
+                return
+            data = tornado.escape.json_decode(frame)
+            if "messages" in data:
+                self.stats.deliver(data["messages"])
+
+
+    @gen.coroutine
+    def post(self, body):
+        self.connection.write_message(tornado.escape.json_encode(dict(body=body)))
+        raise gen.Return(True)
+
+
+
+@gen.coroutine
+def measure(name, port, pid):
+    """
+    Runs one benchmark against the variant listening on port and returns
+    the row of the report.
+    """
+    options = tornado.options.options
+    transport = VARIANTS[name][1]
+    base_url = "http://127.0.0.1:%d" % port
+    rooms = ["bench%d" % i for i in xrange(options.rooms if transport == "websocket" else 1)]
+    stats = Stats()
+    io_loop = tornado.ioloop.IOLoop.instance()
+
+    # Connect the readers and measure the memory they take.
+    rss_before = process_rss(pid)
+    readers = []
+    for room in rooms:
+        for i in xrange(options.readers):
+            client_name = "reader-%s-%d" % (room, i)
+            if transport == "websocket":
+                reader = SocketClient(base_url, client_name, stats, room)
+            else:
+                reader = PollingReader(base_url, client_name, stats)
+            yield reader.login()
+            if transport == "websocket":
+                yield reader.connect()
+            reader.run()
+            readers.append(reader)
+    # Give the long polls time to park.
+    yield gen.Task(io_loop.add_timeout, time.time() + 1)
+    rss_after = process_rss(pid)
+
+    writers = []
+    for room in rooms:
+        for i in xrange(options.writers):
+            client_name = "writer-%s-%d" % (room, i)
+            if transport == "websocket":
+                writer = SocketClient(base_url, client_name, Stats(), room)
+                yield writer.login()
+                yield writer.connect()
+                # Consume the room's messages the writer receives, too.
+                writer.run()
+            else:
+                writer = PollingWriter(base_url, client_name)
+                yield writer.login()
+            writers.append(writer)
+
+    @gen.coroutine
+    def write(writer, index):
+        seq = 0
+        end = time.time() + options.duration
+        while time.time() < end:
+            # Plain words and numbers are not linkified by the variants.
+            body = "bench %d %d %.6f" % (index, seq, time.time())
+            seq += 1
+            try:
+                ok = yield writer.post(body)
+            except Exception:
+                ok = False
+            if ok:
+                stats.posted += 1
+            else:
+                stats.post_errors += 1
+            yield gen.Task(io_loop.add_timeout, time.time() + 1.0 / options.rate)
+
+    start = time.time()
+    yield [write(client, i) for i, client in enumerate(writers)]
+    elapsed = time.time() - start
+    yield gen.Task(io_loop.add_timeout, time.time() + options.drain)
+
+    for reader in readers:
+        if transport == "websocket":
+            reader.connection.close()
+        else:
+            reader.running = False
+
+    latencies = sorted(stats.latencies)
+    connections = len(readers)
+    row = dict(
+        variant=name,
+        connections=connections,
+        writers=len(writers),
+        posts=stats.posted / elapsed,
+        deliveries=stats.delivered / (elapsed + options.drain),
+        # Every reader of a room should receive every message of the room.
+        delivered=100.0 * stats.delivered / max(stats.posted * options.readers, 1),
+        p50=percentile(latencies, 50) * 1000,
+        p95=percentile(latencies, 95) * 1000,
+        p99=percentile(latencies, 99) * 1000,
+        errors=stats.post_errors + stats.poll_errors,
+        rss=(rss_after - rss_before) / 1024.0 / connections
+            if rss_before is not None and rss_after is not None and connections else float('nan'),
+    )
+    raise gen.Return(row)
+
+
+def boot(name, port):
+    """
+    Starts the variant in its own process group and waits for it to be ready.
+    """
+    directory = os.path.join(ROOT, VARIANTS[name][0])
+    args = [sys.executable, "app.py", "--port=%d" % port, "--logging=warning"]
+    # The writers post faster than the default rate limits allow.
+    args += ["--user_rate=0", "--room_rate=0"]
+    args += tornado.options.options.server_args.split()
+    process = subprocess.Popen(args, cwd=directory, preexec_fn=os.setsid)
+    try:
+        wait_until_ready(port)
+    except:
+        os.killpg(process.pid, signal.SIGTERM)
+        raise
+    return process
+
+
+def report(rows):
+    """
+    Prints the results as a table.
+    """
+    columns = [("variant", "%-11s"), ("connections", "%11d"), ("writers", "%7d"),
+               ("posts", "%9.1f"), ("deliveries", "%10.1f"), ("delivered", "%9.1f"),
+               ("p50", "%8.1f"), ("p95", "%8.1f"), ("p99", "%8.1f"),
+               ("errors", "%6d"), ("rss", "%8.1f")]
+    titles = ["variant", "connections", "writers", "posts/s", "deliver/s", "delivered%",
+              "p50 ms", "p95 ms", "p99 ms", "errors", "KB/conn"]
+    print " | ".join([title.ljust(11) if key == "variant" else title.rjust(len(fmt % 0))
+                      for title, (key, fmt) in zip(titles, columns)])
+    for row in rows:
+        print " | ".join([fmt % row[key] for key, fmt in columns])
+
+
+def main():
+    tornado.options.parse_command_line()
+    options = tornado.options.options
+    names = sorted(VARIANTS) if options.variants == "all" else options.variants.split(",")
+    # Every parked long poll needs its own connection.
+    tornado.httpclient.AsyncHTTPClient.configure(
+        None, max_clients=(options.readers + options.writers) * options.rooms + 10)
+    rows = []
+    for name in names:
+        if name not in VARIANTS:
+            raise SystemExit("Unknown variant: " + name)
+        process = boot(name, options.port) if options.boot else None
+        pid = process.pid if process else options.pid
+        try:
+            io_loop = tornado.ioloop.IOLoop.instance()
+            rows.append(io_loop.run_sync(lambda: measure(name, options.port, pid)))
+        except Exception:
+            logging.error("Benchmark of %s failed", name, exc_info=True)
+        finally:
+            if process:
+                os.killpg(process.pid, signal.SIGTERM)
+                process.wait()
+    report(rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,11 @@
 # coding=UTF-8
 
 # General modules.
+import functools
 import os.path
 import logging
+import math
+import time
 import sys
 
 # Tornado modules.
@@ -10,20 +13,96 @@ import tornado.ioloop
 import tornado.web
 import tornado.auth
 import tornado.options
+import tornado.template
 import tornado.escape
 
 # MongoDb modules.
 import pymongo
-import asyncmongo
 from bson.objectid import ObjectId
 
 # Import application modules.
 from base import BaseHandler
 from auth import LoginHandler
 from auth import LogoutHandler
+from assets import AssetHandler
+from assets import Assets
+from buffer import MessageBuffers
+from cache import LRUCache
+from fragments import FragmentCache
+import metrics
+from metrics import MetricsHandler
+from ratelimit import RateLimiter
+from ratelimit import slow_down
+from relay import MessageRelay
+from pool import CheckoutError
+from pool import Client
+from pool import QueuedPool
+from server import serve
+from startup import ReadyHandler
+from startup import Startup
+from startup import precompile
+from timerwheel import TimerWheel
+import tracing
+from waiters import WaiterRegistry
 
 # Define port from command line parameter.
 tornado.options.define("port", default=8888, help="run on the given port", type=int)
+# Define how many processes serve the application and how they listen.
+tornado.options.define("processes", default=1,
+                       help="number of worker processes, 0 for one per CPU", type=int)
+tornado.options.define("reuse_port", default=False,
+                       help="bind a socket per worker with SO_REUSEPORT instead of sharing one", type=bool)
+tornado.options.define("unix_socket", default=None,
+                       help="path of an additional unix socket to listen on, e.g. for a local proxy")
+# Define where chat rooms are stored.
+tornado.options.define("backend", default="mongo",
+                       help="room backend: mongo (capped collection) or memory (this process only)")
+tornado.options.define("relay", default=False,
+                       help="tail the conversation for messages posted by other processes or nodes", type=bool)
+# Define the MongoDB server and the size of the connection pool.
+tornado.options.define("mongo_host", default="127.0.0.1", help="host of the MongoDB server")
+tornado.options.define("mongo_port", default=27017, help="port of the MongoDB server", type=int)
+tornado.options.define("mongo_connect_timeout", default=2.0,
+                       help="seconds the synchronous MongoDB connection waits to connect at startup",
+                       type=float)
+tornado.options.define("mongo_pool_cached", default=10,
+                       help="maximum number of idle MongoDB connections kept open", type=int)
+tornado.options.define("mongo_pool_max", default=50,
+                       help="maximum number of MongoDB connections in use at once, 0 for unlimited", type=int)
+tornado.options.define("mongo_pool_wait", default=5.0,
+                       help="seconds a query waits for a connection if all are in use, 0 for no limit",
+                       type=float)
+tornado.options.define("mongo_pool_queue", default=1000,
+                       help="maximum number of queries waiting for a connection", type=int)
+# Define the server-side deadline of long polling requests.
+tornado.options.define("poll_timeout", default=45,
+                       help="seconds a long polling request waits before it is answered without messages", type=int)
+tornado.options.define("poll_jitter", default=10,
+                       help="maximum random seconds added to the poll timeout", type=int)
+# Define the number of latest messages shown when loading a chat room.
+tornado.options.define("history_size", default=50,
+                       help="number of latest messages shown when loading a chat room", type=int)
+# Define size and lifetime of the in-process user cache.
+tornado.options.define("user_cache_size", default=10000,
+                       help="maximum number of cached user objects", type=int)
+tornado.options.define("user_cache_ttl", default=60,
+                       help="seconds a cached user object is valid", type=int)
+# Define the number of recent messages kept in memory per chat room. These are
+# all messages kept by the memory backend.
+tornado.options.define("buffer_size", default=50,
+                       help="number of recent messages buffered per chat room, at least 1", type=int)
+# Define how fast users can post and how many messages a chat room takes.
+tornado.options.define("user_rate", default=1.0,
+                       help="messages per second a user can post on average, 0 for unlimited", type=float)
+tornado.options.define("user_burst", default=5,
+                       help="messages a user can post at once", type=int)
+tornado.options.define("room_rate", default=20.0,
+                       help="messages per second a chat room takes on average, 0 for unlimited", type=float)
+tornado.options.define("room_burst", default=50,
+                       help="messages a chat room takes at once", type=int)
+# Define the fraction of messages whose latency per stage is logged.
+tornado.options.define("trace_sample", default=0.0,
+                       help="fraction of messages traced in the log from ingest to delivery", type=float)
 
 
 
@@ -41,24 +120,17 @@ class MainHandler(BaseHandler):
         if not user:
             self.redirect("/login")
             return
-        # Retreive messages.
-        self.db.conversation.find(callback=self.on_conversation_find)
-        
-    
-    def on_conversation_find(self, response, error):
-        """
-        The callback for querying the latest messages in self.on_auth().
-        """
-        if error:
-            raise tornado.web.HTTPError(500)
-        content = self.render_string("messages.html", 
-                        messages=list(response))
+        # Render latest messages from the buffer. Only messages not rendered
+        # before need to be rendered.
+        messages = self.application.buffers['conversation'].recent(
+                                        tornado.options.options.history_size)
+        history = self.application.fragments.render('conversation', messages)
+        content = self.render_string("messages.html", history=history)
         self.render_default("index.html", content=content, chat=1)
         
     
 
 class MessageHandler(BaseHandler):
-    waiters = set()
 
     @tornado.web.asynchronous
     def get(self):
@@ -79,43 +151,67 @@ class MessageHandler(BaseHandler):
             self.finish({'error': 1, 'textStatus': 'unauthorized'})
             return;
         
-        # Check if there are new messages.
-        # @todo: Bad, bad performance loading all items each request!
-        self.db.conversation.find(callback=self.on_conversation_find)
-        
-    
-    def on_conversation_find(self, response, error):
-        """
-        Callback for loading messages in self.get_on_auth().
-        """
-        if error:
-            raise tornado.web.HTTPError(500)
-        
         # get message data from request body.
         try:
             # Get cursor form request body.
             cursor = self.get_argument("cursor", None)
+            # Validate cursor to be a message id.
+            if cursor:
+                ObjectId(cursor)
         except:
             # Send an error back to client.
             self.finish({'error': 1, 'textStatus': 'Bad input data'})
             return;
         
+        # Check if there are new messages.
+        if cursor:
+            buffer = self.application.buffers['conversation']
+            recent = buffer.since(cursor)
+            if recent is None and self.application.memory:
+                # The cursor has been dropped from memory, so send everything.
+                recent = buffer.recent(len(buffer.messages))
+            if recent is None:
+                # The cursor is older than the buffer, so ask MongoDB. Remember
+                # the position of the buffer to catch messages delivered meanwhile.
+                self.mark = buffer.next
+                self.db.conversation.find({'_id': {'$gt': ObjectId(cursor)}},
+                                          callback=metrics.timed('find', self.on_conversation_find))
+                return
+            if recent:
+                self.on_new_messages(recent)
+                return
+        # Wait for the next message in this chat room.
+        self.application.waiters.add('conversation', self, self.on_new_messages)
+        # Answer without messages if none arrive before the deadline.
+        self.application.deadlines.add(self, self.on_poll_timeout)
+        
+    
+    def on_conversation_find(self, response, error):
+        """
+        Callback for loading messages newer than the cursor in self.get_on_auth().
+        """
+        if error:
+            # A saturated pool is not an error of MongoDB, the client may retry.
+            raise tornado.web.HTTPError(503 if isinstance(error, CheckoutError) else 500)
+        
         messages = list(response)
         # Stringify _id.
         for i in xrange(len(messages)):
             messages[i]["_id"] = str(messages[i]["_id"])
+        # Add messages delivered while waiting for MongoDB if not found already.
+        buffer = self.application.buffers['conversation']
+        ids = set([message["_id"] for message in messages])
+        for message in buffer.recent(buffer.next - self.mark):
+            if message["_id"] not in ids:
+                messages.append(message)
         
-        # Find current message.
-        if cursor:
-            index = 0
-            for i in xrange(len(messages)):
-                index = len(messages) - i - 1
-                if messages[index]["_id"] == cursor: break
-            recent = messages[index + 1:]
-            if recent:
-                self.on_new_messages(recent)
-                return
-        MessageHandler.waiters.add(self.on_new_messages)
+        if messages:
+            self.on_new_messages(messages)
+            return
+        # Wait for the next message in this chat room.
+        self.application.waiters.add('conversation', self, self.on_new_messages)
+        # Answer without messages if none arrive before the deadline.
+        self.application.deadlines.add(self, self.on_poll_timeout)
         
         
     def on_new_messages(self, messages):
@@ -123,20 +219,37 @@ class MessageHandler(BaseHandler):
         Callback called by get() when new message is available.
         messages - a list of message object that are new to the waiter.
         """
+        self.application.deadlines.remove(self)
         # Closed client connection
         if self.request.connection.stream.closed():
             logging.warning("Waiter disappeared")
             return
         # Send messages to client and finish connection.
+        metrics.DELIVERED.inc(('conversation',), len(messages))
         self.finish(dict(messages=messages))
-
+        tracing.stages(messages, 'deliver')
+        
+    
+    def on_poll_timeout(self):
+        """
+        Called by the timer wheel when the deadline of this request passed.
+        The client polls again right away after the empty response.
+        """
+        self.application.waiters.remove('conversation', self)
+        # Closed client connection
+        if self.request.connection.stream.closed():
+            return
+        self.finish(dict(messages=[]))
+        
+    
     def on_connection_close(self):
         """
         Called when connection closed.
         """
-        # Remove waiter.
-        MessageHandler.waiters.discard(self.on_new_messages)
-        logging.info("Removed one waiter")
+        # Remove waiter and its deadline.
+        self.application.deadlines.remove(self)
+        if self.application.waiters.remove('conversation', self):
+            logging.info("Removed one waiter")
         
     
     @tornado.web.asynchronous
@@ -171,12 +284,25 @@ class MessageHandler(BaseHandler):
             self.finish({'error': 1, 'textStatus': 'Bad input data'})
             return;
         
-        # Save message.
+        # Reject the message if the user or the chat room is too fast.
+        retry_after = self.application.ratelimit.acquire(self.get_secure_cookie("user"), 'conversation')
+        if retry_after:
+            self.set_header("Retry-After", int(math.ceil(retry_after)))
+            self.finish(slow_down(retry_after))
+            return;
+        
+        metrics.INGESTED.inc(('conversation',))
+        tracing.stamp(message)
+        # Save message unless chat rooms are kept in memory only.
         try:
             # Generate object id because asyncmongo does not return it.
             message["_id"] = ObjectId()
-            self.db.conversation.insert(message,
-                                        callback=self.on_conversation_insert)
+            if not self.application.memory:
+                # Insert a copy, an insert waiting for a connection of the
+                # pool encodes the document only after the _id of the message
+                # is stringified below.
+                self.db.conversation.insert(dict(message), callback=metrics.timed(
+                    'insert', functools.partial(self.on_conversation_insert, message)))
             # Stringify _id.
             message["_id"] = str(message["_id"])
         except Exception, err:
@@ -185,15 +311,8 @@ class MessageHandler(BaseHandler):
             self.finish({'error': 1, 'textStatus': 'Error writing to database: ' + str(err)})
             return;
         
-        # Inform waiters about new message.
-        # Waiters are stored in a class attribute.
-        for waiter in MessageHandler.waiters:
-            try: # Send message to waiter.
-                waiter(messages=[message])
-            except:
-                logging.error("Error in waiter callback", exc_info=True)
-        # Reset cache. 
-        MessageHandler.waiters = set()
+        # Buffer and render message and inform waiters about it.
+        self.application.deliver(message)
         
         # Send message to indicate a successful operation.
         message['_id'] = str(message['_id']) # Stringify id.
@@ -201,15 +320,16 @@ class MessageHandler(BaseHandler):
         return;
     
     
-    def on_conversation_insert(self, response, error):
+    def on_conversation_insert(self, message, response, error):
         """
         Callback for inserting messages into the conversation in self.post.
         """
         if error:
-            logging.error("Error writing to database", exc_info=True)
+            logging.error("Error writing to database: " + str(error))
             return
         else:
             logging.info("Inserted message")
+            tracing.stage(message, 'persist')
     
 
 
@@ -219,20 +339,34 @@ class Application(tornado.web.Application):
     """
     def __init__(self):
         
+        # Build the fingerprinted and precompressed static assets, served at /assets/.
+        static_path = os.path.join(os.path.dirname(__file__), "static")
+        self.assets = Assets(static_path, os.path.join(os.path.dirname(__file__), "build"))
+        self.assets.build()
+        
+        # Templates are compiled into this loader at startup.
+        template_path = os.path.join(os.path.dirname(__file__), "templates")
+        self.template_loader = tornado.template.Loader(template_path, autoescape="xhtml_escape")
+        
         # Handlers defining the url routing.
         handlers = [
             (r"/", MainHandler),
             (r"/login", LoginHandler),
             (r"/logout", LogoutHandler),
             (r"/message", MessageHandler),
+            (r"/ready", ReadyHandler),
+            (r"/metrics", MetricsHandler),
+            (r"/assets/(.*)", AssetHandler, {"path": self.assets.build_path}),
         ]
         
         # Settings:
         settings = dict(
             cookie_secret = "43osdETzKXasdQAGaYdkL5gEmGeJJFuYh7EQnp2XdTP1o/Vo=",
             login_url = "/login",
-            template_path=os.path.join(os.path.dirname(__file__), "templates"),
-            static_path=os.path.join(os.path.dirname(__file__), "static"),
+            template_path=template_path,
+            template_loader=self.template_loader,
+            static_path=static_path,
+            ui_methods=self.assets.ui_methods(),
             xsrf_cookies= True,
             autoescape="xhtml_escape",
             # Set this to your desired database name.
@@ -244,28 +378,179 @@ class Application(tornado.web.Application):
         # Call super constructor.
         tornado.web.Application.__init__(self, handlers, **settings)
         
+        # Cache user objects to resolve the user cookie without a database
+        # round trip on every request.
+        self.user_cache = LRUCache(tornado.options.options.user_cache_size,
+                                   tornado.options.options.user_cache_ttl)
+        
+        # Cache the rendered latest messages of each chat room.
+        self.fragments = FragmentCache(self.settings["template_path"],
+                                       tornado.options.options.history_size)
+        
+        # Expire parked long polling requests before the client gives up.
+        self.deadlines = TimerWheel(tornado.options.options.poll_timeout,
+                                    tornado.options.options.poll_jitter)
+        
         """
         We create a database connection using asyncmongo, which is a 
         non-blocking, asynchronous driver.
         """
-        # Configure your MongoDB connection.
-        self.db = asyncmongo.Client(pool_id='mydb', host='127.0.0.1',
-                    port=27017, maxcached=10, maxconnections=50, dbname='chat')
-        # Create collection 'conversation' manually to make it a fixed size
-        # capped collection with the natural order being the one order of
-        # insertion. We do this using the synchronous, blocking driver pymongo.
+        # Configure your MongoDB connection. The pool opens its connections
+        # on demand and keeps up to mongo_pool_cached of them open. Queries
+        # wait for a connection while mongo_pool_max are in use.
+        options = tornado.options.options
+        cached = options.mongo_pool_cached
+        if options.mongo_pool_max and cached > options.mongo_pool_max:
+            cached = options.mongo_pool_max
+        self.pool_cached = cached
+        self.pool = QueuedPool(timeout=options.mongo_pool_wait, max_waiters=options.mongo_pool_queue,
+                               maxcached=cached, maxconnections=options.mongo_pool_max,
+                               dbname='chat', host=options.mongo_host, port=options.mongo_port)
+        self.db = Client(self.pool)
+        # The synchronous connection is opened in the startup phase
+        # 'datastore'.
+        self.sync_db = None
         
-        # Configure your MongoDB connection.
-        sync_connection = pymongo.Connection('localhost', 27017)
+        # Keep the latest messages of each chat room in memory so polling
+        # clients can be served without querying MongoDB.
+        self.buffers = MessageBuffers(tornado.options.options.buffer_size)
+        # Index of the parked long polling requests by chat room.
+        self.waiters = WaiterRegistry()
+        # The memory backend keeps chat rooms in the buffers only and uses
+        # MongoDB for the users.
+        self.memory = options.backend == "memory"
+        
+        # Limit the rate of messages per user and chat room in this process.
+        self.ratelimit = RateLimiter(options.user_rate, options.user_burst,
+                                     options.room_rate, options.room_burst)
+        
+        # Log the stages of a sample of the messages.
+        tracing.sample_rate = tornado.options.options.trace_sample
+        
+        # Expose the state of this process at /metrics. These values are read
+        # when scraped.
+        self.metrics = metrics.registry
+        self.metrics.gauge('chat_parked_polls', 'Long polling requests waiting for messages by chat room.',
+                           ['room'], lambda: dict([((room,), count) for room, count
+                                                   in self.waiters.counts().iteritems()]))
+        self.metrics.counter('chat_user_lookups_total',
+                             'User lookups by cache result, misses query the datastore.', ['result'],
+                             lambda: {('hit',): self.user_cache.hits, ('miss',): self.user_cache.misses})
+        self.metrics.gauge('chat_mongo_pool_connections', 'Open MongoDB connections by state.', ['state'],
+                           lambda: {('in_use',): self.pool.in_use(), ('idle',): self.pool.idle()})
+        self.metrics.gauge('chat_mongo_pool_waiters', 'Queries waiting for a MongoDB connection.',
+                           callback=lambda: len(self.pool.waiters))
+        
+        # Warm up this process before it takes traffic, /ready tells load
+        # balancers when it is done.
+        self.startup = Startup()
+        self.startup.add_blocking('templates', lambda: precompile(self.template_loader, template_path))
+        self.startup.add_threaded('datastore', self.connect)
+        self.startup.add('pool', self.warm_pool)
+        self.startup.add_threaded('rooms', self.load_rooms, self.warm_rooms)
+        tornado.ioloop.IOLoop.instance().add_callback(self.startup.run)
+        
+    
+    def connect(self):
+        """
+        Startup phase creating the collection 'conversation' manually to
+        make it a fixed size capped collection with the natural order being
+        the one order of insertion. We do this using the synchronous,
+        blocking driver pymongo, so this runs on a thread.
+        """
+        # Configure your MongoDB connection. Fail fast while MongoDB is down,
+        # the phase is retried anyway.
+        options = tornado.options.options
+        sync_connection = pymongo.Connection(options.mongo_host, options.mongo_port,
+                                             connectTimeoutMS=int(options.mongo_connect_timeout * 1000))
         # Choose your database for this application.
-        self.sync_db = sync_connection['chat']
+        sync_db = sync_connection['chat']
         # Create collection 'conversation' manually to make it a fixed size
         # capped collection with the natural order being the one order of
         # insertion.
-        if not "conversation" in self.sync_db.collection_names():
+        if not "conversation" in sync_db.collection_names():
             logging.info("Creating capped collection 'conversation'")
-            pymongo.collection.Collection(self.sync_db, "conversation",
+            pymongo.collection.Collection(sync_db, "conversation",
                                   create=True, capped=True, size=20480, max=50)
+        self.sync_db = sync_db
+        
+    
+    def warm_pool(self, callback):
+        """
+        Startup phase opening the cached connections of the asyncmongo pool
+        by sending a query on each of them at once, so the first requests do
+        not wait for connections to be opened. Fails if any query fails.
+        """
+        if not self.pool_cached:
+            # No connections are kept open, so there is nothing to warm up.
+            callback()
+            return
+        remaining = [self.pool_cached]
+        errors = []
+        def on_response(response, error):
+            if error:
+                errors.append(error)
+            remaining[0] -= 1
+            if not remaining[0]:
+                callback(errors[0] if errors else None)
+        for i in range(self.pool_cached):
+            self.db.conversation.find_one({}, callback=metrics.timed('find_one', on_response))
+        
+    
+    def load_rooms(self):
+        """
+        Startup phase loading the latest messages with the synchronous
+        driver. Runs on a thread.
+        """
+        if self.memory:
+            return []
+        return list(self.sync_db.conversation.find())
+        
+    
+    def warm_rooms(self, messages):
+        """
+        Puts the latest messages into the buffer and renders them, so the
+        first polls and page loads are served from memory. Then starts
+        tailing the capped collection from the latest message.
+        """
+        options = tornado.options.options
+        latest = None
+        for message in messages:
+            latest = message["_id"]
+            # Stringify _id.
+            message["_id"] = str(message["_id"])
+            self.buffers['conversation'].append(message)
+        self.fragments.render('conversation',
+                              self.buffers['conversation'].recent(options.history_size))
+        
+        # Other processes only learn about a message by tailing the capped
+        # collection, so this is required when running multiple processes.
+        if self.memory:
+            if options.processes != 1:
+                logging.warning("Chat rooms of the memory backend are not shared between processes")
+        elif options.relay or options.processes != 1:
+            self.relay = MessageRelay(self.sync_db.conversation, latest, self.deliver)
+            self.relay.start()
+        
+    
+    def deliver(self, message):
+        """
+        Remembers a new message in the buffer of recent messages, renders it
+        for the next page loads and informs waiters about it. Messages are
+        delivered by the posting handler and again by the relay, so messages
+        already buffered are ignored.
+        """
+        buffer = self.buffers['conversation']
+        if message["_id"] in buffer.index:
+            return
+        tracing.stage(message, 'receive')
+        buffer.append(message)
+        self.fragments.append('conversation', message)
+        
+        # Inform the waiters of this chat room about new message.
+        start = time.time()
+        self.waiters.notify('conversation', [message])
+        metrics.FANOUT_SECONDS.observe(time.time() - start, ('conversation',))
         
 
 
@@ -276,11 +561,11 @@ def main():
     """
      # This line will setup default options.
     tornado.options.parse_command_line()
-    # Create an instance of the main application.
-    application = Application()
-    # Start application by listening to desired port and starting IOLoop.
-    application.listen(tornado.options.options.port)
-    tornado.ioloop.IOLoop.instance().start()
+    # Start the application in the desired number of processes by listening
+    # to desired port and starting IOLoop.
+    options = tornado.options.options
+    serve(Application, options.port, processes=options.processes,
+          reuse_port=options.reuse_port, unix_socket=options.unix_socket)
     
 
 if __name__ == "__main__":
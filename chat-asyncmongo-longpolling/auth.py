@@ -95,6 +95,8 @@ class LoginHandler(BaseHandler, tornado.auth.GoogleMixin):
             user = dbuser
             self.sync_db.users.save(user)
             
+        # Drop the outdated user object from the cache.
+        self.application.user_cache.invalidate(str(user["_id"]))
         # Save user id in cookie.
         self.set_secure_cookie("user", str(user["_id"]))
         self.redirect("/")
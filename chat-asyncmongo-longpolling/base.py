@@ -8,6 +8,10 @@ import tornado.web
 import asyncmongo
 from bson.objectid import ObjectId
 
+# Import application modules.
+import metrics
+from pool import CheckoutError
+
 
 class BaseHandler(tornado.web.RequestHandler):
     """
@@ -22,6 +26,14 @@ class BaseHandler(tornado.web.RequestHandler):
         # Call super constructor.
         tornado.web.RequestHandler.__init__(self, application, request, **kwargs)
         
+    def prepare(self):
+        # Answer with 503 until the startup phases are done, the datastore
+        # may not be connected yet.
+        if not self.application.startup.ready:
+            self.set_status(503)
+            self.set_header("Retry-After", "1")
+            self.finish()
+        
     def _get_current_user(self, callback):
         """
         An async method to retreive current user object.
@@ -33,16 +45,26 @@ class BaseHandler(tornado.web.RequestHandler):
         if not user_id:
             callback(user=None)
             return
+        # Serve the user object from the cache if possible.
+        user = self.application.user_cache.get(user_id)
+        if user is not None:
+            self._current_user = user
+            callback(user=user)
+            return
         # Define a callback for the db query.
         def query_callback(response, error):
             if error:
-                raise tornado.web.HTTPError(500)
+                # A saturated pool is not an error of MongoDB, the client may retry.
+                raise tornado.web.HTTPError(503 if isinstance(error, CheckoutError) else 500)
             else:
+                if response:
+                    self.application.user_cache.set(user_id, response)
                 self._current_user = response
                 callback(user=response)
             
         # Load user object and pass query_callback as callback.
-        self.db.users.find_one({'_id': ObjectId(user_id)}, callback=query_callback)
+        self.db.users.find_one({'_id': ObjectId(user_id)},
+                              callback=metrics.timed('find_one', query_callback))
         return
     
     def render_default(self, template_name, **kwargs):
@@ -0,0 +1,76 @@
+# coding=UTF-8
+
+# General modules.
+import collections
+import itertools
+
+
+
+class MessageBuffer(object):
+    """
+    A bounded ring buffer holding the most recent messages of one chat room.
+    Messages are indexed by their id and numbered in order of insertion, so
+    the messages newer than a cursor are found without scanning the buffer.
+    """
+    def __init__(self, size=50):
+        if size < 1:
+            raise ValueError("A message buffer holds at least one message, got %r" % size)
+        self.messages = collections.deque(maxlen=size)
+        # Maps message ids to the sequence number of the message.
+        self.index = {}
+        # Sequence number of the next message appended.
+        self.next = 0
+
+
+    def append(self, message):
+        """
+        Appends a message with a stringified '_id' and drops the oldest message
+        if the buffer is full.
+        """
+        if len(self.messages) == self.messages.maxlen:
+            del self.index[self.messages[0]["_id"]]
+        self.messages.append(message)
+        self.index[message["_id"]] = self.next
+        self.next += 1
+
+
+    def since(self, cursor):
+        """
+        Returns the list of messages newer than the message with the id cursor
+        or None if the cursor is not in the buffer (anymore).
+        """
+        position = self.index.get(cursor)
+        if position is None:
+            return None
+        # Walk backwards from the newest message to copy only what is needed.
+        newer = self.next - position - 1
+        recent = list(itertools.islice(reversed(self.messages), newer))
+        recent.reverse()
+        return recent
+
+
+    def recent(self, count):
+        """
+        Returns a list of the latest count messages.
+        """
+        recent = list(itertools.islice(reversed(self.messages), count))
+        recent.reverse()
+        return recent
+
+
+
+class MessageBuffers(dict):
+    """
+    Dictionary of message buffers by chat room creating buffers on first use.
+    """
+    def __init__(self, size=50):
+        # Fail at startup, not on the first message of a chat room.
+        if size < 1:
+            raise ValueError("A message buffer holds at least one message, got %r" % size)
+        dict.__init__(self)
+        self.size = size
+
+
+    def __missing__(self, room):
+        buffer = self[room] = MessageBuffer(self.size)
+        return buffer
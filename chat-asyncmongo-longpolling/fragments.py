@@ -0,0 +1,45 @@
+# coding=UTF-8
+
+# General modules.
+import collections
+
+# Tornado modules.
+import tornado.template
+
+
+
+class FragmentCache(object):
+    """
+    Caches the rendered HTML fragments (message.html) of the latest messages
+    per chat room. Fragments are added when messages are published and the
+    cache of each room is trimmed to the history window, so loading a chat
+    room only renders messages which have not been rendered before.
+    """
+    def __init__(self, template_path, size=50):
+        loader = tornado.template.Loader(template_path, autoescape="xhtml_escape")
+        self.template = loader.load("message.html")
+        self.size = size
+        # Maps chat rooms to the fragments by message id in order of insertion.
+        self.rooms = collections.defaultdict(collections.OrderedDict)
+
+
+    def append(self, room, message):
+        """
+        Returns the fragment of the message, rendering and caching it if it is
+        not cached yet.
+        """
+        fragments = self.rooms[room]
+        fragment = fragments.get(message["_id"])
+        if fragment is None:
+            fragment = self.template.generate(message=message)
+            fragments[message["_id"]] = fragment
+            if len(fragments) > self.size:
+                fragments.popitem(last=False)
+        return fragment
+
+
+    def render(self, room, messages):
+        """
+        Returns the HTML of the list of messages of the given chat room.
+        """
+        return "".join([self.append(room, message) for message in messages])
@@ -0,0 +1,200 @@
+# coding=UTF-8
+
+# General modules.
+import bisect
+import time
+
+# Tornado modules.
+import tornado.web
+
+
+
+def format_labels(names, values, extra=''):
+    """
+    Returns the label set of a sample in Prometheus text format.
+    """
+    pairs = ['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')
+                                              .replace('\n', '\\n'))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+
+class Metric(object):
+    """
+    Base class of a metric family with optional labels. Values are kept per
+    tuple of label values. Instead of being updated on the hot path a metric
+    can read its values from a callback at scrape time, which returns either
+    a number or a dict of numbers by tuple of label values.
+    """
+    type = 'untyped'
+
+    def __init__(self, name, documentation, labels=(), callback=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.callback = callback
+        self.values = {}
+
+
+    def samples(self):
+        """
+        Returns a list of (name suffix, label values, extra label, value).
+        """
+        values = self.values
+        if self.callback is not None:
+            values = self.callback()
+            if not isinstance(values, dict):
+                values = {(): values}
+        return [('', labels, '', value) for labels, value in sorted(values.items())]
+
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        for suffix, labels, extra, value in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix,
+                                        format_labels(self.labels, labels, extra),
+                                        repr(float(value))))
+        return '\n'.join(lines)
+
+
+
+class Counter(Metric):
+    """
+    A value which only goes up, like the number of messages delivered.
+    """
+    type = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+
+class Gauge(Metric):
+    """
+    A value which goes up and down, like the number of open sockets.
+    """
+    type = 'gauge'
+
+    def set(self, value, labels=()):
+        self.values[labels] = value
+
+
+    def inc(self, labels=(), amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+
+
+class Histogram(Metric):
+    """
+    Counts observed durations in cumulative buckets.
+    """
+    type = 'histogram'
+    buckets = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+    def observe(self, value, labels=()):
+        state = self.values.get(labels)
+        if state is None:
+            # Counts per bucket plus the overflow, sum of values.
+            state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+
+    def samples(self):
+        samples = []
+        for labels, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                samples.append(('_bucket', labels, 'le="%s"' % le, cumulative))
+            samples.append(('_sum', labels, '', total))
+            samples.append(('_count', labels, '', cumulative))
+        return samples
+
+
+
+class Registry(object):
+    """
+    The metrics of this process. Metrics are created on first use and
+    shared by name, so modules can define the metrics they update.
+    """
+    def __init__(self):
+        self.metrics = {}
+
+
+    def register(self, cls, name, documentation, labels=(), callback=None):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, documentation, labels, callback)
+        elif callback is not None:
+            # The latest Application provides the values.
+            metric.callback = callback
+        return metric
+
+
+    def counter(self, name, documentation, labels=(), callback=None):
+        return self.register(Counter, name, documentation, labels, callback)
+
+
+    def gauge(self, name, documentation, labels=(), callback=None):
+        return self.register(Gauge, name, documentation, labels, callback)
+
+
+    def histogram(self, name, documentation, labels=()):
+        return self.register(Histogram, name, documentation, labels)
+
+
+    def render(self):
+        """
+        Returns all metrics in Prometheus text format.
+        """
+        return '\n'.join([self.metrics[name].render() for name in sorted(self.metrics)]) + '\n'
+
+
+registry = Registry()
+
+# Metrics of the message path shared by all modules.
+INGESTED = registry.counter('chat_messages_ingested_total',
+                            'Messages received from clients.', ['room'])
+DELIVERED = registry.counter('chat_messages_delivered_total',
+                             'Messages handed to clients, counted per recipient.', ['room'])
+FANOUT_SECONDS = registry.histogram('chat_fanout_seconds',
+                                    'Duration of handing new messages to all local clients.', ['room'])
+DATASTORE_SECONDS = registry.histogram('chat_datastore_seconds',
+                                       'Round trip latency of datastore commands.', ['command'])
+DATASTORE_IN_FLIGHT = registry.gauge('chat_datastore_in_flight',
+                                     'Datastore commands waiting for their reply.', ['command'])
+
+
+def timed(command, callback):
+    """
+    Wraps the callback of an asynchronous datastore command to record its
+    round trip latency and the number of commands in flight.
+    """
+    labels = (command,)
+    start = time.time()
+    DATASTORE_IN_FLIGHT.inc(labels)
+    def on_reply(*args, **kwargs):
+        DATASTORE_IN_FLIGHT.dec(labels)
+        DATASTORE_SECONDS.observe(time.time() - start, labels)
+        return callback(*args, **kwargs)
+    return on_reply
+
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """
+    Serves the metrics of this process in Prometheus text format.
+    """
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(self.application.metrics.render())
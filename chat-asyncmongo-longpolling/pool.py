@@ -0,0 +1,192 @@
+# coding=UTF-8
+
+# General modules.
+import collections
+import functools
+import logging
+import time
+
+# Tornado modules.
+import tornado.ioloop
+
+# MongoDb modules.
+import asyncmongo
+import asyncmongo.pool
+from asyncmongo.errors import TooManyConnections
+
+# Import application modules.
+import metrics
+
+
+WAIT_SECONDS = metrics.registry.histogram('chat_mongo_pool_wait_seconds',
+                                          'Time queries waited for a connection of the MongoDB pool.')
+CHECKOUT_FAILURES = metrics.registry.counter('chat_mongo_pool_checkout_failures_total',
+                                             'Queries failed because no MongoDB connection became available.',
+                                             ['reason'])
+
+
+
+class CheckoutError(TooManyConnections):
+    """
+    Raised if a query got no connection of the pool, as opposed to errors of
+    MongoDB itself.
+    """
+
+
+
+class QueuedPool(asyncmongo.pool.ConnectionPool):
+    """
+    A connection pool of asyncmongo where queries wait for a connection if
+    all maxconnections are in use, instead of failing at once. Waiting
+    queries get the next released connection in order of arrival and fail
+    with CheckoutError after timeout seconds or if max_waiters queries are
+    waiting already.
+    """
+    def __init__(self, timeout=5.0, max_waiters=1000, **kwargs):
+        asyncmongo.pool.ConnectionPool.__init__(self, **kwargs)
+        self.timeout = timeout
+        self.max_waiters = max_waiters
+        # Waiting queries as [callback, time of arrival, timeout handle].
+        self.waiters = collections.deque()
+        self.dispatching = False
+
+
+    def in_use(self):
+        """
+        Returns the number of connections running a query.
+        """
+        return self._connections
+
+
+    def idle(self):
+        """
+        Returns the number of open connections waiting for a query.
+        """
+        return len(self._idle_cache)
+
+
+    def available(self):
+        """
+        Returns whether a query can take a connection now.
+        """
+        return not self._maxconnections or self._connections < self._maxconnections
+
+
+    def checkout(self, callback):
+        """
+        Calls the callback with None as soon as a connection is available, or
+        with a CheckoutError if there is none in time. The callback has to
+        start its query right away to take the connection.
+        """
+        if not self.waiters and self.available():
+            callback(None)
+            return
+        if len(self.waiters) >= self.max_waiters:
+            CHECKOUT_FAILURES.inc(('queue_full',))
+            callback(CheckoutError("%d queries are already waiting for a connection" % len(self.waiters)))
+            return
+        waiter = [callback, time.time(), None]
+        if self.timeout:
+            waiter[2] = tornado.ioloop.IOLoop.instance().add_timeout(
+                time.time() + self.timeout, functools.partial(self.on_timeout, waiter))
+        self.waiters.append(waiter)
+
+
+    def on_timeout(self, waiter):
+        """
+        Fails a query which waited too long for a connection.
+        """
+        try:
+            self.waiters.remove(waiter)
+        except ValueError:
+            return
+        CHECKOUT_FAILURES.inc(('timeout',))
+        WAIT_SECONDS.observe(time.time() - waiter[1])
+        logging.warning("No MongoDB connection available within %s s, %d in use, %d queries waiting",
+                        self.timeout, self._connections, len(self.waiters))
+        waiter[0](CheckoutError("No connection available within %s s" % self.timeout))
+
+
+    def connection(self):
+        try:
+            return asyncmongo.pool.ConnectionPool.connection(self)
+        except TooManyConnections:
+            CHECKOUT_FAILURES.inc(('exhausted',))
+            raise
+
+
+    def cache(self, con):
+        """
+        Takes back a connection and hands it to the next waiting query once
+        asyncmongo is done with it.
+        """
+        asyncmongo.pool.ConnectionPool.cache(self, con)
+        if self.waiters and not self.dispatching:
+            self.dispatching = True
+            tornado.ioloop.IOLoop.instance().add_callback(self.dispatch)
+
+
+    def dispatch(self):
+        """
+        Starts the waiting queries as long as connections are available.
+        """
+        self.dispatching = False
+        now = time.time()
+        while self.waiters and self.available():
+            callback, arrival, timeout = self.waiters.popleft()
+            if timeout is not None:
+                tornado.ioloop.IOLoop.instance().remove_timeout(timeout)
+            WAIT_SECONDS.observe(now - arrival)
+            try:
+                callback(None)
+            except:
+                logging.error("Error starting a query", exc_info=True)
+
+
+
+class QueuedCursor(object):
+    """
+    Wraps a cursor of asyncmongo, so its queries wait for a connection of
+    the QueuedPool. A query which gets no connection passes the
+    CheckoutError to its callback like a failed query. Documents are encoded
+    only when the query gets a connection, so they must not be changed while
+    the query waits.
+    """
+    def __init__(self, cursor, pool):
+        self.cursor = cursor
+        self.pool = pool
+
+
+    def __getattr__(self, name):
+        method = getattr(self.cursor, name)
+        if name not in ('find', 'find_one', 'insert', 'update', 'remove', 'save'):
+            return method
+        def queued(*args, **kwargs):
+            callback = kwargs.get('callback')
+            def on_checkout(error):
+                if error is not None:
+                    if callback is not None:
+                        callback(None, error)
+                    return
+                try:
+                    method(*args, **kwargs)
+                except Exception, err:
+                    if callback is None:
+                        raise
+                    callback(None, err)
+            self.pool.checkout(on_checkout)
+        return queued
+
+
+
+class Client(asyncmongo.Client):
+    """
+    An asyncmongo client using the given QueuedPool instead of a shared pool
+    by id.
+    """
+    def __init__(self, pool):
+        self._pool = pool
+
+
+    def connection(self, collectionname, dbname=None):
+        return QueuedCursor(asyncmongo.Client.connection(self, collectionname, dbname), self._pool)
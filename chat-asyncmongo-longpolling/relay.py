@@ -0,0 +1,53 @@
+# coding=UTF-8
+
+# General modules.
+import functools
+import logging
+import threading
+import time
+
+# Tornado modules.
+import tornado.ioloop
+
+
+
+class MessageRelay(threading.Thread):
+    """
+    Tails the capped collection of a chat room with a tailable cursor in a
+    background thread and hands every message inserted by any process over to
+    the IOLoop. This way waiters of all worker processes and nodes learn about
+    new messages, not only those of the process the message was posted to.
+    The callback is called on the IOLoop thread and has to ignore messages it
+    knows already.
+    """
+    def __init__(self, collection, after, callback):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.collection = collection
+        # Id of the latest message known when the relay starts.
+        self.after = after
+        self.callback = callback
+        # Grab the IOLoop now, IOLoop.instance() is not meant for other threads.
+        self.io_loop = tornado.ioloop.IOLoop.instance()
+
+
+    def run(self):
+        """
+        Follows the collection forever. A tailable cursor dies if the
+        collection is empty or the cursor fell behind, so it is reopened
+        after the latest message relayed.
+        """
+        while True:
+            try:
+                spec = {'_id': {'$gt': self.after}} if self.after else {}
+                cursor = self.collection.find(spec, tailable=True, await_data=True)
+                while cursor.alive:
+                    for message in cursor:
+                        self.after = message["_id"]
+                        # Stringify _id.
+                        message["_id"] = str(message["_id"])
+                        self.io_loop.add_callback(functools.partial(self.callback, message))
+            except:
+                logging.error("Error tailing messages", exc_info=True)
+            # Wait a moment before reopening the cursor.
+            time.sleep(1)
@@ -51,6 +51,13 @@ function postMessage(form) {
         timeout: 60000,
         cache: false
     }).done(function ( data ) {
+        if (data.retry_after) {
+            // Posting too fast, so wait before the next message is allowed.
+            console.log("Slow down, retrying is allowed in " + data.retry_after + " s");
+            window.setTimeout(function() { disabled.removeAttr("disabled"); }, data.retry_after * 1000);
+            $("#message-input").select();
+            return;
+        }
         if (!data._id) {
             console.log("Error creating message");
             $("#message-input").select();
@@ -0,0 +1,61 @@
+# coding=UTF-8
+
+# General modules.
+import logging
+import time
+import zlib
+
+# Import application modules.
+import metrics
+
+
+# Stages of a message measured from its ingest:
+# persist - the datastore acknowledged the write, which includes publishing
+#           where both are sent at once
+# receive - the process serving a client got the published message
+# deliver - the message was written to the client connection
+STAGE_SECONDS = metrics.registry.histogram('chat_message_stage_seconds',
+                                           'Time from ingest of a message to the end of each stage.',
+                                           ['stage'])
+
+# Fraction of messages logged with their stages, set from the command line.
+sample_rate = 0.0
+log = logging.getLogger("chat.trace")
+
+
+def stamp(message):
+    """
+    Stores the time of ingest in the message. The timestamp travels with the
+    message through the datastore, so every process can measure the stages.
+    """
+    message["_ts"] = time.time()
+
+
+def sampled(message_id):
+    """
+    Returns whether the message is traced in the log. The decision depends on
+    the message id only, so all processes log the same messages.
+    """
+    return (zlib.crc32(str(message_id)) & 0xffffffff) < sample_rate * 0x100000000
+
+
+def stage(message, name, now=None):
+    """
+    Records the end of a stage of the message.
+    """
+    ingest = message.get("_ts")
+    if ingest is None:
+        return
+    elapsed = (now or time.time()) - ingest
+    STAGE_SECONDS.observe(elapsed, (name,))
+    if sample_rate and sampled(message.get("_id")):
+        log.info("message %s %s after %.3f ms", message.get("_id"), name, elapsed * 1000)
+
+
+def stages(messages, name):
+    """
+    Records the end of a stage of all messages at once.
+    """
+    now = time.time()
+    for message in messages:
+        stage(message, name, now)
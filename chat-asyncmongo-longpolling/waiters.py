@@ -0,0 +1,77 @@
+# coding=UTF-8
+
+# General modules.
+import logging
+
+
+
+class WaiterRegistry(object):
+    """
+    Index of the parked long polling requests by chat room. Each room maps
+    the handler of a waiting request to its callback, so waiters are added
+    and removed in O(1) and a new message only wakes the waiters of its own
+    chat room.
+    """
+    def __init__(self):
+        # Maps chat rooms to dicts of callbacks by handler.
+        self.rooms = {}
+
+
+    def add(self, room, key, callback):
+        """
+        Parks the callback of the request key until the next message in the
+        given chat room.
+        """
+        waiters = self.rooms.get(room)
+        if waiters is None:
+            waiters = self.rooms[room] = {}
+        waiters[key] = callback
+
+
+    def remove(self, room, key):
+        """
+        Removes the waiter of the request key, e.g. if the client went away.
+        Returns whether the request was waiting.
+        """
+        waiters = self.rooms.get(room)
+        if waiters is None or key not in waiters:
+            return False
+        del waiters[key]
+        if not waiters:
+            del self.rooms[room]
+        return True
+
+
+    def notify(self, room, messages):
+        """
+        Passes the messages to all waiters of the given chat room and returns
+        their number. The waiters are detached before any callback is called,
+        so requests parked by the callbacks wait for the next message instead
+        of being dropped or woken twice.
+        """
+        waiters = self.rooms.pop(room, None)
+        if not waiters:
+            return 0
+        for callback in waiters.itervalues():
+            try: # Send messages to waiter.
+                callback(messages)
+            except:
+                logging.error("Error in waiter callback", exc_info=True)
+        return len(waiters)
+
+
+    def count(self, room=None):
+        """
+        Returns the number of parked waiters of the given chat room or of all
+        chat rooms.
+        """
+        if room is not None:
+            return len(self.rooms.get(room, ()))
+        return sum([len(waiters) for waiters in self.rooms.itervalues()])
+
+
+    def counts(self):
+        """
+        Returns a dict of the number of parked waiters by chat room.
+        """
+        return dict([(room, len(waiters)) for room, waiters in self.rooms.iteritems()])
@@ -3,19 +3,17 @@
 # General modules.
 import os.path
 import logging
+import math
 import sys
-from threading import Timer
 
 # Tornado modules.
 import tornado.ioloop
 import tornado.web
 import tornado.auth
 import tornado.options
+import tornado.template
 import tornado.escape
 
-# MongoDb modules.
-from bson.objectid import ObjectId
-
 # Redis modules.
 import brukva
 
@@ -23,10 +21,87 @@ import brukva
 from base import BaseHandler
 from auth import LoginHandler
 from auth import LogoutHandler
+from assets import AssetHandler
+from assets import Assets
+from cache import LRUCache
+from fragments import FragmentCache
+from history import HistoryHandler
+import metrics
+from metrics import MetricsHandler
+from presence import Presence
+from ratelimit import RateLimiter
+from ratelimit import RedisRateLimiter
+from ratelimit import slow_down
+from store import ListStore
+from store import MemoryStore
+from store import StreamStore
+from server import serve
+from startup import ReadyHandler
+from startup import Startup
+from startup import precompile
+from timerwheel import TimerWheel
+import tracing
 from symbol import except_clause
 
 # Define port from command line parameter.
 tornado.options.define("port", default=8888, help="run on the given port", type=int)
+# Define how many processes serve the application and how they listen.
+tornado.options.define("processes", default=1,
+                       help="number of worker processes, 0 for one per CPU", type=int)
+tornado.options.define("reuse_port", default=False,
+                       help="bind a socket per worker with SO_REUSEPORT instead of sharing one", type=bool)
+tornado.options.define("unix_socket", default=None,
+                       help="path of an additional unix socket to listen on, e.g. for a local proxy")
+# Define how chat rooms are stored and delivered.
+tornado.options.define("backend", default="list",
+                       help="room backend: list (Redis lists and Pub/Sub), stream (Redis Streams) "
+                            "or memory (this process only)")
+tornado.options.define("stream_block", default=1000,
+                       help="milliseconds a blocking stream read waits for new messages", type=int)
+# Define how many messages are kept per chat room and paged at once.
+tornado.options.define("room_retention", default=1000,
+                       help="maximum number of messages kept per chat room", type=int)
+tornado.options.define("history_page_size", default=50,
+                       help="number of messages per page of the history", type=int)
+# Define the server-side deadline of long polling requests.
+tornado.options.define("poll_timeout", default=45,
+                       help="seconds a long polling request waits before it is answered without messages", type=int)
+tornado.options.define("poll_jitter", default=10,
+                       help="maximum random seconds added to the poll timeout", type=int)
+# Define the number of latest messages shown when loading a chat room.
+tornado.options.define("history_size", default=50,
+                       help="number of latest messages shown when loading a chat room", type=int)
+# Define size and lifetime of the in-process user cache.
+tornado.options.define("user_cache_size", default=10000,
+                       help="maximum number of cached user objects", type=int)
+tornado.options.define("user_cache_ttl", default=60,
+                       help="seconds a cached user object is valid", type=int)
+# Define how many of the latest messages are checked for missed messages.
+tornado.options.define("catchup_size", default=50,
+                       help="number of latest messages checked for messages missed between pollings", type=int)
+# Define how the members of chat rooms are tracked.
+tornado.options.define("presence_interval", default=5,
+                       help="seconds between flushing presence changes", type=int)
+tornado.options.define("presence_ttl", default=30,
+                       help="seconds after which a member not polling anymore leaves a chat room", type=int)
+tornado.options.define("presence_listed", default=100,
+                       help="maximum number of members listed per chat room, larger rooms only show a count",
+                       type=int)
+# Define how fast users can post and how many messages a chat room takes.
+tornado.options.define("user_rate", default=1.0,
+                       help="messages per second a user can post on average, 0 for unlimited", type=float)
+tornado.options.define("user_burst", default=5,
+                       help="messages a user can post at once", type=int)
+tornado.options.define("room_rate", default=20.0,
+                       help="messages per second a chat room takes on average, 0 for unlimited", type=float)
+tornado.options.define("room_burst", default=50,
+                       help="messages a chat room takes at once", type=int)
+tornado.options.define("shared_rate_limits", default=False,
+                       help="keep the rate limits in Redis to enforce them across processes and nodes",
+                       type=bool)
+# Define the fraction of messages whose latency per stage is logged.
+tornado.options.define("trace_sample", default=0.0,
+                       help="fraction of messages traced in the log from ingest to delivery", type=float)
 
 
 
@@ -44,9 +119,10 @@ class MainHandler(BaseHandler):
         if not user:
             self.redirect("/login")
             return
-        # Retreive 50 latest messages.
-        self.application.client.lrange('conversation', -50, -1, 
-                                       self.on_conversation_find)
+        # Retreive latest messages.
+        self.application.store.recent('conversation',
+                                      tornado.options.options.history_size,
+                                      self.on_conversation_find)
         
     
     def on_conversation_find(self, result):
@@ -55,13 +131,12 @@ class MainHandler(BaseHandler):
         """
         if isinstance(result, Exception):
             raise tornado.web.HTTPError(500)
-        # JSON-decode messages.
-        messages = []
-        for message in result:
-            messages.append(tornado.escape.json_decode(message))
+        messages = result
         
-        content = self.render_string("messages.html", 
-                        messages=messages)
+        # Only messages not rendered before need to be rendered.
+        history = self.application.fragments.render('conversation', messages)
+        content = self.render_string("messages.html", history=history,
+                                     presence=self.application.presence.snapshot('conversation'))
         self.render_default("index.html", content=content, chat=1)
 
         
@@ -90,45 +165,47 @@ class MessageHandler(BaseHandler):
             self.finish({'error': 1, 'textStatus': 'unauthorized'})
             return;
         
-        # Subscribe to conversation channel.
-        self.new_message_send = False
-        self.client = brukva.Client()
-        self.client.connect()
-        self.client.subscribe('conversation')
-        self.subscribed = True
-        self.client.listen(self.on_new_messages)
-        
-        # @todo: We could check if we missed a message between pollings.
+        # Get cursor from request.
+        cursor = self.get_argument("cursor", None)
+        # Wait for messages newer than the cursor. Messages missed between
+        # pollings are delivered right away.
+        self.waiter = self.application.store.wait('conversation', cursor,
+                                                  self.on_new_messages)
+        # Answer without messages if none arrive before the deadline.
+        self.application.deadlines.add(self, self.on_poll_timeout)
+        # The user is present while polling.
+        self.member = user['name']
+        self.application.presence.join('conversation', self.member)
         
         
-    def on_new_messages(self, message):
+    def on_new_messages(self, messages):
         """
-        Callback for listening to subscription 'conversation'
-        """
-        logging.info("on_new_messages GET")
-        # Aboart if message type is something like unsubscribe.
-        if not message.kind == "message":
-            return;
-        # Aboard if fired twice.
-        if self.new_message_send:
-            return;
-        self.new_message_send = True
-        logging.info("NEW MESSAGE")
-        logging.info(message)
+        Callback called by the waiter when new messages are available.
+        messages - a list of message object that are new to the client.
         """
-        Callback called by get() when new message is available.
-        message - a new message.
-        """
-        # Remove waiter.
         logging.info("Removed one waiter")
-        self.client.unsubscribe('conversation')
-        self.subscribed = False
         # Closed client connection
         if self.request.connection.stream.closed():
             logging.warning("Waiter disappeared")
             return
         # Send messages to client and finish connection.
-        self.finish(dict(messages=[tornado.escape.json_decode(message.body)]))
+        metrics.DELIVERED.inc(('conversation',), len(messages))
+        self.finish(dict(messages=messages,
+                         presence=self.application.presence.snapshot('conversation')))
+        tracing.stages(messages, 'deliver')
+        
+
+    def on_poll_timeout(self):
+        """
+        Called by the timer wheel when the deadline of this request passed.
+        The client polls again right away after the empty response.
+        """
+        self.waiter.cancel()
+        # Closed client connection
+        if self.request.connection.stream.closed():
+            return
+        self.finish(dict(messages=[],
+                         presence=self.application.presence.snapshot('conversation')))
         
 
     def on_finish(self):
@@ -152,17 +229,15 @@ class MessageHandler(BaseHandler):
         """
         Frees up resource related to this request.
         """
-        # Cleanup database connection.
+        # Stop waiting for messages.
         logging.info("CLEANUP")
-        if hasattr(self, 'client'):
-            # Unsubscribe if not done yet.
-            if self.subscribed:
-                self.client.unsubscribe('conversation')
-                self.subscribed
-            # Disconnect connection after delay due to this issue:
-            # https://github.com/evilkost/brukva/issues/25 
-            t = Timer(0.1, self.client.disconnect)
-            t.start()
+        if hasattr(self, 'waiter'):
+            self.waiter.cancel()
+        self.application.deadlines.remove(self)
+        # Keep the user present until the next poll or until it expires.
+        if getattr(self, 'member', None):
+            self.application.presence.leave('conversation', self.member, expire=True)
+            self.member = None
         
     
     @tornado.web.asynchronous
@@ -199,28 +274,57 @@ class MessageHandler(BaseHandler):
             self.finish({'error': 1, 'textStatus': 'Bad input data'})
             return;
         
-        # Save message.
+        # Reject the message if the user or the chat room is too fast.
+        self.message = message
+        self.application.ratelimit.check(self.get_secure_cookie("user"), 'conversation',
+                                         self.on_rate_checked)
+        
+        
+    def on_rate_checked(self, retry_after):
+        """
+        Callback for checking the rate limits in self.post_on_auth().
+        """
+        # Closed client connection
+        if self.request.connection.stream.closed():
+            return
+        if retry_after:
+            self.set_header("Retry-After", int(math.ceil(retry_after)))
+            self.finish(slow_down(retry_after))
+            return;
+        
+        # Persistently store and publish message.
+        message = self.message
+        metrics.INGESTED.inc(('conversation',))
+        tracing.stamp(message)
         try:
-            # Generate object id as message id.
-            message["_id"] = str(ObjectId())
-            # Convert to JSON-literal.
-            message_encoded = tornado.escape.json_encode(message)
-            # Persistently store message.
-            self.application.client.rpush('conversation', message_encoded)
-            # publish message.
-            self.application.client.publish('conversation', message_encoded)
+            self.application.store.append('conversation', message,
+                                          self.on_message_written)
         except Exception, err:
             e = str(sys.exc_info()[0])
             # Send an error back to client.
-            self.finish({'error': 1, 'textStatus': 'Error writing to database: ' + str(err)})
+            self.finish({'error': 1, 'textStatus': 'Bad input data: ' + str(err)})
             return;
         
-        # Send message to indicate a successful operation.
+        
+    def on_message_written(self, error):
+        """
+        Callback for storing and publishing the message in self.post_on_auth().
+        """
         # Closed client connection
         if self.request.connection.stream.closed():
             logging.warning("Connection disappeared")
             return
-        self.finish(message)
+        if error:
+            # Send an error back to client.
+            self.finish({'error': 1, 'textStatus': 'Error writing to database: ' + str(error)})
+            return;
+        tracing.stage(self.message, 'persist')
+        
+        # Render message for the next page loads.
+        self.application.fragments.append('conversation', self.message)
+        
+        # Send message to indicate a successful operation.
+        self.finish(self.message)
         return;
     
 
@@ -231,20 +335,35 @@ class Application(tornado.web.Application):
     """
     def __init__(self):
         
+        # Build the fingerprinted and precompressed static assets, served at /assets/.
+        static_path = os.path.join(os.path.dirname(__file__), "static")
+        self.assets = Assets(static_path, os.path.join(os.path.dirname(__file__), "build"))
+        self.assets.build()
+        
+        # Templates are compiled into this loader at startup.
+        template_path = os.path.join(os.path.dirname(__file__), "templates")
+        self.template_loader = tornado.template.Loader(template_path, autoescape="xhtml_escape")
+        
         # Handlers defining the url routing.
         handlers = [
             (r"/", MainHandler),
             (r"/login", LoginHandler),
             (r"/logout", LogoutHandler),
             (r"/message", MessageHandler),
+            (r"/history", HistoryHandler),
+            (r"/ready", ReadyHandler),
+            (r"/metrics", MetricsHandler),
+            (r"/assets/(.*)", AssetHandler, {"path": self.assets.build_path}),
         ]
         
         # Settings:
         settings = dict(
             cookie_secret = "43osdETzKXasdQAGaYdkL5gEmGeJJFuYh7EQnp2XdTP1o/Vo=",
             login_url = "/login",
-            template_path=os.path.join(os.path.dirname(__file__), "templates"),
-            static_path=os.path.join(os.path.dirname(__file__), "static"),
+            template_path=template_path,
+            template_loader=self.template_loader,
+            static_path=static_path,
+            ui_methods=self.assets.ui_methods(),
             xsrf_cookies= True,
             autoescape="xhtml_escape",
             # Set this to your desired database name.
@@ -256,6 +375,19 @@ class Application(tornado.web.Application):
         # Call super constructor.
         tornado.web.Application.__init__(self, handlers, **settings)
         
+        # Cache user objects to resolve the user cookie without a database
+        # round trip on every request.
+        self.user_cache = LRUCache(tornado.options.options.user_cache_size,
+                                   tornado.options.options.user_cache_ttl)
+        
+        # Cache the rendered latest messages of each chat room.
+        self.fragments = FragmentCache(self.settings["template_path"],
+                                       tornado.options.options.history_size)
+        
+        # Expire parked long polling requests before the client gives up.
+        self.deadlines = TimerWheel(tornado.options.options.poll_timeout,
+                                    tornado.options.options.poll_jitter)
+        
         """
         We create a database connection using brukva, which is a 
         non-blocking, asynchronous driver for redis.
@@ -263,6 +395,80 @@ class Application(tornado.web.Application):
         # Connect to redis.
         self.client = brukva.Client()
         self.client.connect()
+        # Chat rooms are stored and delivered either as lists and Pub/Sub
+        # channels or as streams. Messages are written in pipelined
+        # transactions on the connection above. The memory backend keeps
+        # chat rooms in this process and only uses Redis for the users.
+        options = tornado.options.options
+        if options.backend == "stream":
+            self.store = StreamStore(self.client, options.room_retention,
+                                     options.catchup_size, options.stream_block)
+        elif options.backend == "memory":
+            if options.processes != 1:
+                logging.warning("Chat rooms of the memory backend are not shared between processes")
+            self.store = MemoryStore(options.room_retention, options.catchup_size)
+        else:
+            self.store = ListStore(self.client, options.room_retention,
+                                   options.catchup_size)
+        
+        # Track who is in which chat room. Polls answer with the latest
+        # state, so presence never wakes up parked polls.
+        self.presence = Presence(self.client, options.presence_interval,
+                                 options.presence_ttl, options.presence_listed)
+        
+        # Limit the rate of messages per user and chat room, in this
+        # process or shared by all processes in Redis.
+        limits = (options.user_rate, options.user_burst, options.room_rate, options.room_burst)
+        if options.shared_rate_limits:
+            self.ratelimit = RedisRateLimiter(self.client, *limits)
+        else:
+            self.ratelimit = RateLimiter(*limits)
+        
+        # Log the stages of a sample of the messages.
+        tracing.sample_rate = options.trace_sample
+        
+        # Expose the state of this process at /metrics. These values are read
+        # when scraped.
+        self.metrics = metrics.registry
+        self.metrics.gauge('chat_parked_polls', 'Long polling requests waiting for messages by chat room.',
+                           ['room'], lambda: {('conversation',): len(self.deadlines)})
+        self.metrics.counter('chat_user_lookups_total',
+                             'User lookups by cache result, misses query the datastore.', ['result'],
+                             lambda: {('hit',): self.user_cache.hits, ('miss',): self.user_cache.misses})
+        self.metrics.gauge('chat_presence_members', 'Members present by chat room watched by this process.',
+                           ['room'], lambda: dict([((room,), count) for room, (count, members)
+                                                   in self.presence.snapshots.iteritems()]))
+        
+        # Warm up this process before it takes traffic, /ready tells load
+        # balancers when it is done.
+        self.startup = Startup()
+        self.startup.add_blocking('templates', lambda: precompile(self.template_loader, template_path))
+        self.startup.add('datastore', self.check_datastore)
+        self.startup.add('rooms', self.warm_rooms)
+        tornado.ioloop.IOLoop.instance().add_callback(self.startup.run)
+        
+    
+    def check_datastore(self, callback):
+        """
+        Startup phase checking the connection to Redis.
+        """
+        def on_pong(result):
+            callback(result if isinstance(result, Exception) else None)
+        self.client.execute_command('PING', metrics.timed('ping', on_pong))
+        
+    
+    def warm_rooms(self, callback):
+        """
+        Startup phase loading and rendering the latest messages of the chat
+        room, so the first page loads are served from the fragment cache.
+        """
+        def on_recent(result):
+            if isinstance(result, Exception):
+                callback(result)
+                return
+            self.fragments.render('conversation', result)
+            callback()
+        self.store.recent('conversation', tornado.options.options.history_size, on_recent)
         
 
 
@@ -272,11 +478,11 @@ def main():
     """
      # This line will setup default options.
     tornado.options.parse_command_line()
-    # Create an instance of the main application.
-    application = Application()
-    # Start application by listening to desired port and starting IOLoop.
-    application.listen(tornado.options.options.port)
-    tornado.ioloop.IOLoop.instance().start()
+    # Start the application in the desired number of processes by listening
+    # to desired port and starting IOLoop.
+    options = tornado.options.options
+    serve(Application, options.port, processes=options.processes,
+          reuse_port=options.reuse_port, unix_socket=options.unix_socket)
     
 
 if __name__ == "__main__":
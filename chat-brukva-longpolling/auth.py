@@ -102,6 +102,8 @@ class LoginHandler(BaseHandler, tornado.auth.GoogleMixin):
                 self.application.client.set("user:" + user["email"],
                                             tornado.escape.json_encode(user))
             
+            # Drop the outdated user object from the cache.
+            self.application.user_cache.invalidate(str(user["email"]))
             # Save user id in cookie.
             self.set_secure_cookie("user", str(user["email"]))
             logging.warning("Cookie set")
@@ -12,6 +12,9 @@ import brukva
 # General modules.
 import logging
 
+# Import application modules.
+import metrics
+
 
 class BaseHandler(tornado.web.RequestHandler):
     """
@@ -23,6 +26,14 @@ class BaseHandler(tornado.web.RequestHandler):
         # Call super constructor.
         tornado.web.RequestHandler.__init__(self, application, request, **kwargs)
         
+    def prepare(self):
+        # Answer with 503 until the startup phases are done, the datastore
+        # may not be connected yet.
+        if not self.application.startup.ready:
+            self.set_status(503)
+            self.set_header("Retry-After", "1")
+            self.finish()
+        
     def _get_current_user(self, callback):
         """
         An async method to retreive current user object.
@@ -35,6 +46,12 @@ class BaseHandler(tornado.web.RequestHandler):
             logging.warning("Cookie not found")
             callback(user=None)
             return
+        # Serve the user object from the cache if possible.
+        user = self.application.user_cache.get(user_id)
+        if user is not None:
+            self._current_user = user
+            callback(user=user)
+            return
         # Define a callback for the db query.
         def query_callback(result):
             if result == "null" or not result:
@@ -42,11 +59,12 @@ class BaseHandler(tornado.web.RequestHandler):
                 user = {}
             else:
                 user = tornado.escape.json_decode(result)
+                self.application.user_cache.set(user_id, user)
             self._current_user = user
             callback(user=user)
             
         # Load user object and pass query_callback as callback.
-        self.application.client.get("user:" + user_id, query_callback)
+        self.application.client.get("user:" + user_id, metrics.timed('get', query_callback))
         return
     
     def render_default(self, template_name, **kwargs):
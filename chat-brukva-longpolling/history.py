@@ -0,0 +1,62 @@
+# coding=UTF-8
+
+# Tornado modules.
+import tornado.web
+import tornado.options
+
+# Import application modules.
+from base import BaseHandler
+
+
+
+class HistoryHandler(BaseHandler):
+    """
+    Handler for paging backwards through the history of a chat room.
+    """
+    @tornado.web.asynchronous
+    def get(self, room='conversation'):
+        """
+        Handles get requests for older messages.
+        Expects a query like this:
+        ?before=MessageID of the oldest message received&offset=Its position
+        and responds with the next page of older messages like this:
+        {'messages': [...], 'offset': Position of the first message}
+        Positions count messages from the end of the chat room, the newest
+        message has position 1. Without before the latest page is returned.
+        """
+        self.room = str(room)
+        # Check authentication.
+        self._get_current_user(callback=self.on_auth)
+
+
+    def on_auth(self, user):
+        """
+        Callback for checking auth in self.get().
+        """
+        if not user:
+            self.finish({'error': 1, 'textStatus': 'unauthorized'})
+            return
+        # Get cursor and its position from request.
+        try:
+            before = self.get_argument("before", None)
+            position = max(int(self.get_argument("offset", 1)), 1)
+        except:
+            # Send an error back to client.
+            self.finish({'error': 1, 'textStatus': 'Bad input data'})
+            return
+        self.application.store.before(self.room, before, position,
+                                      tornado.options.options.history_page_size,
+                                      self.on_page)
+
+
+    def on_page(self, result):
+        """
+        Callback for loading a page of older messages in self.on_auth().
+        """
+        if isinstance(result, Exception):
+            raise tornado.web.HTTPError(500)
+        messages, position = result
+        # Closed client connection
+        if self.request.connection.stream.closed():
+            return
+        self.finish(dict(messages=messages, offset=position))
@@ -0,0 +1,242 @@
+# coding=UTF-8
+
+# General modules.
+import logging
+import time
+
+# Tornado modules.
+import tornado.ioloop
+
+# Import application modules.
+import metrics
+
+
+
+class Presence(object):
+    """
+    Tracks who is in which chat room in Redis sorted sets named
+    'presence:<room>' with members scored by the time they were last seen.
+    Refreshing a member is O(log n) and counting the members of a room is
+    O(1). Members not seen within ttl seconds are expired, so members of a
+    crashed process disappear by themselves.
+
+    Nothing is written per join or leave. Every interval seconds all changes
+    of this process are flushed in one pipeline, which also refreshes the
+    members connected to this process as their heartbeat and reads the
+    count and up to listed members of every watched room. The new state is
+    compared to the previous one and passed to the listeners as one diff per
+    room. Rooms with more than listed members are only reported by count.
+    """
+    def __init__(self, client, interval=5, ttl=30, listed=100):
+        self.client = client
+        self.ttl = ttl
+        self.listed = listed
+        # Number of local connections by member by chat room.
+        self.local = {}
+        # Number of local listeners by chat room.
+        self.watchers = {}
+        # Time a member was last seen locally by chat room, without a
+        # connection, e.g. when parking a long polling request.
+        self.active = {}
+        # Members seen or left since the last flush by chat room.
+        self.seen = {}
+        self.left = {}
+        # Latest state by chat room as (count, set of members or None).
+        self.snapshots = {}
+        # Latest state by chat room as sent to clients.
+        self.views = {}
+        # Callables receiving the chat room and its diff after a flush.
+        self.listeners = []
+        self.flushing = False
+        self.timer = tornado.ioloop.PeriodicCallback(self.flush, interval * 1000)
+        self.timer.start()
+
+
+    def join(self, room, member):
+        """
+        Adds a connection of the member to the chat room. The member stays
+        present as long as it has connections in this process.
+        """
+        members = self.local.setdefault(room, {})
+        members[member] = members.get(member, 0) + 1
+        self.touch(room, member)
+
+
+    def leave(self, room, member, expire=False):
+        """
+        Removes a connection of the member from the chat room. The member is
+        removed from the room with the next flush after its last connection
+        in this process is gone. With expire the member is not removed but
+        expires unless it is seen again, e.g. between two long polls.
+        """
+        members = self.local.get(room)
+        if not members or member not in members:
+            return
+        members[member] -= 1
+        if members[member]:
+            return
+        del members[member]
+        if not members:
+            del self.local[room]
+        if expire:
+            self.touch(room, member)
+            return
+        self.seen.get(room, set()).discard(member)
+        self.left.setdefault(room, set()).add(member)
+
+
+    def touch(self, room, member):
+        """
+        Marks the member as present in the chat room now.
+        """
+        self.seen.setdefault(room, set()).add(member)
+        self.left.get(room, set()).discard(member)
+        self.active[room] = time.time()
+
+
+    def watch(self, room):
+        """
+        Adds a local listener of the chat room, so its diffs are computed.
+        """
+        self.watchers[room] = self.watchers.get(room, 0) + 1
+
+
+    def unwatch(self, room):
+        """
+        Removes a local listener of the chat room.
+        """
+        count = self.watchers.get(room, 0) - 1
+        if count > 0:
+            self.watchers[room] = count
+        else:
+            self.watchers.pop(room, None)
+
+
+    def snapshot(self, room):
+        """
+        Returns the latest state of the chat room for clients like this
+        {"room": "1", "count": 3, "members": ["Alice", "Bob", "Carol"]}
+        with members being None for rooms with more than listed members, or
+        None if the room has not been flushed yet.
+        """
+        view = self.views.get(room)
+        if view is None and room in self.snapshots:
+            count, members = self.snapshots[room]
+            view = self.views[room] = {'room': room, 'count': count,
+                                       'members': sorted(members) if members is not None else None}
+        return view
+
+
+    def rooms(self):
+        """
+        Returns the chat rooms this process refreshes or watches.
+        """
+        horizon = time.time() - self.ttl
+        for room, seen in self.active.items():
+            if seen < horizon:
+                del self.active[room]
+        rooms = set(self.local)
+        rooms.update(self.watchers)
+        rooms.update(self.active)
+        return rooms
+
+
+    def flush(self):
+        """
+        Writes the changes since the last flush, expires members and reads
+        the state of the chat rooms in one pipeline.
+        """
+        if self.flushing:
+            # The previous flush is still waiting for its reply.
+            return
+        # Connected members are refreshed on every flush.
+        for room, members in self.local.iteritems():
+            self.seen.setdefault(room, set()).update(members)
+        seen, self.seen = self.seen, {}
+        left, self.left = self.left, {}
+        rooms = sorted(self.rooms().union(seen, left))
+        # Drop the state of rooms nobody is interested in anymore.
+        for room in self.snapshots.keys():
+            if room not in rooms:
+                del self.snapshots[room]
+                self.views.pop(room, None)
+        if not rooms:
+            return
+        now = time.time()
+        # Index of the ZCARD reply of every room.
+        replies = []
+        commands = 0
+        try:
+            pipe = self.client.pipeline()
+            for room in rooms:
+                key = 'presence:' + room
+                if seen.get(room):
+                    scores = []
+                    for member in seen[room]:
+                        scores.extend((now, member))
+                    pipe.execute_command('ZADD', None, key, *scores)
+                    commands += 1
+                if left.get(room):
+                    pipe.execute_command('ZREM', None, key, *left[room])
+                    commands += 1
+                pipe.execute_command('ZREMRANGEBYSCORE', None, key, '-inf', now - self.ttl)
+                pipe.execute_command('ZCARD', None, key)
+                pipe.execute_command('ZRANGE', None, key, 0, self.listed)
+                replies.append(commands + 1)
+                commands += 3
+        except Exception, err:
+            logging.error("Error flushing presence: " + str(err))
+            return
+        self.flushing = True
+        pipe.execute(metrics.timed('pipeline', lambda result: self.on_flushed(rooms, replies, result)))
+
+
+    def on_flushed(self, rooms, replies, result):
+        """
+        Callback for the pipeline sent in self.flush(). Updates the state of
+        the chat rooms and passes the diffs to the listeners.
+        """
+        self.flushing = False
+        if isinstance(result, Exception):
+            logging.error("Error flushing presence: " + str(result))
+            return
+        for room, i in zip(rooms, replies):
+            count, members = result[i], result[i + 1]
+            if isinstance(count, Exception) or isinstance(members, Exception):
+                logging.error("Error reading presence of chat room " + room)
+                continue
+            count = int(count)
+            members = set(members) if count <= self.listed else None
+            previous = self.snapshots.get(room)
+            self.snapshots[room] = (count, members)
+            self.views.pop(room, None)
+            if room not in self.watchers:
+                continue
+            diff = self.diff(room, previous, (count, members))
+            if diff is None:
+                continue
+            for listener in self.listeners:
+                try:
+                    listener(room, diff)
+                except:
+                    logging.error("Error in presence listener", exc_info=True)
+
+
+    def diff(self, room, previous, current):
+        """
+        Returns the change between two states of the chat room for clients
+        like this {"room": "1", "count": 2, "joined": ["Dave"], "left": ["Alice", "Bob"]}
+        or the whole state if the members were not known before or are not
+        listed anymore. Returns None if nothing changed.
+        """
+        count, members = current
+        if previous is None or previous[1] is None or members is None:
+            if previous == current:
+                return None
+            return {'room': room, 'count': count,
+                    'members': sorted(members) if members is not None else None}
+        joined = members - previous[1]
+        left = previous[1] - members
+        if not joined and not left and count == previous[0]:
+            return None
+        return {'room': room, 'count': count, 'joined': sorted(joined), 'left': sorted(left)}
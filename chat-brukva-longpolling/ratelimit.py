@@ -0,0 +1,160 @@
+# coding=UTF-8
+
+# General modules.
+import logging
+import time
+
+# Import application modules.
+import metrics
+
+
+LIMITED = metrics.registry.counter('chat_messages_rate_limited_total',
+                                   'Messages rejected because a sender or chat room exceeded its rate.',
+                                   ['limit'])
+
+
+def slow_down(retry_after):
+    """
+    Returns the error sent to a client exceeding a rate limit.
+    """
+    return {'error': 1, 'textStatus': 'slow down', 'retry_after': round(retry_after, 3)}
+
+
+
+class RateLimiter(object):
+    """
+    Token buckets limiting the messages per user and per chat room in this
+    process. A bucket holds up to burst tokens and refills with rate tokens
+    per second, every message takes one token from the bucket of its user
+    and of its room. A rate of 0 disables that limit. Full buckets carry no
+    state, so they are dropped whenever the number of buckets exceeds
+    max_buckets.
+    """
+    def __init__(self, user_rate=1.0, user_burst=5, room_rate=20.0, room_burst=50,
+                 max_buckets=100000):
+        self.limits = {'user': (user_rate, user_burst), 'room': (room_rate, room_burst)}
+        self.max_buckets = max_buckets
+        # Maps (limit, name) to [tokens, time of the last update].
+        self.buckets = {}
+
+
+    def acquire(self, user, room):
+        """
+        Takes a token for a message of the user in the chat room. Returns 0 if
+        the message is allowed or the seconds until it would be. Nothing is
+        taken from any bucket if the message is rejected.
+        """
+        now = time.time()
+        states = []
+        retry_after = 0.0
+        for limit, name in (('user', user), ('room', room)):
+            rate, burst = self.limits[limit]
+            if not rate:
+                continue
+            state = self.buckets.get((limit, name))
+            if state is None:
+                state = [burst, now]
+            tokens = min(burst, state[0] + (now - state[1]) * rate)
+            if tokens < 1:
+                retry_after = max(retry_after, (1 - tokens) / rate)
+                LIMITED.inc((limit,))
+            states.append(((limit, name), state, tokens))
+        if retry_after:
+            return retry_after
+        for key, state, tokens in states:
+            state[0] = tokens - 1
+            state[1] = now
+            self.buckets[key] = state
+        if len(self.buckets) > self.max_buckets:
+            self.prune(now)
+        return 0.0
+
+
+    def check(self, user, room, callback):
+        """
+        Like acquire(), but passes the result to the callback.
+        """
+        callback(self.acquire(user, room))
+
+
+    def prune(self, now):
+        """
+        Drops the buckets which have refilled completely.
+        """
+        for key, state in self.buckets.items():
+            rate, burst = self.limits[key[0]]
+            if state[0] + (now - state[1]) * rate >= burst:
+                del self.buckets[key]
+
+
+
+class RedisRateLimiter(RateLimiter):
+    """
+    Token buckets shared by all processes and nodes, kept in Redis hashes
+    named 'ratelimit:<limit>:<name>' and updated by a script in one round
+    trip per message. Buckets expire once they would be full again. If Redis
+    fails, the buckets of this process are used instead.
+    """
+    # KEYS are the buckets, ARGV the current time followed by rate and burst
+    # of every bucket. Returns the seconds to wait as string, "0" if allowed.
+    script = """
+local now = tonumber(ARGV[1])
+local wait = 0
+local tokens = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local burst = tonumber(ARGV[i * 2 + 1])
+    local state = redis.call('HMGET', key, 'tokens', 'time')
+    local available = tonumber(state[1]) or burst
+    local last = tonumber(state[2]) or now
+    available = math.min(burst, available + math.max(now - last, 0) * rate)
+    if available < 1 then
+        wait = math.max(wait, (1 - available) / rate)
+    end
+    tokens[i] = available
+end
+if wait > 0 then
+    return tostring(wait)
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local burst = tonumber(ARGV[i * 2 + 1])
+    redis.call('HMSET', key, 'tokens', tokens[i] - 1, 'time', now)
+    redis.call('PEXPIRE', key, math.ceil((burst - tokens[i] + 1) / rate * 1000))
+end
+return "0"
+"""
+
+    def __init__(self, client, user_rate=1.0, user_burst=5, room_rate=20.0, room_burst=50,
+                 max_buckets=100000):
+        RateLimiter.__init__(self, user_rate, user_burst, room_rate, room_burst, max_buckets)
+        self.client = client
+
+
+    def check(self, user, room, callback):
+        """
+        Takes a token for a message of the user in the chat room from the
+        shared buckets. The callback receives 0 if the message is allowed or
+        the seconds until it would be.
+        """
+        keys = []
+        args = [repr(time.time())]
+        for limit, name in (('user', user), ('room', room)):
+            rate, burst = self.limits[limit]
+            if rate:
+                keys.append('ratelimit:%s:%s' % (limit, name))
+                args.extend((rate, burst))
+        if not keys:
+            callback(0.0)
+            return
+        def on_result(result):
+            if isinstance(result, Exception):
+                logging.error("Error checking rate limit, limiting locally: " + str(result))
+                callback(self.acquire(user, room))
+                return
+            retry_after = float(result)
+            if retry_after:
+                LIMITED.inc(('shared',))
+            callback(retry_after)
+        self.client.execute_command('EVAL', metrics.timed('eval', on_result), self.script, len(keys),
+                                    *(keys + args))
@@ -0,0 +1,61 @@
+# coding=UTF-8
+
+# General modules.
+import logging
+import socket
+
+# Tornado modules.
+import tornado.ioloop
+import tornado.httpserver
+import tornado.netutil
+import tornado.process
+
+
+
+def bind_reuse_port(port, address=None, backlog=128):
+    """
+    Binds listening sockets to the given port with SO_REUSEPORT set, so every
+    worker process gets its own sockets and the kernel balances connections
+    between them.
+    """
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise ValueError("SO_REUSEPORT is not supported on this platform")
+    sockets = []
+    for res in set(socket.getaddrinfo(address, port, socket.AF_UNSPEC,
+                                      socket.SOCK_STREAM, 0, socket.AI_PASSIVE)):
+        af, socktype, proto, canonname, sockaddr = res
+        sock = socket.socket(af, socktype, proto)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if af == socket.AF_INET6 and hasattr(socket, "IPPROTO_IPV6"):
+            # Bind IPv4 and IPv6 separately like tornado does.
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        sock.setblocking(0)
+        sock.bind(sockaddr)
+        sock.listen(backlog)
+        sockets.append(sock)
+    return sockets
+
+
+def serve(create_application, port, processes=1, reuse_port=False, unix_socket=None):
+    """
+    Runs the application in the given number of processes (0 means one per
+    CPU). Without reuse_port the listening sockets are bound once and shared
+    by all forked workers, with reuse_port every worker binds its own. An
+    optional unix socket for a local proxy is always shared. The application
+    is created after forking, so every worker has its own connections.
+    """
+    sockets = []
+    if not reuse_port:
+        sockets.extend(tornado.netutil.bind_sockets(port))
+    if unix_socket:
+        sockets.append(tornado.netutil.bind_unix_socket(unix_socket))
+    if processes != 1:
+        tornado.process.fork_processes(processes)
+        logging.info("Started worker %d", tornado.process.task_id())
+    if reuse_port:
+        sockets.extend(bind_reuse_port(port))
+    application = create_application()
+    server = tornado.httpserver.HTTPServer(application)
+    server.add_sockets(sockets)
+    tornado.ioloop.IOLoop.instance().start()
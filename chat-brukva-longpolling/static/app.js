@@ -28,6 +28,10 @@ $(document).ready(function() {
     });
     $("#message-input").focus();
     $('html, body').animate({scrollTop: $(document).height()}, 800);
+    // Start polling from the latest message rendered with the page, so
+    // messages posted in between are not missed.
+    var latest = $("#messsages .message:last").attr("id");
+    if (latest) updater.cursor = latest.substring(1);
     updater.poll();
 });
 
@@ -51,6 +55,13 @@ function postMessage(form) {
         timeout: 60000,
         cache: false
     }).done(function ( data ) {
+        if (data.retry_after) {
+            // Posting too fast, so wait before the next message is allowed.
+            console.log("Slow down, retrying is allowed in " + data.retry_after + " s");
+            window.setTimeout(function() { disabled.removeAttr("disabled"); }, data.retry_after * 1000);
+            $("#message-input").select();
+            return;
+        }
         if (!data._id) {
             console.log("Error creating message");
             $("#message-input").select();
@@ -97,6 +108,7 @@ var updater = {
             }
             console.log("Received new messages successfuly");
             updater.newMessages(data);
+            if (data.presence) updater.showPresence(data.presence);
             updater.errorSleepTime = 500;
             window.setTimeout(updater.poll, 0);
         }).fail(function(jqXHR, textStatus) {
@@ -131,9 +143,18 @@ var updater = {
         console.log("Show Message");
         var existing = $("#m" + message._id);
         if (existing.length > 0) return;
-        $("#messsages").append('<div style="display: none;" class="message" id="' + message._id + '"><b>' + message.from + ': </b>' + message.body + '</div>');
+        $("#messsages").append('<div style="display: none;" class="message" id="m' + message._id + '"><b>' + message.from + ': </b>' + message.body + '</div>');
         $('#messsages').find(".message:last").slideDown("fast", function(){
             $('html, body').animate({scrollTop: $(document).height()}, 400);
         });
+    },
+
+    /**
+     * Function to show who is in the chat room. Rooms with too many members
+     * are only shown by count.
+     */
+    showPresence: function(presence) {
+        $("#presence .count").text(presence.count + " online");
+        $("#presence .members").text((presence.members || []).join(", "));
     }
 };
@@ -0,0 +1,605 @@
+# coding=UTF-8
+
+# General modules.
+import functools
+import logging
+from threading import Timer
+
+# Tornado modules.
+import tornado.escape
+import tornado.ioloop
+
+# MongoDb modules.
+from bson.objectid import ObjectId
+
+# Redis modules.
+import brukva
+
+# Import application modules.
+import metrics
+import tracing
+from writer import MessageWriter
+from writer import StreamWriter
+
+
+
+def newer_than(messages, cursor):
+    """
+    Returns the messages newer than the message with the id cursor. If the
+    cursor is not found, all messages are returned.
+    """
+    for i in xrange(len(messages) - 1, -1, -1):
+        if messages[i]["_id"] == cursor:
+            return messages[i + 1:]
+    return messages
+
+
+def decode_entries(entries):
+    """
+    JSON-decodes the messages of a list of stream entries using the entry id
+    as message id.
+    """
+    messages = []
+    for entry_id, fields in entries or []:
+        message = tornado.escape.json_decode(dict(zip(fields[::2], fields[1::2]))['m'])
+        message["_id"] = entry_id
+        messages.append(message)
+    return messages
+
+
+
+class ListStore(object):
+    """
+    Stores each chat room as a Redis list and delivers new messages through
+    the Pub/Sub channel of the same name. All callbacks receive an exception
+    instead of the result if a command failed.
+    """
+    def __init__(self, client, retention=1000, catchup=50):
+        self.client = client
+        self.catchup = catchup
+        self.writer = MessageWriter(client, retention)
+
+
+    def append(self, room, message, callback):
+        """
+        Stores and publishes the message and sets its '_id'. The callback
+        receives None on success or the exception.
+        """
+        # Generate object id as message id.
+        message["_id"] = str(ObjectId())
+        self.writer.write(room, tornado.escape.json_encode(message),
+                          lambda error, replies: callback(error))
+
+
+    def recent(self, room, count, callback):
+        """
+        Loads the list of the latest count messages of the chat room.
+        """
+        def on_result(result):
+            if isinstance(result, Exception):
+                callback(result)
+                return
+            # JSON-decode messages.
+            callback([tornado.escape.json_decode(message) for message in result])
+        self.client.lrange(room, -count, -1, metrics.timed('lrange', on_result))
+
+
+    def since(self, room, cursor, callback):
+        """
+        Loads the list of messages newer than the message with the id cursor.
+        Only the latest messages are checked, if the cursor is older all of
+        them are loaded.
+        """
+        def on_result(result):
+            if isinstance(result, Exception):
+                callback(result)
+                return
+            callback(newer_than(result, cursor))
+        self.recent(room, self.catchup, on_result)
+
+
+    def before(self, room, cursor, position, count, callback):
+        """
+        Loads a page of count messages older than the message with the id
+        cursor. Position is the position of the cursor from the end of the
+        chat room as returned by the previous page. The callback receives a
+        tuple of the messages and the position of the first message.
+        """
+        ListHistory(self.client, room, cursor, position, count, callback)
+
+
+    def wait(self, room, cursor, callback):
+        """
+        Calls callback once with the list of messages newer than the message
+        with the id cursor as soon as there are any. Returns the waiter which
+        must be cancelled if the messages are not needed anymore.
+        """
+        return ListWaiter(self, room, cursor, callback)
+
+
+
+class ListHistory(object):
+    """
+    Pages backwards through a chat room list from the message with the id
+    cursor. Positions count messages from the end of the list, the newest
+    message has position 1. The cursor can only have moved further back
+    since the client got its position, so the search starts there.
+    """
+    def __init__(self, client, room, cursor, position, count, callback):
+        self.client = client
+        self.room = room
+        self.cursor = cursor
+        self.count = count
+        self.callback = callback
+        if not cursor:
+            self.load_page(0)
+        else:
+            self.scan(max(position, 1))
+
+
+    def scan(self, position):
+        """
+        Loads a window of two pages ending at position to look for the cursor.
+        """
+        self.position = position
+        self.window = 2 * self.count
+        self.client.lrange(self.room, -(position + self.window - 1), -position,
+                           metrics.timed('lrange', self.on_window))
+
+
+    def on_window(self, result):
+        """
+        Callback for loading a window of messages in self.scan().
+        """
+        if isinstance(result, Exception):
+            self.callback(result)
+            return
+        # JSON-decode messages.
+        messages = [tornado.escape.json_decode(message) for message in result]
+        # Find the cursor, starting with the newest message of the window.
+        for i in xrange(len(messages) - 1, -1, -1):
+            if messages[i]["_id"] == self.cursor:
+                position = self.position + len(messages) - 1 - i
+                if i >= self.count:
+                    # The whole page is part of the window.
+                    page = messages[i - self.count:i]
+                    self.callback((page, position + len(page)))
+                else:
+                    self.load_page(position)
+                return
+        if len(messages) < self.window:
+            # Reached the oldest message, the cursor has been trimmed away.
+            self.callback(([], self.position))
+            return
+        self.scan(self.position + self.window)
+
+
+    def load_page(self, position):
+        """
+        Loads the page of messages older than position.
+        """
+        self.position = position
+        self.client.lrange(self.room, -(position + self.count), -(position + 1),
+                           metrics.timed('lrange', self.on_page))
+
+
+    def on_page(self, result):
+        """
+        Callback for loading a page in self.load_page().
+        """
+        if isinstance(result, Exception):
+            self.callback(result)
+            return
+        # JSON-decode messages.
+        page = [tornado.escape.json_decode(message) for message in result]
+        self.callback((page, self.position + len(page)))
+
+
+
+class ListWaiter(object):
+    """
+    Waits for new messages of a chat room on a dedicated Pub/Sub connection.
+    As soon as the subscription is confirmed, the latest messages are checked
+    for messages missed between pollings, so no message can get lost in
+    between.
+    """
+    def __init__(self, store, room, cursor, callback):
+        self.store = store
+        self.room = room
+        self.cursor = cursor
+        self.callback = callback
+        self.done = False
+        # Messages published while catching up are held back here.
+        self.catching_up = bool(cursor)
+        self.pending = []
+        # Subscribe to the chat room's channel.
+        self.client = brukva.Client()
+        self.client.connect()
+        self.client.subscribe(room)
+        self.subscribed = True
+        self.client.listen(self.on_new_messages)
+
+
+    def on_new_messages(self, message):
+        """
+        Callback for listening to the subscription.
+        """
+        if message.kind == "subscribe":
+            if self.catching_up:
+                self.store.since(self.room, self.cursor, self.on_missed_messages)
+            return
+        # Abort if message type is something like unsubscribe.
+        if not message.kind == "message":
+            return
+        message = tornado.escape.json_decode(message.body)
+        tracing.stage(message, 'receive')
+        # Wait for the missed messages to send everything at once.
+        if self.catching_up:
+            self.pending.append(message)
+            return
+        self.finish([message])
+
+
+    def on_missed_messages(self, result):
+        """
+        Callback for loading the messages missed between pollings.
+        """
+        self.catching_up = False
+        if isinstance(result, Exception):
+            logging.error("Error loading missed messages: " + str(result))
+            result = []
+        # Add messages published meanwhile if not loaded already.
+        ids = set(message["_id"] for message in result)
+        result.extend(message for message in self.pending if message["_id"] not in ids)
+        self.pending = []
+        if result:
+            self.finish(result)
+
+
+    def finish(self, messages):
+        """
+        Stops waiting and passes the messages to the callback.
+        """
+        if self.done:
+            return
+        self.cancel()
+        self.callback(messages)
+
+
+    def cancel(self):
+        """
+        Stops waiting and frees up the Pub/Sub connection.
+        """
+        if self.done:
+            return
+        self.done = True
+        if self.subscribed:
+            self.client.unsubscribe(self.room)
+            self.subscribed = False
+        # Disconnect connection after delay due to this issue:
+        # https://github.com/evilkost/brukva/issues/25
+        t = Timer(0.1, self.client.disconnect)
+        t.start()
+
+
+
+class StreamStore(object):
+    """
+    Stores each chat room as a Redis Stream, which persists and delivers
+    messages in one structure. Stream entry ids are used as message ids and
+    thereby as cursors, so clients resume exactly where they left off. All
+    callbacks receive an exception instead of the result if a command failed.
+    """
+    def __init__(self, client, retention=1000, catchup=50, block=1000):
+        self.client = client
+        self.catchup = catchup
+        self.block = block
+        self.writer = StreamWriter(client, retention)
+
+
+    def append(self, room, message, callback):
+        """
+        Stores the message and sets its '_id' to the id of the stream entry.
+        The callback receives None on success or the exception.
+        """
+        def on_written(error, replies):
+            if not error:
+                message["_id"] = replies[0]
+            callback(error)
+        self.writer.write(room, tornado.escape.json_encode(message), on_written)
+
+
+    def recent(self, room, count, callback):
+        """
+        Loads the list of the latest count messages of the chat room.
+        """
+        def on_result(result):
+            if isinstance(result, Exception):
+                callback(result)
+                return
+            entries = list(result or [])
+            entries.reverse()
+            callback(decode_entries(entries))
+        self.client.execute_command('XREVRANGE', metrics.timed('xrevrange', on_result), room, '+', '-',
+                                    'COUNT', count)
+
+
+    def since(self, room, cursor, callback):
+        """
+        Loads the list of messages newer than the message with the id cursor.
+        """
+        def on_result(result):
+            if isinstance(result, Exception):
+                callback(result)
+                return
+            callback(decode_entries(result[0][1] if result else []))
+        self.client.execute_command('XREAD', metrics.timed('xread', on_result), 'COUNT', self.catchup,
+                                    'STREAMS', room, cursor)
+
+
+    def before(self, room, cursor, position, count, callback):
+        """
+        Loads a page of count messages older than the message with the id
+        cursor. The callback receives a tuple of the messages and the position
+        of the first message from the end of the chat room, which is only
+        informational for streams.
+        """
+        if not cursor:
+            self.recent(room, count, lambda result: callback(
+                result if isinstance(result, Exception) else (result, len(result))))
+            return
+        def on_result(result):
+            if isinstance(result, Exception):
+                callback(result)
+                return
+            # The range includes the cursor itself.
+            entries = [entry for entry in result or [] if entry[0] != cursor][:count]
+            entries.reverse()
+            page = decode_entries(entries)
+            callback((page, max(position, 1) + len(page)))
+        self.client.execute_command('XREVRANGE', metrics.timed('xrevrange', on_result), room, cursor, '-',
+                                    'COUNT', count + 1)
+
+
+    def wait(self, room, cursor, callback):
+        """
+        Calls callback once with the list of messages newer than the message
+        with the id cursor as soon as there are any. Returns the waiter which
+        must be cancelled if the messages are not needed anymore.
+        """
+        return StreamWaiter(self, room, cursor, callback)
+
+
+
+class StreamWaiter(object):
+    """
+    Waits for new messages of a chat room with blocking XREAD commands on a
+    dedicated connection. Without cursor the id of the latest message is
+    looked up first, so no message between two reads can get lost.
+    """
+    def __init__(self, store, room, cursor, callback):
+        self.store = store
+        self.room = room
+        self.callback = callback
+        self.done = False
+        self.client = brukva.Client()
+        self.client.connect()
+        if cursor:
+            self.read(cursor)
+        else:
+            store.client.execute_command('XREVRANGE', metrics.timed('xrevrange', self.on_latest), room,
+                                         '+', '-', 'COUNT', 1)
+
+
+    def on_latest(self, result):
+        """
+        Callback for looking up the latest message of the chat room.
+        """
+        if isinstance(result, Exception):
+            logging.error("Error loading latest message: " + str(result))
+            result = []
+        self.read(result[0][0] if result else '0-0')
+
+
+    def read(self, cursor):
+        """
+        Blocks until there are messages newer than cursor or the read times out.
+        """
+        if self.done:
+            return
+        self.cursor = cursor
+        self.client.execute_command('XREAD', self.on_read, 'COUNT', self.store.catchup,
+                                    'BLOCK', self.store.block, 'STREAMS', self.room, cursor)
+
+
+    def on_read(self, result):
+        """
+        Callback for the blocking read in self.read().
+        """
+        if self.done:
+            return
+        if isinstance(result, Exception):
+            logging.error("Error reading new messages: " + str(result))
+            self.finish([])
+            return
+        if not result:
+            # Timed out without new messages, so read again.
+            self.read(self.cursor)
+            return
+        messages = decode_entries(result[0][1])
+        tracing.stages(messages, 'receive')
+        self.finish(messages)
+
+
+    def finish(self, messages):
+        """
+        Stops waiting and passes the messages to the callback.
+        """
+        if self.done:
+            return
+        self.cancel()
+        self.callback(messages)
+
+
+    def cancel(self):
+        """
+        Stops waiting and frees up the connection.
+        """
+        if self.done:
+            return
+        self.done = True
+        # Disconnect connection after delay due to this issue:
+        # https://github.com/evilkost/brukva/issues/25
+        t = Timer(0.1, self.client.disconnect)
+        t.start()
+
+
+
+
+class MemoryStore(object):
+    """
+    Keeps each chat room in the memory of this process and hands new messages
+    to the waiters of the room directly, without any datastore round trip.
+    Messages are neither shared with other processes nor kept across
+    restarts, so this backend fits single process deployments only. Like the
+    other stores, callbacks are called asynchronously on the IOLoop.
+    """
+    def __init__(self, retention=1000, catchup=50):
+        self.retention = retention
+        self.catchup = catchup
+        # Lists of messages by chat room, oldest first.
+        self.rooms = {}
+        # Sets of the waiting MemoryWaiters by chat room.
+        self.waiters = {}
+
+
+    def messages(self, room):
+        """
+        Returns the list of all messages of the chat room.
+        """
+        return self.rooms.get(room, [])
+
+
+    def append(self, room, message, callback):
+        """
+        Stores the message, sets its '_id' and wakes the waiters of the chat
+        room. The callback receives None.
+        """
+        # Generate object id as message id.
+        message["_id"] = str(ObjectId())
+        messages = self.rooms.setdefault(room, [])
+        messages.append(message)
+        if len(messages) > self.retention:
+            del messages[:len(messages) - self.retention]
+        waiters = self.waiters.pop(room, None)
+        io_loop = tornado.ioloop.IOLoop.instance()
+        if waiters:
+            io_loop.add_callback(functools.partial(self.publish, waiters, message))
+        io_loop.add_callback(functools.partial(callback, None))
+
+
+    def publish(self, waiters, message):
+        """
+        Passes the new message to the waiters detached from their chat room.
+        """
+        tracing.stage(message, 'receive')
+        for waiter in waiters:
+            try:
+                waiter.finish([message])
+            except:
+                logging.error("Error in waiter callback", exc_info=True)
+
+
+    def recent(self, room, count, callback):
+        """
+        Loads the list of the latest count messages of the chat room.
+        """
+        recent = self.messages(room)[-count:] if count else []
+        tornado.ioloop.IOLoop.instance().add_callback(functools.partial(callback, recent))
+
+
+    def since(self, room, cursor, callback):
+        """
+        Loads the list of messages newer than the message with the id cursor.
+        Only the latest messages are checked, if the cursor is older all of
+        them are loaded.
+        """
+        recent = newer_than(self.messages(room)[-self.catchup:], cursor)
+        tornado.ioloop.IOLoop.instance().add_callback(functools.partial(callback, recent))
+
+
+    def before(self, room, cursor, position, count, callback):
+        """
+        Loads a page of count messages older than the message with the id
+        cursor. The callback receives a tuple of the messages and the position
+        of the first message from the end of the chat room.
+        """
+        messages = self.messages(room)
+        end = len(messages)
+        if cursor:
+            # Search backwards from the position the client got last.
+            end = None
+            for i in xrange(max(len(messages) - max(position, 1), 0), -1, -1):
+                if messages[i]["_id"] == cursor:
+                    end = i
+                    break
+        if end is None:
+            # The cursor has been trimmed away.
+            result = ([], position)
+        else:
+            page = messages[max(end - count, 0):end]
+            result = (page, len(messages) - end + len(page))
+        tornado.ioloop.IOLoop.instance().add_callback(functools.partial(callback, result))
+
+
+    def wait(self, room, cursor, callback):
+        """
+        Calls callback once with the list of messages newer than the message
+        with the id cursor as soon as there are any. Returns the waiter which
+        must be cancelled if the messages are not needed anymore.
+        """
+        return MemoryWaiter(self, room, cursor, callback)
+
+
+
+class MemoryWaiter(object):
+    """
+    Waits for new messages of a chat room of a MemoryStore. Messages missed
+    between pollings are delivered right away.
+    """
+    def __init__(self, store, room, cursor, callback):
+        self.store = store
+        self.room = room
+        self.callback = callback
+        self.done = False
+        missed = []
+        if cursor:
+            missed = newer_than(store.messages(room)[-store.catchup:], cursor)
+        if missed:
+            tornado.ioloop.IOLoop.instance().add_callback(functools.partial(self.finish, missed))
+        else:
+            store.waiters.setdefault(room, set()).add(self)
+
+
+    def finish(self, messages):
+        """
+        Stops waiting and passes the messages to the callback.
+        """
+        if self.done:
+            return
+        self.cancel()
+        self.callback(messages)
+
+
+    def cancel(self):
+        """
+        Stops waiting for new messages.
+        """
+        if self.done:
+            return
+        self.done = True
+        waiters = self.store.waiters.get(self.room)
+        if waiters is not None:
+            waiters.discard(self)
+            if not waiters:
+                del self.store.waiters[self.room]
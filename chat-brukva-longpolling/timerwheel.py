@@ -0,0 +1,72 @@
+# coding=UTF-8
+
+# General modules.
+import logging
+import math
+import random
+
+# Tornado modules.
+import tornado.ioloop
+
+
+
+class TimerWheel(object):
+    """
+    Expires parked long polling requests with a single periodic IOLoop
+    callback instead of one timeout per request. The wheel has one slot per
+    tick, a request is put into the slot of its deadline, so adding and
+    removing requests is O(1) and every tick only touches the requests
+    expiring right now. Deadlines are jittered to spread the reconnects of
+    clients which started polling at the same time.
+    """
+    def __init__(self, timeout=45, jitter=10, resolution=1):
+        self.timeout = timeout
+        self.jitter = jitter
+        self.resolution = resolution
+        # A deadline is at most this many ticks ahead of the current slot.
+        self.slots = [{} for i in xrange(int(math.ceil(float(timeout + jitter) / resolution)) + 1)]
+        self.position = 0
+        # Maps keys to the slot of their deadline.
+        self.index = {}
+        self.timer = tornado.ioloop.PeriodicCallback(self.tick, resolution * 1000)
+        self.timer.start()
+
+
+    def add(self, key, callback):
+        """
+        Calls callback once the deadline of the request key has passed unless
+        the key is removed before.
+        """
+        self.remove(key)
+        delay = self.timeout + random.uniform(0, self.jitter)
+        ticks = max(int(math.ceil(delay / self.resolution)), 1)
+        slot = (self.position + ticks) % len(self.slots)
+        self.slots[slot][key] = callback
+        self.index[key] = slot
+
+
+    def remove(self, key):
+        """
+        Removes the deadline of the request key if it is set.
+        """
+        slot = self.index.pop(key, None)
+        if slot is not None:
+            del self.slots[slot][key]
+
+
+    def __len__(self):
+        return len(self.index)
+
+
+    def tick(self):
+        """
+        Advances the wheel by one slot and expires its requests.
+        """
+        self.position = (self.position + 1) % len(self.slots)
+        expired, self.slots[self.position] = self.slots[self.position], {}
+        for key, callback in expired.iteritems():
+            del self.index[key]
+            try:
+                callback()
+            except:
+                logging.error("Error in deadline callback", exc_info=True)
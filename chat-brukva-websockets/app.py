@@ -1,10 +1,9 @@
 # coding=UTF-8
 
 # General modules.
+import functools
 import os.path
 import logging
-import sys
-from threading import Timer
 
 # Tornado modules.
 import tornado.ioloop
@@ -12,6 +11,7 @@ import tornado.web
 import tornado.websocket
 import tornado.auth
 import tornado.options
+import tornado.template
 import tornado.escape
 from tornado import gen
 
@@ -23,11 +23,97 @@ import brukva
 
 # Import application modules.
 from base import BaseHandler
+from base import load_user
 from auth import LoginHandler
 from auth import LogoutHandler
+from assets import AssetHandler
+from assets import Assets
+from cache import LRUCache
+from fragments import FragmentCache
+from history import HistoryHandler
+import metrics
+from metrics import MetricsHandler
+from outbound import OutboundQueue
+from outbound import OutboundStats
+from presence import Presence
+from ratelimit import RateLimiter
+from ratelimit import RedisRateLimiter
+from ratelimit import slow_down
+from wire import CODECS
+from wire import JSON
+from store import ListStore
+from store import MemoryStore
+from store import StreamStore
+from server import serve
+from startup import ReadyHandler
+from startup import Startup
+from startup import precompile
+import tracing
 
 # Define port from command line parameter.
 tornado.options.define("port", default=8888, help="run on the given port", type=int)
+# Define how many processes serve the application and how they listen.
+tornado.options.define("processes", default=1,
+                       help="number of worker processes, 0 for one per CPU", type=int)
+tornado.options.define("reuse_port", default=False,
+                       help="bind a socket per worker with SO_REUSEPORT instead of sharing one", type=bool)
+tornado.options.define("unix_socket", default=None,
+                       help="path of an additional unix socket to listen on, e.g. for a local proxy")
+# Define how chat rooms are stored and delivered.
+tornado.options.define("backend", default="list",
+                       help="room backend: list (Redis lists and Pub/Sub), stream (Redis Streams) "
+                            "or memory (this process only)")
+tornado.options.define("stream_block", default=1000,
+                       help="milliseconds a blocking stream read waits for new messages", type=int)
+# Define how many of the latest messages are checked for missed messages.
+tornado.options.define("catchup_size", default=50,
+                       help="number of latest messages checked for messages missed while disconnected", type=int)
+# Define how frames are queued for slow clients.
+tornado.options.define("outbound_policy", default="coalesce",
+                       help="what to do if a client can not keep up: coalesce, drop or disconnect")
+tornado.options.define("outbound_max_frames", default=100,
+                       help="maximum number of frames queued per socket", type=int)
+tornado.options.define("outbound_max_bytes", default=1048576,
+                       help="maximum number of bytes queued per socket", type=int)
+# Define how many messages are kept per chat room and paged at once.
+tornado.options.define("room_retention", default=1000,
+                       help="maximum number of messages kept per chat room", type=int)
+tornado.options.define("history_page_size", default=50,
+                       help="number of messages per page of the history", type=int)
+# Define the number of latest messages shown when loading a chat room.
+tornado.options.define("history_size", default=50,
+                       help="number of latest messages shown when loading a chat room", type=int)
+# Define the chat rooms whose latest messages are rendered at startup.
+tornado.options.define("warm_rooms", default=["1", "2", "3", "4"], multiple=True,
+                       help="comma separated chat rooms whose latest messages are rendered at startup")
+# Define size and lifetime of the in-process user cache.
+tornado.options.define("user_cache_size", default=10000,
+                       help="maximum number of cached user objects", type=int)
+tornado.options.define("user_cache_ttl", default=60,
+                       help="seconds a cached user object is valid", type=int)
+# Define how the members of chat rooms are tracked.
+tornado.options.define("presence_interval", default=5,
+                       help="seconds between flushing presence changes and sending diffs", type=int)
+tornado.options.define("presence_ttl", default=30,
+                       help="seconds after which a member not seen anymore leaves a chat room", type=int)
+tornado.options.define("presence_listed", default=100,
+                       help="maximum number of members listed per chat room, larger rooms only show a count",
+                       type=int)
+# Define how fast users can post and how many messages a chat room takes.
+tornado.options.define("user_rate", default=1.0,
+                       help="messages per second a user can post on average, 0 for unlimited", type=float)
+tornado.options.define("user_burst", default=5,
+                       help="messages a user can post at once", type=int)
+tornado.options.define("room_rate", default=20.0,
+                       help="messages per second a chat room takes on average, 0 for unlimited", type=float)
+tornado.options.define("room_burst", default=50,
+                       help="messages a chat room takes at once", type=int)
+tornado.options.define("shared_rate_limits", default=False,
+                       help="keep the rate limits in Redis to enforce them across processes and nodes",
+                       type=bool)
+# Define the fraction of messages whose latency per stage is logged.
+tornado.options.define("trace_sample", default=0.0,
+                       help="fraction of messages traced in the log from ingest to delivery", type=float)
 
 
 
@@ -52,35 +138,56 @@ class MainHandler(BaseHandler):
             # Redirect to login if not authenticated.
             self.redirect("/login")
             return
-        # Load 50 latest messages from this chat room.
-        self.application.client.lrange(self.room, -50, -1, self.on_conversation_found)
+        # Load latest messages from this chat room.
+        self.application.store.recent(self.room, tornado.options.options.history_size,
+                                      self.on_conversation_found)
 
 
     def on_conversation_found(self, result):
         if isinstance(result, Exception):
             raise tornado.web.HTTPError(500)
-        # JSON-decode messages.
-        messages = []
-        for message in result:
-            messages.append(tornado.escape.json_decode(message))
-        # Render template and deliver website.
-        content = self.render_string("messages.html", messages=messages)
+        messages = result
+        # Render template and deliver website. Only messages not rendered
+        # before need to be rendered.
+        history = self.application.fragments.render(self.room, messages)
+        content = self.render_string("messages.html", history=history,
+                                     presence=self.application.presence.snapshot(self.room))
         self.render_default("index.html", content=content, chat=1)
 
 
 
 class ChatSocketHandler(tornado.websocket.WebSocketHandler):
     """
-    Handler for dealing with websockets. It receives, stores and distributes new messages.
-
-    TODO: Not proper authentication handling!
+    Handler for dealing with websockets. It receives, stores and distributes new messages. The user is
+    authenticated once from the cookie of the handshake request and pinned to the socket.
     """
+    # Wire format of this socket, clients can choose MessagePack as subprotocol.
+    codec = JSON
+    # User object of this socket, set as soon as it is loaded.
+    user = None
+
+    def select_subprotocol(self, subprotocols):
+        """
+        Chooses the preferred wire format among the subprotocols offered by
+        the client in the Sec-WebSocket-Protocol header.
+        """
+        for codec in CODECS:
+            if codec.name in subprotocols:
+                self.codec = codec
+                return codec.name
+        return None
 
     @gen.engine
     def open(self, room='root'):
         """
-        Called when socket is opened. It will subscribe for the given chat room based on Redis Pub/Sub.
+        Called when socket is opened. It will subscribe for the given chat room. A reconnecting client
+        passes the id of the latest message it received as cursor to get the messages it missed.
         """
+        # All frames to this socket go through a bounded queue.
+        options = tornado.options.options
+        self.outbound = OutboundQueue(self, self.application.outbound_stats,
+                                      options.outbound_policy, options.outbound_max_frames,
+                                      options.outbound_max_bytes, self.codec)
         # Check if room is set.
         if not room:
             self.write_message({'error': 1, 'textStatus': 'Error: No room specified'})
@@ -88,25 +195,92 @@ class ChatSocketHandler(tornado.websocket.WebSocketHandler):
             return
         self.room = str(room)
         self.new_message_send = False
-        # Connect to redis.
-        self.client = brukva.Client()
-        self.client.connect()
-        # Subscribe to the given chat room.
-        self.client.subscribe(self.room)
+        # The datastore may not be connected before the startup phases are done, the client reconnects.
+        if not self.application.startup.ready:
+            self.write_message({'error': 1, 'textStatus': 'starting'})
+            self.close()
+            return
+        # Authenticate from the cookie of the handshake request. Messages received before the user is
+        # loaded wait for it.
+        self.pending = []
+        self.user_id = self.get_secure_cookie('user')
+        if not self.user_id:
+            self.reject()
+            return
+        load_user(self.application, self.user_id, self.on_user)
+
+
+    def on_user(self, user):
+        """
+        Callback for loading the user of this socket in self.open(). Joins the chat room.
+        """
+        # Abort if the socket was closed meanwhile.
+        if self.ws_connection is None:
+            return
+        if not user:
+            self.reject()
+            return
+        self.user = user
+        # Join the given chat room on the shared subscriber of this process.
+        self.application.store.subscribe(self.room, self)
         self.subscribed = True
-        self.client.listen(self.on_messages_published)
-        logging.info('New user connected to chat room ' + room)
+        logging.info('New user connected to chat room ' + self.room)
+        # Show who is in the chat room, including this user.
+        presence = self.application.presence
+        presence.watch(self.room)
+        snapshot = presence.snapshot(self.room)
+        if snapshot:
+            self.write_message({'presence': snapshot})
+        self.member = user['name']
+        presence.join(self.room, self.member)
+        # Resume from the client's cursor.
+        cursor = self.get_argument("cursor", None)
+        if cursor:
+            self.application.store.since(self.room, cursor, self.on_missed_messages)
+        # Handle the messages received meanwhile.
+        pending, self.pending = self.pending, []
+        for data in pending:
+            self.on_message(data)
+
+
+    def reject(self):
+        """
+        Closes the socket of a client which is not logged in.
+        """
+        logging.warning("Error: Authentication missing")
+        self.write_message({'error': 1, 'textStatus': 'unauthorized'})
+        self.close()
 
 
-    def on_messages_published(self, message):
+    def on_missed_messages(self, result):
         """
-        Callback for listening to subscribed chat room based on Redis Pub/Sub. When a new message is stored
-        in the given Redis chanel this method will be called.
+        Callback for loading the messages missed by a reconnecting client in self.open().
         """
-        # Decode message
-        m = tornado.escape.json_decode(message.body)
-        # Send messages to other clients and finish connection.
-        self.write_message(dict(messages=[m]))
+        # Abort if the socket was closed meanwhile.
+        if self.ws_connection is None:
+            return
+        if isinstance(result, Exception):
+            logging.error("Error loading missed messages: " + str(result))
+            return
+        if result:
+            self.write_message(dict(messages=result))
+
+
+    def on_messages_published(self, batch):
+        """
+        Called by the shared subscriber of the store when new messages are published in this socket's
+        chat room. The MessageBatch is shared by all sockets of the room and encoded once per wire format.
+        """
+        # Queue the pre-serialized messages for the client.
+        self.outbound.push_batch(batch)
+
+
+    def write_message(self, message, binary=False):
+        """
+        Sends the message through the outbound queue of this socket. Dicts are encoded in the wire
+        format of this socket.
+        """
+        self.outbound.push(message, binary)
 
 
     def on_message(self, data):
@@ -114,39 +288,62 @@ class ChatSocketHandler(tornado.websocket.WebSocketHandler):
         Callback when new message received vie the socket.
         """
         logging.info('Received new message %r', data)
+        if self.user is None:
+            # Wait for the user to be loaded.
+            self.pending.append(data)
+            return
         try:
             # Parse input to message dict.
-            datadecoded = tornado.escape.json_decode(data)
+            datadecoded = self.codec.decode(data)
             message = {
                 '_id': str(ObjectId()),
-                'from': self.get_secure_cookie('user', str(datadecoded['user'])),
+                'from': self.user['name'],
                 'body': tornado.escape.linkify(datadecoded["body"]),
             }
-            if not message['from']:
-                logging.warning("Error: Authentication missing")
-                message['from'] = 'Guest'
+            tracing.stamp(message)
         except Exception, err:
             # Send an error back to client.
             self.write_message({'error': 1, 'textStatus': 'Bad input data ... ' + str(err) + data})
             return
 
-        # Save message and publish in Redis.
-        try:
-            # Convert to JSON-literal.
-            message_encoded = tornado.escape.json_encode(message)
-            # Persistently store message in Redis.
-            self.application.client.rpush(self.room, message_encoded)
-            # Publish message in Redis channel.
-            self.application.client.publish(self.room, message_encoded)
-        except Exception, err:
-            e = str(sys.exc_info()[0])
+        # Reject the message if the user or the chat room is too fast.
+        self.application.ratelimit.check(self.user_id, self.room,
+                                         lambda retry_after: self.on_rate_checked(message, retry_after))
+
+
+    def on_rate_checked(self, message, retry_after):
+        """
+        Callback for checking the rate limits of a message received in self.on_message().
+        """
+        # Abort if the socket was closed meanwhile.
+        if self.ws_connection is None:
+            return
+        if retry_after:
+            self.write_message(slow_down(retry_after))
+            return
+        metrics.INGESTED.inc((self.room,))
+        self.application.store.append(self.room, message,
+                                      lambda error: self.on_message_written(message, error))
+
+
+    def on_message_written(self, message, error):
+        """
+        Callback for storing and publishing a message received in self.on_message().
+        """
+        # Abort if the socket was closed meanwhile.
+        if self.ws_connection is None:
+            return
+        if error:
             # Send an error back to client.
-            self.write_message({'error': 1, 'textStatus': 'Error writing to database: ' + str(err)})
+            self.write_message({'error': 1, 'textStatus': 'Error writing to database: ' + str(error)})
             return
+        tracing.stage(message, 'persist')
+
+        # Render message for the next page loads.
+        self.application.fragments.append(self.room, message)
 
         # Send message through the socket to indicate a successful operation.
         self.write_message(message)
-        return
 
 
     def on_close(self):
@@ -154,15 +351,17 @@ class ChatSocketHandler(tornado.websocket.WebSocketHandler):
         Callback when the socket is closed. Frees up resource related to this socket.
         """
         logging.info("socket closed, cleaning up resources now")
-        if hasattr(self, 'client'):
-            # Unsubscribe if not done yet.
-            if self.subscribed:
-                self.client.unsubscribe(self.room)
-                self.subscribed = False
-            # Disconnect connection after delay due to this issue:
-            # https://github.com/evilkost/brukva/issues/25
-            t = Timer(0.1, self.client.disconnect)
-            t.start()
+        # Drop frames which can not be sent anymore.
+        if hasattr(self, 'outbound'):
+            self.outbound.discard()
+        # Leave the chat room if not done yet.
+        if getattr(self, 'subscribed', False):
+            self.application.store.unsubscribe(self.room, self)
+            self.application.presence.unwatch(self.room)
+            self.subscribed = False
+        if getattr(self, 'member', None):
+            self.application.presence.leave(self.room, self.member)
+            self.member = None
 
 
 
@@ -172,6 +371,15 @@ class Application(tornado.web.Application):
     """
     def __init__(self):
 
+        # Build the fingerprinted and precompressed static assets, served at /assets/.
+        static_path = os.path.join(os.path.dirname(__file__), "static")
+        self.assets = Assets(static_path, os.path.join(os.path.dirname(__file__), "build"))
+        self.assets.build()
+
+        # Templates are compiled into this loader at startup.
+        template_path = os.path.join(os.path.dirname(__file__), "templates")
+        self.template_loader = tornado.template.Loader(template_path, autoescape="xhtml_escape")
+
         # Handlers defining the url routing.
         handlers = [
             (r"/", MainHandler),
@@ -180,14 +388,20 @@ class Application(tornado.web.Application):
             (r"/logout", LogoutHandler),
             (r"/socket", ChatSocketHandler),
             (r"/socket/([a-zA-Z0-9]*)$", ChatSocketHandler),
+            (r"/history/([a-zA-Z0-9]*)$", HistoryHandler),
+            (r"/ready", ReadyHandler),
+            (r"/metrics", MetricsHandler),
+            (r"/assets/(.*)", AssetHandler, {"path": self.assets.build_path}),
         ]
 
         # Settings:
         settings = dict(
             cookie_secret = "43osdETzKXasdQAGaYdkL5gEmGeJJFuYh7EQnp2XdTP1o/Vo=",
             login_url = "/login",
-            template_path=os.path.join(os.path.dirname(__file__), "templates"),
-            static_path=os.path.join(os.path.dirname(__file__), "static"),
+            template_path=template_path,
+            template_loader=self.template_loader,
+            static_path=static_path,
+            ui_methods=self.assets.ui_methods(),
             xsrf_cookies= True,
             autoescape="xhtml_escape",
             # Set this to your desired database name.
@@ -199,9 +413,127 @@ class Application(tornado.web.Application):
         # Call super constructor.
         tornado.web.Application.__init__(self, handlers, **settings)
 
+        # Cache user objects to resolve the user cookie without a database
+        # round trip on every request.
+        self.user_cache = LRUCache(tornado.options.options.user_cache_size,
+                                   tornado.options.options.user_cache_ttl)
+
+        # Cache the rendered latest messages of each chat room.
+        self.fragments = FragmentCache(self.settings["template_path"],
+                                       tornado.options.options.history_size)
+
+        # Counters of the outbound queues of all sockets.
+        self.outbound_stats = OutboundStats()
+
         # We create a database connection using brukva, which is a non-blocking, asynchronous driver for redis.
         self.client = brukva.Client()
         self.client.connect()
+        # Chat rooms are stored and delivered either as lists and Pub/Sub channels or as streams.
+        # Messages are written in pipelined transactions on the connection above. The memory backend keeps
+        # chat rooms in this process and only uses Redis for the users.
+        options = tornado.options.options
+        if options.backend == "stream":
+            self.store = StreamStore(self.client, options.room_retention,
+                                     options.catchup_size, options.stream_block)
+        elif options.backend == "memory":
+            if options.processes != 1:
+                logging.warning("Chat rooms of the memory backend are not shared between processes")
+            self.store = MemoryStore(options.room_retention, options.catchup_size)
+        else:
+            self.store = ListStore(self.client, options.room_retention, options.catchup_size)
+
+        # Track who is in which chat room and send the changes to the sockets periodically.
+        self.presence = Presence(self.client, options.presence_interval, options.presence_ttl,
+                                 options.presence_listed)
+        self.presence.listeners.append(self.on_presence_changed)
+
+        # Limit the rate of messages per user and chat room, in this process or shared by all processes
+        # in Redis.
+        limits = (options.user_rate, options.user_burst, options.room_rate, options.room_burst)
+        if options.shared_rate_limits:
+            self.ratelimit = RedisRateLimiter(self.client, *limits)
+        else:
+            self.ratelimit = RateLimiter(*limits)
+
+        # Log the stages of a sample of the messages.
+        tracing.sample_rate = options.trace_sample
+
+        # Expose the state of this process at /metrics. These values are read when scraped.
+        self.metrics = metrics.registry
+        self.metrics.gauge('chat_open_websockets', 'Open websockets by chat room.', ['room'],
+                           lambda: dict([((room,), len(sockets)) for room, sockets
+                                         in self.store.subscriber.rooms.iteritems()]))
+        self.metrics.counter('chat_user_lookups_total',
+                             'User lookups by cache result, misses query the datastore.', ['result'],
+                             lambda: {('hit',): self.user_cache.hits, ('miss',): self.user_cache.misses})
+        self.metrics.gauge('chat_outbound_buffered_bytes', 'Bytes queued for or being sent to websockets.',
+                           callback=lambda: self.outbound_stats.buffered_bytes)
+        self.metrics.counter('chat_outbound_frames_coalesced_total', 'Frames merged into batches for slow clients.',
+                             callback=lambda: self.outbound_stats.frames_coalesced)
+        self.metrics.counter('chat_outbound_frames_dropped_total', 'Frames dropped for slow clients.',
+                             callback=lambda: self.outbound_stats.frames_dropped)
+        self.metrics.counter('chat_outbound_disconnects_total', 'Sockets closed because they could not keep up.',
+                             callback=lambda: self.outbound_stats.disconnects)
+        self.metrics.gauge('chat_presence_members', 'Members present by chat room watched by this process.',
+                           ['room'], lambda: dict([((room,), count) for room, (count, members)
+                                                   in self.presence.snapshots.iteritems()]))
+
+        # Warm up this process before it takes traffic, /ready tells load balancers when it is done.
+        self.startup = Startup()
+        self.startup.add_blocking('templates', lambda: precompile(self.template_loader, template_path))
+        self.startup.add('datastore', self.check_datastore)
+        self.startup.add('rooms', self.warm_rooms)
+        tornado.ioloop.IOLoop.instance().add_callback(self.startup.run)
+
+
+    def check_datastore(self, callback):
+        """
+        Startup phase checking the connection to Redis.
+        """
+        def on_pong(result):
+            callback(result if isinstance(result, Exception) else None)
+        self.client.execute_command('PING', metrics.timed('ping', on_pong))
+
+
+    def warm_rooms(self, callback):
+        """
+        Startup phase loading and rendering the latest messages of the chat rooms given by --warm_rooms,
+        so their first page loads are served from the fragment cache.
+        """
+        rooms = tornado.options.options.warm_rooms
+        if not rooms:
+            callback()
+            return
+        remaining = [len(rooms)]
+        errors = []
+        def on_recent(room, result):
+            if isinstance(result, Exception):
+                errors.append(result)
+            else:
+                self.fragments.render(room, result)
+            remaining[0] -= 1
+            if not remaining[0]:
+                callback(errors[0] if errors else None)
+        for room in rooms:
+            self.store.recent(room, tornado.options.options.history_size,
+                              functools.partial(on_recent, room))
+
+
+    def on_presence_changed(self, room, diff):
+        """
+        Sends the diff of the members of a chat room to all local sockets in the room. The frame is
+        encoded once per wire format.
+        """
+        sockets = self.store.subscriber.rooms.get(room)
+        if not sockets:
+            return
+        frames = {}
+        for socket in list(sockets):
+            codec = socket.codec
+            frame = frames.get(codec.name)
+            if frame is None:
+                frame = frames[codec.name] = codec.encode({'presence': diff})
+            socket.write_message(frame, codec.binary)
 
 
 
@@ -211,11 +543,11 @@ def main():
     """
      # This line will setup default options.
     tornado.options.parse_command_line()
-    # Create an instance of the main application.
-    application = Application()
-    # Start application by listening to desired port and starting IOLoop.
-    application.listen(tornado.options.options.port)
-    tornado.ioloop.IOLoop.instance().start()
+    # Start the application in the desired number of processes by listening
+    # to desired port and starting IOLoop.
+    options = tornado.options.options
+    serve(Application, options.port, processes=options.processes,
+          reuse_port=options.reuse_port, unix_socket=options.unix_socket)
 
 
 if __name__ == "__main__":
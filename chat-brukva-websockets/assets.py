@@ -0,0 +1,317 @@
+# coding=UTF-8
+
+# General modules.
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import os.path
+import posixpath
+import re
+import urllib2
+from cStringIO import StringIO
+
+# Tornado modules.
+import tornado.escape
+import tornado.web
+
+# Minifiers and Brotli are optional, without them assets are only
+# fingerprinted and gzipped.
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+try:
+    import rcssmin
+except ImportError:
+    rcssmin = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Third-party libraries by their path below static/vendor and their CDN.
+# Libraries are loaded from their CDN until they are downloaded with:
+#     python assets.py
+VENDOR = {
+    'css/bootstrap.min.css':
+        'https://netdna.bootstrapcdn.com/bootstrap/3.1.1/css/bootstrap.min.css',
+    'fonts/glyphicons-halflings-regular.eot':
+        'https://netdna.bootstrapcdn.com/bootstrap/3.1.1/fonts/glyphicons-halflings-regular.eot',
+    'fonts/glyphicons-halflings-regular.svg':
+        'https://netdna.bootstrapcdn.com/bootstrap/3.1.1/fonts/glyphicons-halflings-regular.svg',
+    'fonts/glyphicons-halflings-regular.ttf':
+        'https://netdna.bootstrapcdn.com/bootstrap/3.1.1/fonts/glyphicons-halflings-regular.ttf',
+    'fonts/glyphicons-halflings-regular.woff':
+        'https://netdna.bootstrapcdn.com/bootstrap/3.1.1/fonts/glyphicons-halflings-regular.woff',
+    'js/jquery.min.js':
+        'https://ajax.googleapis.com/ajax/libs/jquery/1.11.0/jquery.min.js',
+    'js/bootstrap.min.js':
+        'https://netdna.bootstrapcdn.com/bootstrap/3.1.1/js/bootstrap.min.js',
+    'js/msgpack.min.js':
+        'https://unpkg.com/msgpack-lite@0.1.26/dist/msgpack.min.js',
+}
+
+# Assets concatenated into one file, built only if all parts are present.
+BUNDLES = {
+    'libs.js': ['vendor/js/jquery.min.js', 'vendor/js/bootstrap.min.js'],
+}
+
+# Built assets never change, so they are cached for a year without revalidation.
+MAX_AGE = 365 * 24 * 60 * 60
+CACHE_CONTROL = "public, max-age=%d, immutable" % MAX_AGE
+
+# Types of assets which are worth compressing.
+COMPRESSIBLE = ('.css', '.js', '.json', '.svg', '.html', '.txt', '.eot', '.ttf')
+
+# References in stylesheets, e.g. url("../img/icons.png").
+CSS_URL = re.compile(r'url\(\s*([\'"]?)([^\'"\)]+)\1\s*\)')
+
+
+def minify(path, content):
+    """
+    Returns the content of the asset minified if a minifier for its type is
+    installed and it is not minified yet.
+    """
+    if '.min.' in path:
+        return content
+    if path.endswith('.js') and rjsmin is not None:
+        return rjsmin.jsmin(content)
+    if path.endswith('.css') and rcssmin is not None:
+        return rcssmin.cssmin(content)
+    return content
+
+
+def compress(content):
+    """
+    Returns the content gzipped at the highest level. The header carries no
+    time, so the same content always gives the same file.
+    """
+    out = StringIO()
+    f = gzip.GzipFile(fileobj=out, mode='wb', compresslevel=9, mtime=0)
+    f.write(content)
+    f.close()
+    return out.getvalue()
+
+
+def write_file(path, content):
+    """
+    Writes the file under a temporary name and renames it, so concurrent
+    processes building the same asset never serve half a file.
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Created by another process meanwhile.
+            if not os.path.isdir(directory):
+                raise
+    temp = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp, 'wb') as f:
+        f.write(content)
+    os.rename(temp, path)
+
+
+def accepted_encodings(header):
+    """
+    Returns the set of content codings in an Accept-Encoding header, without
+    those explicitly refused with q=0.
+    """
+    accepted = set()
+    for part in header.split(','):
+        params = part.split(';')
+        coding = params[0].strip().lower()
+        refused = False
+        for param in params[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    refused = float(value) == 0
+                except ValueError:
+                    pass
+        if coding and not refused:
+            accepted.add(coding)
+    return accepted
+
+
+
+class Assets(object):
+    """
+    Builds the assets in static_path into build_path and resolves the paths
+    used in the templates to the urls of the built assets, which are served
+    at prefix by the AssetHandler. Every asset is minified, named after a
+    hash of its content and written with its gzip and Brotli variants, e.g.
+    app.js becomes app.3f2a9c1e0b7d.js, app.3f2a9c1e0b7d.js.gz and
+    app.3f2a9c1e0b7d.js.br. A name never changes its content, so clients
+    cache assets for a year without revalidation and a deploy only changes
+    the names of the changed assets.
+    """
+    def __init__(self, static_path, build_path, prefix="/assets/", vendor=VENDOR, bundles=BUNDLES):
+        self.static_path = static_path
+        self.build_path = build_path
+        self.prefix = prefix
+        self.vendor = vendor
+        self.bundles = bundles
+        # Maps the path of every built asset to the name it is served by.
+        self.manifest = {}
+
+
+    def build(self):
+        """
+        Builds all assets and bundles. Assets built before are not written
+        again, so restarting with unchanged assets only hashes them.
+        """
+        paths = []
+        for directory, dirnames, filenames in os.walk(self.static_path):
+            for filename in filenames:
+                path = os.path.relpath(os.path.join(directory, filename), self.static_path)
+                paths.append(path.replace(os.sep, '/'))
+        # Stylesheets go last, so they can refer to the built images and fonts.
+        paths.sort(key=lambda path: (path.endswith('.css'), path))
+        contents = {}
+        for path in paths:
+            with open(os.path.join(self.static_path, path), 'rb') as f:
+                content = f.read()
+            if path.endswith('.css'):
+                content = self.rewrite(path, content)
+            content = contents[path] = minify(path, content)
+            self.manifest[path] = self.write(path, content)
+        for name, parts in sorted(self.bundles.items()):
+            if not all(part in contents for part in parts):
+                continue
+            separator = ';\n' if name.endswith('.js') else '\n'
+            self.manifest[name] = self.write(name, separator.join([contents[part] for part in parts]))
+        logging.info("Built %d static assets in %s", len(self.manifest), self.build_path)
+
+
+    def write(self, path, content):
+        """
+        Writes the asset and its compressed variants under its fingerprinted
+        name and returns the name.
+        """
+        base, ext = posixpath.splitext(path)
+        name = '%s.%s%s' % (base, hashlib.md5(content).hexdigest()[:12], ext)
+        target = os.path.join(self.build_path, *name.split('/'))
+        if os.path.exists(target):
+            return name
+        if ext in COMPRESSIBLE:
+            variants = [('.gz', compress(content))]
+            if brotli is not None:
+                variants.append(('.br', brotli.compress(content)))
+            for suffix, compressed in variants:
+                # Clients accepting the encoding get the smaller file.
+                if len(compressed) < len(content):
+                    write_file(target + suffix, compressed)
+        # The uncompressed file is written last, it marks the asset as built.
+        write_file(target, content)
+        return name
+
+
+    def rewrite(self, path, content):
+        """
+        Replaces relative references in a stylesheet with the urls of the
+        built assets they refer to.
+        """
+        directory = posixpath.dirname(path)
+        def replace(match):
+            quote, url = match.group(1), match.group(2)
+            if url.startswith(('/', '#', 'data:')) or '://' in url:
+                return match.group(0)
+            target, suffix = re.match(r'([^?#]*)(.*)', url).groups()
+            target = posixpath.normpath(posixpath.join(directory, target))
+            if target not in self.manifest:
+                return match.group(0)
+            return 'url(%s%s%s%s)' % (quote, self.prefix + self.manifest[target], suffix, quote)
+        return CSS_URL.sub(replace, content)
+
+
+    def url(self, path):
+        """
+        Returns the url of an asset by its path below static. Libraries
+        without a local copy are loaded from their CDN.
+        """
+        name = self.manifest.get(path)
+        if name is not None:
+            return self.prefix + name
+        if path.startswith('vendor/') and path[len('vendor/'):] in self.vendor:
+            return self.vendor[path[len('vendor/'):]]
+        raise KeyError("Unknown static asset " + path)
+
+
+    def tags(self, path):
+        """
+        Returns the HTML to include a script or stylesheet. A bundle which
+        could not be built is included by its parts.
+        """
+        if path in self.bundles and path not in self.manifest:
+            return '\n'.join([self.tags(part) for part in self.bundles[path]])
+        url = tornado.escape.xhtml_escape(self.url(path))
+        if path.endswith('.css'):
+            return '<link href="%s" rel="stylesheet">' % url
+        return '<script src="%s" type="text/javascript"></script>' % url
+
+
+    def ui_methods(self):
+        """
+        Returns the template functions asset_url() and asset_tags().
+        """
+        return {'asset_url': lambda handler, path: self.url(path),
+                'asset_tags': lambda handler, path: self.tags(path)}
+
+
+
+class AssetHandler(tornado.web.StaticFileHandler):
+    """
+    Serves the built assets with immutable cache headers. Clients accepting
+    Brotli or gzip get the precompressed variant, nothing is compressed per
+    request.
+    """
+    # Content codings in order of preference with the suffix of their files.
+    encodings = (('br', '.br'), ('gzip', '.gz'))
+
+    def validate_absolute_path(self, root, absolute_path):
+        absolute_path = tornado.web.StaticFileHandler.validate_absolute_path(self, root, absolute_path)
+        if absolute_path is None:
+            return None
+        accepted = accepted_encodings(self.request.headers.get("Accept-Encoding", ""))
+        for encoding, suffix in self.encodings:
+            if encoding in accepted and os.path.isfile(absolute_path + suffix):
+                self.set_header("Content-Encoding", encoding)
+                return absolute_path + suffix
+        return absolute_path
+
+
+    def get_content_type(self):
+        # The type of the asset, not of its compressed file.
+        mime_type, encoding = mimetypes.guess_type(self.path)
+        return mime_type
+
+
+    def get_cache_time(self, path, modified, mime_type):
+        return MAX_AGE
+
+
+    def set_extra_headers(self, path):
+        self.set_header("Cache-Control", CACHE_CONTROL)
+        self.set_header("Vary", "Accept-Encoding")
+
+
+
+def download_vendor(static_path, vendor=VENDOR):
+    """
+    Downloads the libraries which have no local copy yet.
+    """
+    for path, url in sorted(vendor.items()):
+        target = os.path.join(static_path, 'vendor', *path.split('/'))
+        if os.path.exists(target):
+            continue
+        logging.info("Downloading %s", url)
+        write_file(target, urllib2.urlopen(url, timeout=30).read())
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    download_vendor(os.path.join(os.path.dirname(os.path.abspath(__file__)), "static"))
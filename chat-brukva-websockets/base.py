@@ -6,6 +6,34 @@ import tornado.web
 # General modules.
 import logging
 
+# Import application modules.
+import metrics
+
+
+def load_user(application, user_id, callback):
+    """
+    Loads the user object with the given id from the user cache or from
+    Redis. The callback receives the user object or an empty dict if the
+    user does not exist.
+    """
+    # Serve the user object from the cache if possible.
+    user = application.user_cache.get(user_id)
+    if user is not None:
+        callback(user)
+        return
+    # Define a callback for the db query.
+    def query_callback(result):
+        if result == "null" or not result:
+            logging.warning("User not found")
+            user = {}
+        else:
+            user = tornado.escape.json_decode(result)
+            application.user_cache.set(user_id, user)
+        callback(user)
+    # Load user object and pass query_callback as callback.
+    application.client.get("user:" + user_id, metrics.timed('get', query_callback))
+
+
 
 class BaseHandler(tornado.web.RequestHandler):
     """
@@ -18,6 +46,15 @@ class BaseHandler(tornado.web.RequestHandler):
         tornado.web.RequestHandler.__init__(self, application, request, **kwargs)
 
 
+    def prepare(self):
+        # Answer with 503 until the startup phases are done, the datastore
+        # may not be connected yet.
+        if not self.application.startup.ready:
+            self.set_status(503)
+            self.set_header("Retry-After", "1")
+            self.finish()
+
+
     def _get_current_user(self, callback):
         """
         An async method to load the current user object.
@@ -30,17 +67,10 @@ class BaseHandler(tornado.web.RequestHandler):
             logging.warning("Cookie not found")
             callback(user=None)
             return
-        # Define a callback for the db query.
-        def query_callback(result):
-            if result == "null" or not result:
-                logging.warning("User not found")
-                user = {}
-            else:
-                user = tornado.escape.json_decode(result)
+        def on_user(user):
             self._current_user = user
             callback(user=user)
-        # Load user object and pass query_callback as callback.
-        self.application.client.get("user:" + user_id, query_callback)
+        load_user(self.application, user_id, on_user)
         return
 
 
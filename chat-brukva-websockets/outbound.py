@@ -0,0 +1,228 @@
+# coding=UTF-8
+
+# General modules.
+import collections
+import functools
+import logging
+
+# Tornado modules.
+import tornado.escape
+import tornado.websocket
+
+# Import application modules.
+from wire import JSON
+
+
+
+class OutboundStats(object):
+    """
+    Counters of the outbound queues of all sockets of this process.
+    """
+    def __init__(self):
+        # Bytes queued or written to the streams and not yet sent.
+        self.buffered_bytes = 0
+        self.frames_coalesced = 0
+        self.frames_dropped = 0
+        self.disconnects = 0
+
+
+
+class OutboundQueue(object):
+    """
+    Bounded queue of the frames to send through one websocket. Frames are
+    written to the stream as long as it keeps up. While the stream is still
+    sending, frames are queued and written at once when it has drained. The
+    policy decides what happens if a slow client lets the queue exceed
+    max_frames or max_bytes:
+    coalesce - Merges the queued messages into a single frame. Exceeding
+               max_bytes anyway closes the socket.
+    drop - Drops the oldest messages and sends a gap marker like this
+           {"gap": Number of frames dropped} before the remaining ones, so
+           the client can reconnect to fetch the missed messages.
+    disconnect - Closes the socket, the client reconnects with its cursor.
+    """
+    policies = ('coalesce', 'drop', 'disconnect')
+
+    def __init__(self, socket, stats, policy='coalesce', max_frames=100, max_bytes=1048576,
+                 codec=JSON):
+        if policy not in self.policies:
+            raise ValueError("Unknown outbound policy: " + str(policy))
+        self.socket = socket
+        self.stats = stats
+        self.policy = policy
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        # Wire format of the frames.
+        self.codec = codec
+        # Queued frames as (frame, binary, items) with items being the list of
+        # encoded messages of frames which may be merged or dropped.
+        self.frames = collections.deque()
+        self.queued_bytes = 0
+        # Bytes written to the stream since it drained last.
+        self.sending_bytes = 0
+        # Number of the latest write, older drain callbacks are ignored.
+        self.writes = 0
+        self.dropped = 0
+        self.closed = False
+
+
+    @property
+    def buffered_bytes(self):
+        """
+        Bytes of this socket waiting to be sent.
+        """
+        return self.queued_bytes + self.sending_bytes
+
+
+    def push(self, message, binary=False):
+        """
+        Sends the message or queues it if the stream is still sending. Dicts
+        are encoded with the codec of this socket.
+        """
+        if isinstance(message, dict):
+            self.enqueue((self.codec.encode(message), self.codec.binary, None))
+        else:
+            self.enqueue((tornado.escape.utf8(message), binary, None))
+
+
+    def push_batch(self, batch):
+        """
+        Sends or queues the frame of a MessageBatch of published messages.
+        """
+        self.enqueue((batch.frame(self.codec), self.codec.binary, batch.items(self.codec)))
+
+
+    def enqueue(self, entry):
+        """
+        Writes the (frame, binary, items) entry or adds it to the queue.
+        """
+        if self.closed:
+            return
+        if not self.frames and not self.sending():
+            self.write([entry])
+            return
+        self.frames.append(entry)
+        self.account(len(entry[0]), 0)
+        if len(self.frames) > self.max_frames or self.queued_bytes > self.max_bytes:
+            self.overflow()
+
+
+    def sending(self):
+        """
+        Returns whether frames written before are still being sent.
+        """
+        if self.sending_bytes and not self.socket.stream.writing():
+            # Drained, but the drain callback has not run yet.
+            self.writes += 1
+            self.account(0, -self.sending_bytes)
+        return self.sending_bytes > 0
+
+
+    def overflow(self):
+        """
+        Applies the policy to the queue exceeding its limits.
+        """
+        if self.policy == 'coalesce':
+            self.coalesce()
+            if self.queued_bytes > self.max_bytes:
+                logging.warning("Closing slow socket with %d bytes queued", self.queued_bytes)
+                self.close()
+        elif self.policy == 'drop':
+            while self.frames and (len(self.frames) > self.max_frames or
+                                   self.queued_bytes > self.max_bytes):
+                frame, binary, items = self.frames.popleft()
+                self.account(-len(frame), 0)
+                if items is not None:
+                    self.dropped += 1
+                    self.stats.frames_dropped += 1
+        else:
+            logging.warning("Closing slow socket with %d bytes queued", self.queued_bytes)
+            self.close()
+
+
+    def coalesce(self):
+        """
+        Merges all queued frames of published messages into one frame.
+        """
+        merged = []
+        items = []
+        batches = 0
+        for entry in self.frames:
+            if entry[2] is None:
+                merged.append(entry)
+            else:
+                items.extend(entry[2])
+                batches += 1
+        if batches < 2:
+            return
+        self.stats.frames_coalesced += batches - 1
+        merged.append((self.codec.batch(items), self.codec.binary, items))
+        self.frames = collections.deque(merged)
+        queued = sum([len(entry[0]) for entry in merged])
+        self.account(queued - self.queued_bytes, 0)
+
+
+    def write(self, frames):
+        """
+        Writes the frames to the stream and waits for it to drain.
+        """
+        if self.dropped:
+            frames.insert(0, (self.codec.encode({'gap': self.dropped}), self.codec.binary, None))
+            self.dropped = 0
+        size = 0
+        try:
+            for frame, binary, items in frames:
+                tornado.websocket.WebSocketHandler.write_message(self.socket, frame, binary)
+                size += len(frame)
+            self.writes += 1
+            self.socket.stream.write(b'', functools.partial(self.on_drain, self.writes))
+        except:
+            logging.warning("Error writing to socket", exc_info=True)
+            self.discard()
+            return
+        self.account(0, size)
+
+
+    def on_drain(self, writes):
+        """
+        Callback when the stream has sent everything written to it. Writes the
+        frames queued meanwhile.
+        """
+        if self.closed or writes != self.writes:
+            return
+        self.account(0, -self.sending_bytes)
+        if not self.frames:
+            return
+        if self.policy == 'coalesce':
+            self.coalesce()
+        frames = list(self.frames)
+        self.frames.clear()
+        self.account(-self.queued_bytes, 0)
+        self.write(frames)
+
+
+    def account(self, queued, sending):
+        """
+        Updates the bytes counters of this queue and of the process.
+        """
+        self.queued_bytes += queued
+        self.sending_bytes += sending
+        self.stats.buffered_bytes += queued + sending
+
+
+    def close(self):
+        """
+        Closes the socket because the client can not keep up.
+        """
+        self.stats.disconnects += 1
+        self.discard()
+        self.socket.close()
+
+
+    def discard(self):
+        """
+        Drops everything queued when the socket is closed.
+        """
+        self.closed = True
+        self.frames.clear()
+        self.account(-self.queued_bytes, -self.sending_bytes)
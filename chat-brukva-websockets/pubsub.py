@@ -0,0 +1,90 @@
+# coding=UTF-8
+
+# General modules.
+import logging
+import time
+
+# Redis modules.
+import brukva
+
+# Import application modules.
+import metrics
+import tracing
+from wire import MessageBatch
+
+
+
+class RoomSubscriber(object):
+    """
+    Multiplexes all chat rooms of this process over one single Redis Pub/Sub
+    connection. A room is subscribed in Redis when its first local socket joins
+    and unsubscribed when its last local socket leaves. Published messages are
+    fanned out to the local sockets of the room using an in-memory index.
+    """
+    def __init__(self):
+        # Index of chat rooms mapping to the set of local sockets in the room.
+        self.rooms = {}
+        # Connect to redis. This connection is used for Pub/Sub only.
+        self.client = brukva.Client()
+        self.client.connect()
+
+
+    def subscribe(self, room, socket):
+        """
+        Adds the socket to the given chat room and subscribes for the room in
+        Redis if it is the first local socket in this room.
+        """
+        sockets = self.rooms.get(room)
+        if sockets is None:
+            # Brukva stops listening when the last channel was unsubscribed,
+            # so start listening again with the first subscription.
+            listen = not self.rooms
+            sockets = self.rooms[room] = set()
+            self.client.subscribe(room)
+            if listen:
+                self.client.listen(self.on_messages_published)
+            logging.info('Subscribed to chat room ' + room)
+        sockets.add(socket)
+
+
+    def unsubscribe(self, room, socket):
+        """
+        Removes the socket from the given chat room and unsubscribes from the
+        room in Redis if it was the last local socket in this room.
+        """
+        sockets = self.rooms.get(room)
+        if sockets is None:
+            return
+        sockets.discard(socket)
+        if not sockets:
+            del self.rooms[room]
+            self.client.unsubscribe(room)
+            logging.info('Unsubscribed from chat room ' + room)
+
+
+    def on_messages_published(self, message):
+        """
+        Callback for listening to subscribed chat rooms based on Redis Pub/Sub.
+        Delivers the message to every local socket in the message's chat room.
+        """
+        # Abort if message type is something like unsubscribe.
+        if message.kind != 'message':
+            return
+        sockets = self.rooms.get(message.channel)
+        if not sockets:
+            return
+        # The message is published JSON-encoded, so the frames are built once
+        # per wire format from it instead of decoding and encoding it per socket.
+        batch = MessageBatch([message.body])
+        tracing.stages(batch.messages(), 'receive')
+        start = time.time()
+        sockets = list(sockets)
+        # Iterate over a copy since sockets might be closed while delivering.
+        for socket in sockets:
+            try:
+                socket.on_messages_published(batch)
+            except:
+                logging.error("Error delivering message to socket", exc_info=True)
+        metrics.DELIVERED.inc((message.channel,), len(sockets))
+        metrics.FANOUT_SECONDS.observe(time.time() - start, (message.channel,))
+        tracing.stages(batch.messages(), 'deliver')
@@ -0,0 +1,144 @@
+# coding=UTF-8
+
+# General modules.
+import logging
+import os
+import os.path
+import time
+
+# Tornado modules.
+import tornado.ioloop
+import tornado.web
+
+# Import application modules.
+import metrics
+
+
+PHASE_SECONDS = metrics.registry.gauge('chat_startup_phase_seconds',
+                                       'Duration of each startup phase of this process, including retries.',
+                                       ['phase'])
+
+
+def precompile(loader, template_path):
+    """
+    Compiles all templates below template_path into the loader, so no
+    request has to wait for a template to be compiled. Returns the number of
+    templates.
+    """
+    count = 0
+    for directory, dirnames, filenames in os.walk(template_path):
+        for filename in filenames:
+            if filename.endswith('.html'):
+                path = os.path.relpath(os.path.join(directory, filename), template_path)
+                loader.load(path.replace(os.sep, '/'))
+                count += 1
+    return count
+
+
+
+class Startup(object):
+    """
+    Runs the phases warming up this process one after another, like
+    compiling the templates, checking the datastore connection and loading
+    the latest messages of the chat rooms. A phase is a function receiving a
+    callback, which it calls when done, with an Exception if it failed. A
+    failed phase is retried every retry seconds, so a process started before
+    its datastore becomes ready as soon as the datastore is up. The process
+    is ready after the last phase, until then requests are answered with 503
+    and /ready tells load balancers to wait.
+    """
+    def __init__(self, retry=1.0):
+        self.retry = retry
+        self.phases = []
+        # Durations of the finished phases as (name, seconds).
+        self.durations = []
+        self.current = None
+        self.error = None
+        self.started = None
+        self.ready = False
+        metrics.registry.gauge('chat_ready', 'Whether this process finished its startup phases.',
+                               callback=lambda: int(self.ready))
+
+
+    def add(self, name, phase):
+        """
+        Adds an asynchronous phase.
+        """
+        self.phases.append((name, phase))
+
+
+    def add_blocking(self, name, function):
+        """
+        Adds a phase which is done when the function returns.
+        """
+        def phase(callback):
+            function()
+            callback()
+        self.add(name, phase)
+
+
+    def run(self):
+        """
+        Starts the first phase.
+        """
+        self.started = time.time()
+        self.next(0, self.started)
+
+
+    def next(self, index, start):
+        """
+        Runs the phase at index, which was first tried at start.
+        """
+        if index == len(self.phases):
+            self.current = None
+            self.error = None
+            self.ready = True
+            logging.info("Ready after %.3f s (%s)", time.time() - self.started,
+                         ", ".join(["%s %.3f s" % duration for duration in self.durations]))
+            return
+        name, phase = self.phases[index]
+        self.current = name
+        def on_done(error=None):
+            if error is not None:
+                self.error = "%s: %s" % (name, error)
+                logging.error("Startup phase %s failed, retrying in %s s: %s", name, self.retry, error)
+                tornado.ioloop.IOLoop.instance().add_timeout(time.time() + self.retry,
+                                                             lambda: self.next(index, start))
+                return
+            elapsed = time.time() - start
+            PHASE_SECONDS.set(elapsed, (name,))
+            self.durations.append((name, elapsed))
+            logging.info("Startup phase %s took %.3f s", name, elapsed)
+            self.next(index + 1, time.time())
+        try:
+            phase(on_done)
+        except Exception, err:
+            on_done(err)
+
+
+    def status(self):
+        """
+        Returns the state of the startup for the readiness check.
+        """
+        return {
+            'ready': self.ready,
+            'phase': self.current,
+            'error': self.error,
+            'phases': [{'name': name, 'seconds': round(seconds, 6)} for name, seconds in self.durations],
+            'uptime': round(time.time() - self.started, 3) if self.started else 0,
+        }
+
+
+
+class ReadyHandler(tornado.web.RequestHandler):
+    """
+    Readiness check for load balancers. Answers 200 once this process has
+    finished its startup phases and 503 before, both with the state of the
+    startup as JSON.
+    """
+    def get(self):
+        startup = self.application.startup
+        if not startup.ready:
+            self.set_status(503)
+        self.set_header("Cache-Control", "no-cache")
+        self.write(startup.status())
@@ -1,17 +1,13 @@
 /**
- * Initiate global websocket object.
- * @todo: Add user cookie for authentication.
+ * Global websocket object, (re)created by connect(). The server
+ * authenticates the socket once by the user cookie of the handshake.
  */
-var ws = new WebSocket("ws://127.0.0.1:8888/socket/" + location.pathname.replace('/room/', '').replace('/', ''));
-
-
-/**
- * Helper function to get the value of a cookie.
- */
-function cookie(name) {
-    var r = document.cookie.match("\\b" + name + "=([^;]*)\\b");
-    return r ? r[1] : undefined;
-}
+var ws = null;
+// Set when the server rejected the user, so there is no point in reconnecting.
+var unauthorized = false;
+var room = location.pathname.replace('/room/', '').replace('/', '');
+// Delay in ms before reconnecting, doubled after every failed attempt.
+var reconnectDelay = 500;
 
 
 $(document).ready(function() {
@@ -30,29 +26,79 @@ $(document).ready(function() {
     var disabled = $("form#chat-input").find("input");
     disabled.attr("disabled", "disabled");
 
+    // Resume from the latest message rendered with the page, so messages
+    // posted in between are not missed.
+    var latest = $("#messsages .message:last").attr("id");
+    if (latest) updater.cursor = latest.substring(1);
+    connect(disabled);
+});
+
+
+/**
+ * Opens the websocket, passing the cursor of the latest message received to
+ * get the messages missed while disconnected. Reconnects with backoff.
+ */
+function connect(disabled) {
+    var url = "ws://" + location.host + "/socket/" + room;
+    if (updater.cursor) url += "?cursor=" + encodeURIComponent(updater.cursor);
+    // Prefer the compact MessagePack wire format if its library is loaded.
+    var protocols = window.msgpack ? ["msgpack", "json"] : ["json"];
+    ws = new WebSocket(url, protocols);
+    ws.binaryType = "arraybuffer";
+
     // Websocket callbacks:
     ws.onopen = function() {
         console.log("Connected...");
+        reconnectDelay = 500;
         disabled.removeAttr("disabled");
     };
     ws.onmessage = function(event) {
-        data = JSON.parse(event.data);
+        if (event.data instanceof ArrayBuffer) {
+            data = msgpack.decode(new Uint8Array(event.data));
+        }
+        else {
+            data = JSON.parse(event.data);
+        }
         if(data.textStatus && data.textStatus == "unauthorized") {
+            unauthorized = true;
             alert("unauthorized");
             disabled.attr("disabled", "disabled");
         }
+        else if(data.retry_after) {
+            // Posting too fast, so wait before the next message is allowed.
+            console.log("Slow down, retrying is allowed in " + data.retry_after + " s");
+            var input = $("form#chat-input").find("input, button");
+            input.attr("disabled", "disabled");
+            window.setTimeout(function() { input.removeAttr("disabled"); }, data.retry_after * 1000);
+            return;
+        }
+        else if(data.textStatus && data.textStatus == "starting") {
+            // The server is still warming up and closes the socket, the
+            // reconnect is delayed as after any other close.
+            console.log("Server is starting");
+        }
         else if(data.error && data.textStatus) {
             alert(data.textStatus);
         }
+        else if(data.gap) {
+            // The server dropped messages because we could not keep up, so
+            // reconnect to fetch them from the cursor.
+            console.log("Missed " + data.gap + " frames, reconnecting");
+            ws.close();
+            return;
+        }
         console.log("New Message", data);
         if (data.messages) newMessages(data);
+        if (data.presence) showPresence(data.presence);
     };
     ws.onclose = function() {
-        // @todo: Implement reconnect.
-        console.log("Closed!");
         disabled.attr("disabled", "disabled");
+        if (unauthorized) return;
+        console.log("Closed! Reconnecting in " + reconnectDelay + "ms");
+        window.setTimeout(function() { connect(disabled); }, reconnectDelay);
+        reconnectDelay = Math.min(reconnectDelay * 2, 30000);
     };
-});
+}
 
 
 /**
@@ -61,12 +107,15 @@ $(document).ready(function() {
 function postMessage(form) {
     var value = form.find("input[type=text]").val();
     var message = {body: value};
-    message._xsrf = cookie("_xsrf");
-    message.user = cookie("user");
     var disabled = form.find("input");
     disabled.attr("disabled", "disabled");
     // Send message using websocket.
-    ws.send(JSON.stringify(message));
+    if (ws.protocol == "msgpack") {
+        ws.send(msgpack.encode(message));
+    }
+    else {
+        ws.send(JSON.stringify(message));
+    }
     // @todo: A response if successful would be nice. 
     console.log("Created message (successfuly)");
     $("#message-input").val("").select();
@@ -96,8 +145,27 @@ showMessage = function(message) {
     console.log("Show Message");
     var existing = $("#m" + message._id);
     if (existing.length > 0) return;
-    $("#messsages").append('<div style="display: none;" class="message" id="' + message._id + '"><b>' + message.from + ': </b>' + message.body + '</div>');
+    $("#messsages").append('<div style="display: none;" class="message" id="m' + message._id + '"><b>' + message.from + ': </b>' + message.body + '</div>');
     $('#messsages').find(".message:last").slideDown("fast", function(){
         $('html, body').animate({scrollTop: $(document).height()}, 400);
     });
 };
+
+
+/**
+ * Members of the chat room, updated by the full state or by diffs. Rooms
+ * with too many members are only shown by count.
+ */
+var members = {};
+showPresence = function(presence) {
+    var i;
+    if (presence.members !== undefined) {
+        members = {};
+        for (i = 0; presence.members && i < presence.members.length; i++) members[presence.members[i]] = true;
+    }
+    for (i = 0; presence.joined && i < presence.joined.length; i++) members[presence.joined[i]] = true;
+    for (i = 0; presence.left && i < presence.left.length; i++) delete members[presence.left[i]];
+    var names = $.map(members, function(value, name) { return name; }).sort();
+    $("#presence .count").text(presence.count + " online");
+    $("#presence .members").text(names.join(", "));
+};
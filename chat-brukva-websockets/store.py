@@ -0,0 +1,581 @@
+# coding=UTF-8
+
+# General modules.
+import functools
+import logging
+import time
+
+# Tornado modules.
+import tornado.ioloop
+import tornado.escape
+
+# MongoDb modules.
+from bson.objectid import ObjectId
+
+# Redis modules.
+import brukva
+
+# Import application modules.
+import metrics
+import tracing
+from pubsub import RoomSubscriber
+from wire import MessageBatch
+from writer import MessageWriter
+from writer import StreamWriter
+
+
+
+def newer_than(messages, cursor):
+    """
+    Returns the messages newer than the message with the id cursor. If the
+    cursor is not found, all messages are returned.
+    """
+    for i in xrange(len(messages) - 1, -1, -1):
+        if messages[i]["_id"] == cursor:
+            return messages[i + 1:]
+    return messages
+
+
+def encode_entry(entry_id, fields):
+    """
+    Returns the JSON-literal of the message of a stream entry with the entry
+    id added as message id, without decoding the stored message. A message
+    stored with an '_id' of its own is decoded to replace it.
+    """
+    message_encoded = dict(zip(fields[::2], fields[1::2]))['m']
+    if '"_id"' in message_encoded:
+        message = tornado.escape.json_decode(message_encoded)
+        message["_id"] = entry_id
+        return tornado.escape.json_encode(message)
+    return '{"_id": ' + tornado.escape.json_encode(entry_id) + ', ' + message_encoded[1:]
+
+
+def decode_entries(entries):
+    """
+    JSON-decodes the messages of a list of stream entries using the entry id
+    as message id.
+    """
+    messages = []
+    for entry_id, fields in entries or []:
+        message = tornado.escape.json_decode(dict(zip(fields[::2], fields[1::2]))['m'])
+        message["_id"] = entry_id
+        messages.append(message)
+    return messages
+
+
+
+class ListStore(object):
+    """
+    Stores each chat room as a Redis list and delivers new messages to the
+    sockets through the Pub/Sub channel of the same name. All callbacks
+    receive an exception instead of the result if a command failed.
+    """
+    def __init__(self, client, retention=1000, catchup=50):
+        self.client = client
+        self.catchup = catchup
+        self.writer = MessageWriter(client, retention)
+        # One Pub/Sub connection per process shared by all sockets and rooms.
+        self.subscriber = RoomSubscriber()
+
+
+    def append(self, room, message, callback):
+        """
+        Stores and publishes the message and sets its '_id'. The callback
+        receives None on success or the exception.
+        """
+        # Generate object id as message id.
+        message["_id"] = str(ObjectId())
+        self.writer.write(room, tornado.escape.json_encode(message),
+                          lambda error, replies: callback(error))
+
+
+    def recent(self, room, count, callback):
+        """
+        Loads the list of the latest count messages of the chat room.
+        """
+        def on_result(result):
+            if isinstance(result, Exception):
+                callback(result)
+                return
+            # JSON-decode messages.
+            callback([tornado.escape.json_decode(message) for message in result])
+        self.client.lrange(room, -count, -1, metrics.timed('lrange', on_result))
+
+
+    def since(self, room, cursor, callback):
+        """
+        Loads the list of messages newer than the message with the id cursor.
+        Only the latest messages are checked, if the cursor is older all of
+        them are loaded.
+        """
+        def on_result(result):
+            if isinstance(result, Exception):
+                callback(result)
+                return
+            callback(newer_than(result, cursor))
+        self.recent(room, self.catchup, on_result)
+
+
+    def before(self, room, cursor, position, count, callback):
+        """
+        Loads a page of count messages older than the message with the id
+        cursor. Position is the position of the cursor from the end of the
+        chat room as returned by the previous page. The callback receives a
+        tuple of the messages and the position of the first message.
+        """
+        ListHistory(self.client, room, cursor, position, count, callback)
+
+
+    def subscribe(self, room, socket):
+        """
+        Delivers new messages of the chat room to the socket.
+        """
+        self.subscriber.subscribe(room, socket)
+
+
+    def unsubscribe(self, room, socket):
+        """
+        Stops delivering new messages of the chat room to the socket.
+        """
+        self.subscriber.unsubscribe(room, socket)
+
+
+
+class ListHistory(object):
+    """
+    Pages backwards through a chat room list from the message with the id
+    cursor. Positions count messages from the end of the list, the newest
+    message has position 1. The cursor can only have moved further back
+    since the client got its position, so the search starts there.
+    """
+    def __init__(self, client, room, cursor, position, count, callback):
+        self.client = client
+        self.room = room
+        self.cursor = cursor
+        self.count = count
+        self.callback = callback
+        if not cursor:
+            self.load_page(0)
+        else:
+            self.scan(max(position, 1))
+
+
+    def scan(self, position):
+        """
+        Loads a window of two pages ending at position to look for the cursor.
+        """
+        self.position = position
+        self.window = 2 * self.count
+        self.client.lrange(self.room, -(position + self.window - 1), -position,
+                           metrics.timed('lrange', self.on_window))
+
+
+    def on_window(self, result):
+        """
+        Callback for loading a window of messages in self.scan().
+        """
+        if isinstance(result, Exception):
+            self.callback(result)
+            return
+        # JSON-decode messages.
+        messages = [tornado.escape.json_decode(message) for message in result]
+        # Find the cursor, starting with the newest message of the window.
+        for i in xrange(len(messages) - 1, -1, -1):
+            if messages[i]["_id"] == self.cursor:
+                position = self.position + len(messages) - 1 - i
+                if i >= self.count:
+                    # The whole page is part of the window.
+                    page = messages[i - self.count:i]
+                    self.callback((page, position + len(page)))
+                else:
+                    self.load_page(position)
+                return
+        if len(messages) < self.window:
+            # Reached the oldest message, the cursor has been trimmed away.
+            self.callback(([], self.position))
+            return
+        self.scan(self.position + self.window)
+
+
+    def load_page(self, position):
+        """
+        Loads the page of messages older than position.
+        """
+        self.position = position
+        self.client.lrange(self.room, -(position + self.count), -(position + 1),
+                           metrics.timed('lrange', self.on_page))
+
+
+    def on_page(self, result):
+        """
+        Callback for loading a page in self.load_page().
+        """
+        if isinstance(result, Exception):
+            self.callback(result)
+            return
+        # JSON-decode messages.
+        page = [tornado.escape.json_decode(message) for message in result]
+        self.callback((page, self.position + len(page)))
+
+
+
+class StreamStore(object):
+    """
+    Stores each chat room as a Redis Stream, which persists and delivers
+    messages in one structure. Stream entry ids are used as message ids and
+    thereby as cursors, so clients resume exactly where they left off. All
+    callbacks receive an exception instead of the result if a command failed.
+    """
+    def __init__(self, client, retention=1000, catchup=50, block=1000):
+        self.client = client
+        self.catchup = catchup
+        self.writer = StreamWriter(client, retention)
+        # One blocking read per process shared by all sockets and rooms.
+        self.subscriber = StreamSubscriber(client, block, catchup)
+
+
+    def append(self, room, message, callback):
+        """
+        Stores the message and sets its '_id' to the id of the stream entry.
+        The callback receives None on success or the exception.
+        """
+        def on_written(error, replies):
+            if not error:
+                message["_id"] = replies[0]
+            callback(error)
+        # The id of the entry is the message id, so it is not stored.
+        stored = dict(message)
+        stored.pop("_id", None)
+        self.writer.write(room, tornado.escape.json_encode(stored), on_written)
+
+
+    def recent(self, room, count, callback):
+        """
+        Loads the list of the latest count messages of the chat room.
+        """
+        def on_result(result):
+            if isinstance(result, Exception):
+                callback(result)
+                return
+            entries = list(result or [])
+            entries.reverse()
+            callback(decode_entries(entries))
+        self.client.execute_command('XREVRANGE', metrics.timed('xrevrange', on_result), room, '+', '-',
+                                    'COUNT', count)
+
+
+    def since(self, room, cursor, callback):
+        """
+        Loads the list of messages newer than the message with the id cursor.
+        """
+        def on_result(result):
+            if isinstance(result, Exception):
+                callback(result)
+                return
+            callback(decode_entries(result[0][1] if result else []))
+        self.client.execute_command('XREAD', metrics.timed('xread', on_result), 'COUNT', self.catchup,
+                                    'STREAMS', room, cursor)
+
+
+    def before(self, room, cursor, position, count, callback):
+        """
+        Loads a page of count messages older than the message with the id
+        cursor. The callback receives a tuple of the messages and the position
+        of the first message from the end of the chat room, which is only
+        informational for streams.
+        """
+        if not cursor:
+            self.recent(room, count, lambda result: callback(
+                result if isinstance(result, Exception) else (result, len(result))))
+            return
+        def on_result(result):
+            if isinstance(result, Exception):
+                callback(result)
+                return
+            # The range includes the cursor itself.
+            entries = [entry for entry in result or [] if entry[0] != cursor][:count]
+            entries.reverse()
+            page = decode_entries(entries)
+            callback((page, max(position, 1) + len(page)))
+        self.client.execute_command('XREVRANGE', metrics.timed('xrevrange', on_result), room, cursor, '-',
+                                    'COUNT', count + 1)
+
+
+    def subscribe(self, room, socket):
+        """
+        Delivers new messages of the chat room to the socket.
+        """
+        self.subscriber.subscribe(room, socket)
+
+
+    def unsubscribe(self, room, socket):
+        """
+        Stops delivering new messages of the chat room to the socket.
+        """
+        self.subscriber.unsubscribe(room, socket)
+
+
+
+class StreamSubscriber(object):
+    """
+    Delivers new messages of all chat rooms of this process by reading their
+    streams with one blocking XREAD on a dedicated connection. A room is read
+    from the id of the last message delivered in this room, which is looked
+    up when the first local socket joins, so no message can get lost between
+    two reads.
+    """
+    def __init__(self, client, block=1000, count=50):
+        # The shared connection is used for looking up the latest messages.
+        self.client = client
+        self.block = block
+        self.count = count
+        # Index of chat rooms mapping to the set of local sockets in the room.
+        self.rooms = {}
+        # Ids of the last message delivered by chat room.
+        self.cursors = {}
+        self.reading = False
+        # Connect to redis. This connection is used for blocking reads only.
+        self.reader = brukva.Client()
+        self.reader.connect()
+
+
+    def subscribe(self, room, socket):
+        """
+        Adds the socket to the given chat room and starts reading the room's
+        stream if it is the first local socket in this room.
+        """
+        sockets = self.rooms.get(room)
+        if sockets is None:
+            sockets = self.rooms[room] = set()
+            self.client.execute_command('XREVRANGE',
+                                        metrics.timed('xrevrange', lambda result: self.on_latest(room, result)),
+                                        room, '+', '-', 'COUNT', 1)
+            logging.info('Subscribed to chat room ' + room)
+        sockets.add(socket)
+
+
+    def on_latest(self, room, result):
+        """
+        Callback for looking up the latest message of a chat room joined in
+        self.subscribe().
+        """
+        # Abort if the room was left meanwhile.
+        if room not in self.rooms or room in self.cursors:
+            return
+        if isinstance(result, Exception):
+            logging.error("Error loading latest message: " + str(result))
+            result = []
+        self.cursors[room] = result[0][0] if result else '0-0'
+        if not self.reading:
+            self.read()
+
+
+    def unsubscribe(self, room, socket):
+        """
+        Removes the socket from the given chat room and stops reading the
+        room's stream if it was the last local socket in this room.
+        """
+        sockets = self.rooms.get(room)
+        if sockets is None:
+            return
+        sockets.discard(socket)
+        if not sockets:
+            del self.rooms[room]
+            self.cursors.pop(room, None)
+            logging.info('Unsubscribed from chat room ' + room)
+
+
+    def read(self):
+        """
+        Blocks until there are new messages in any chat room or the read
+        times out. Rooms joined meanwhile are read with the next read.
+        """
+        if not self.cursors:
+            self.reading = False
+            return
+        self.reading = True
+        rooms = self.cursors.keys()
+        self.reader.execute_command('XREAD', self.on_read, 'COUNT', self.count,
+                                    'BLOCK', self.block, 'STREAMS',
+                                    *(rooms + [self.cursors[room] for room in rooms]))
+
+
+    def on_read(self, result):
+        """
+        Callback for the blocking read in self.read(). Delivers the messages
+        of each chat room as one frame to every local socket in the room.
+        """
+        if isinstance(result, Exception):
+            logging.error("Error reading new messages: " + str(result))
+            # Wait a moment before trying again.
+            tornado.ioloop.IOLoop.instance().add_timeout(time.time() + 1, self.read)
+            return
+        for room, entries in result or []:
+            # Abort if the room was left meanwhile.
+            if room not in self.cursors or not entries:
+                continue
+            self.cursors[room] = entries[-1][0]
+            # The frames are built once per wire format from the stored JSON-literals.
+            batch = MessageBatch([encode_entry(entry_id, fields) for entry_id, fields in entries])
+            tracing.stages(batch.messages(), 'receive')
+            start = time.time()
+            sockets = list(self.rooms[room])
+            # Iterate over a copy since sockets might be closed while delivering.
+            for socket in sockets:
+                try:
+                    socket.on_messages_published(batch)
+                except:
+                    logging.error("Error delivering message to socket", exc_info=True)
+            metrics.DELIVERED.inc((room,), len(sockets) * len(entries))
+            metrics.FANOUT_SECONDS.observe(time.time() - start, (room,))
+            tracing.stages(batch.messages(), 'deliver')
+        self.read()
+
+
+
+
+class MemoryStore(object):
+    """
+    Keeps each chat room in the memory of this process and fans new messages
+    out to the local sockets of the room directly, without any datastore
+    round trip. Messages are neither shared with other processes nor kept
+    across restarts, so this backend fits single process deployments only.
+    Like the other stores, callbacks are called asynchronously on the IOLoop.
+    """
+    def __init__(self, retention=1000, catchup=50):
+        self.retention = retention
+        self.catchup = catchup
+        # Lists of messages by chat room, oldest first.
+        self.rooms = {}
+        self.subscriber = MemorySubscriber()
+
+
+    def messages(self, room):
+        """
+        Returns the list of all messages of the chat room.
+        """
+        return self.rooms.get(room, [])
+
+
+    def append(self, room, message, callback):
+        """
+        Stores and publishes the message and sets its '_id'. The callback
+        receives None.
+        """
+        # Generate object id as message id.
+        message["_id"] = str(ObjectId())
+        messages = self.rooms.setdefault(room, [])
+        messages.append(message)
+        if len(messages) > self.retention:
+            del messages[:len(messages) - self.retention]
+        io_loop = tornado.ioloop.IOLoop.instance()
+        io_loop.add_callback(functools.partial(self.subscriber.publish, room, message))
+        io_loop.add_callback(functools.partial(callback, None))
+
+
+    def recent(self, room, count, callback):
+        """
+        Loads the list of the latest count messages of the chat room.
+        """
+        recent = self.messages(room)[-count:] if count else []
+        tornado.ioloop.IOLoop.instance().add_callback(functools.partial(callback, recent))
+
+
+    def since(self, room, cursor, callback):
+        """
+        Loads the list of messages newer than the message with the id cursor.
+        Only the latest messages are checked, if the cursor is older all of
+        them are loaded.
+        """
+        recent = newer_than(self.messages(room)[-self.catchup:], cursor)
+        tornado.ioloop.IOLoop.instance().add_callback(functools.partial(callback, recent))
+
+
+    def before(self, room, cursor, position, count, callback):
+        """
+        Loads a page of count messages older than the message with the id
+        cursor. The callback receives a tuple of the messages and the position
+        of the first message from the end of the chat room.
+        """
+        messages = self.messages(room)
+        end = len(messages)
+        if cursor:
+            # Search backwards from the position the client got last.
+            end = None
+            for i in xrange(max(len(messages) - max(position, 1), 0), -1, -1):
+                if messages[i]["_id"] == cursor:
+                    end = i
+                    break
+        if end is None:
+            # The cursor has been trimmed away.
+            result = ([], position)
+        else:
+            page = messages[max(end - count, 0):end]
+            result = (page, len(messages) - end + len(page))
+        tornado.ioloop.IOLoop.instance().add_callback(functools.partial(callback, result))
+
+
+    def subscribe(self, room, socket):
+        """
+        Delivers new messages of the chat room to the socket.
+        """
+        self.subscriber.subscribe(room, socket)
+
+
+    def unsubscribe(self, room, socket):
+        """
+        Stops delivering new messages of the chat room to the socket.
+        """
+        self.subscriber.unsubscribe(room, socket)
+
+
+
+class MemorySubscriber(object):
+    """
+    Index of the local sockets by chat room of a MemoryStore. New messages are
+    fanned out to the sockets of their room as soon as they are stored.
+    """
+    def __init__(self):
+        # Index of chat rooms mapping to the set of local sockets in the room.
+        self.rooms = {}
+
+
+    def subscribe(self, room, socket):
+        """
+        Adds the socket to the given chat room.
+        """
+        self.rooms.setdefault(room, set()).add(socket)
+
+
+    def unsubscribe(self, room, socket):
+        """
+        Removes the socket from the given chat room.
+        """
+        sockets = self.rooms.get(room)
+        if sockets is None:
+            return
+        sockets.discard(socket)
+        if not sockets:
+            del self.rooms[room]
+
+
+    def publish(self, room, message):
+        """
+        Delivers the message to every local socket in the chat room.
+        """
+        sockets = self.rooms.get(room)
+        if not sockets:
+            return
+        tracing.stage(message, 'receive')
+        batch = MessageBatch([tornado.escape.json_encode(message)])
+        start = time.time()
+        sockets = list(sockets)
+        # Iterate over a copy since sockets might be closed while delivering.
+        for socket in sockets:
+            try:
+                socket.on_messages_published(batch)
+            except:
+                logging.error("Error delivering message to socket", exc_info=True)
+        metrics.DELIVERED.inc((room,), len(sockets))
+        metrics.FANOUT_SECONDS.observe(time.time() - start, (room,))
+        tracing.stage(message, 'deliver')
@@ -0,0 +1,41 @@
+# coding=UTF-8
+
+# General modules.
+import unittest
+
+# Tornado modules.
+import tornado.escape
+
+# Import application modules.
+from store import decode_entries
+from store import encode_entry
+
+
+
+class EncodeEntryTest(unittest.TestCase):
+    """
+    The id of a stream entry is the message id, whether or not the stored
+    message has an '_id' of its own.
+    """
+    def test_adds_entry_id(self):
+        fields = ['m', tornado.escape.json_encode({'from': 'Ann', 'body': 'hi'})]
+        message = tornado.escape.json_decode(encode_entry('1-0', fields))
+        self.assertEqual(message, {'_id': '1-0', 'from': 'Ann', 'body': 'hi'})
+
+
+    def test_replaces_stored_id(self):
+        stored = {'_id': '5f0c2b3a9d1e8f0001a2b3c4', 'from': 'Ann', 'body': 'hi'}
+        literal = encode_entry('1526919030474-0', ['m', tornado.escape.json_encode(stored)])
+        self.assertEqual(literal.count('"_id"'), 1)
+        self.assertEqual(tornado.escape.json_decode(literal)['_id'], '1526919030474-0')
+
+
+    def test_matches_decode_entries(self):
+        fields = ['m', tornado.escape.json_encode({'_id': 'old', 'from': 'Ann', 'body': 'hi'})]
+        self.assertEqual([tornado.escape.json_decode(encode_entry('2-0', fields))],
+                         decode_entries([('2-0', fields)]))
+
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+# coding=UTF-8
+
+# General modules.
+import unittest
+
+# Tornado modules.
+import tornado.escape
+
+# Import application modules.
+from wire import JSONCodec
+from wire import MessageBatch
+from wire import MsgpackCodec
+from wire import msgpack
+
+
+
+@unittest.skipIf(msgpack is None, "msgpack is not installed")
+class MsgpackCodecTest(unittest.TestCase):
+    """
+    Frames encoded with MessagePack must decode to the same values as the
+    JSON frames, with text as strings, so the client can compare them.
+    """
+    def setUp(self):
+        self.codec = MsgpackCodec()
+
+
+    def test_encode_packs_byte_strings_as_text(self):
+        frame = self.codec.encode({'error': 1, 'textStatus': 'unauthorized'})
+        decoded = self.codec.decode(frame)
+        self.assertEqual(decoded, {u'error': 1, u'textStatus': u'unauthorized'})
+        self.assertIsInstance(decoded[u'textStatus'], unicode)
+
+
+    def test_encode_packs_acks_and_presence_as_text(self):
+        value = {'ack': 'a1b2c3', 'presence': {'count': 2, 'members': ['Ann', u'Jürgen']}}
+        decoded = self.codec.decode(self.codec.encode(value))
+        self.assertIsInstance(decoded[u'ack'], unicode)
+        self.assertEqual(decoded[u'presence'][u'members'], [u'Ann', u'Jürgen'])
+        for name in decoded[u'presence'][u'members']:
+            self.assertIsInstance(name, unicode)
+
+
+    def test_batch_matches_json(self):
+        message = {'_id': '5f0c', 'from': 'Ann', 'body': u'Grüße'}
+        batch = MessageBatch([tornado.escape.json_encode(message)])
+        decoded = self.codec.decode(batch.frame(self.codec))
+        self.assertEqual(decoded, JSONCodec().decode(batch.frame(JSONCodec())))
+        for value in decoded[u'messages'][0].values():
+            self.assertIsInstance(value, unicode)
+
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+# coding=UTF-8
+
+# Tornado modules.
+import tornado.escape
+
+# MessagePack is optional, without it clients are served JSON only.
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+
+class JSONCodec(object):
+    """
+    Encodes frames as JSON text frames. A batch of messages looks like this:
+    {"messages": [...]}
+    """
+    name = 'json'
+    binary = False
+
+    def item(self, literal):
+        """
+        Returns the encoding of one message from its JSON-literal.
+        """
+        return tornado.escape.utf8(literal)
+
+
+    def batch(self, items):
+        """
+        Returns the frame of a batch of encoded messages.
+        """
+        return '{"messages": [' + ','.join(items) + ']}'
+
+
+    def encode(self, value):
+        return tornado.escape.utf8(tornado.escape.json_encode(value))
+
+
+    def decode(self, data):
+        return tornado.escape.json_decode(data)
+
+
+
+class MsgpackCodec(JSONCodec):
+    """
+    Encodes frames as MessagePack binary frames with the same structure as
+    the JSON frames. A batch frame is concatenated from the encoded messages
+    behind a map and array header, so batches are built without re-encoding
+    the messages.
+    """
+    name = 'msgpack'
+    binary = True
+
+    def __init__(self):
+        # Byte strings are text here, like the textStatus of errors, ids and
+        # user names, so they are packed as str and not as bin. Otherwise the
+        # client would get them as byte arrays instead of strings.
+        self.packer = msgpack.Packer(use_bin_type=False)
+        # Map header and key of a batch frame.
+        self.prefix = self.packer.pack_map_header(1) + self.packer.pack(u'messages')
+
+
+    def item(self, literal):
+        return self.packer.pack(tornado.escape.json_decode(literal))
+
+
+    def batch(self, items):
+        return self.prefix + self.packer.pack_array_header(len(items)) + ''.join(items)
+
+
+    def encode(self, value):
+        return self.packer.pack(value)
+
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+# Codecs by the name of their websocket subprotocol in order of preference.
+CODECS = [MsgpackCodec(), JSONCodec()] if msgpack else [JSONCodec()]
+JSON = CODECS[-1]
+
+
+
+class MessageBatch(object):
+    """
+    Messages published at once in a chat room. The messages are stored as
+    JSON-literals and encoded at most once per codec for all sockets of the
+    room, no matter how many sockets use that codec.
+    """
+    def __init__(self, literals):
+        self.literals = literals
+        # Encoded messages and frames by codec name.
+        self.encoded = {}
+        self.decoded = None
+
+
+    def messages(self):
+        """
+        Returns the list of decoded messages, decoded once for all callers.
+        """
+        if self.decoded is None:
+            self.decoded = [tornado.escape.json_decode(literal) for literal in self.literals]
+        return self.decoded
+
+
+    def items(self, codec):
+        """
+        Returns the list of messages encoded with the given codec.
+        """
+        encoded = self.encoded.get(codec.name)
+        if encoded is None:
+            items = [codec.item(literal) for literal in self.literals]
+            encoded = self.encoded[codec.name] = (items, codec.batch(items))
+        return encoded[0]
+
+
+    def frame(self, codec):
+        """
+        Returns the frame of the batch encoded with the given codec.
+        """
+        self.items(codec)
+        return self.encoded[codec.name][1]
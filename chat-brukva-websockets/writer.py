@@ -0,0 +1,111 @@
+# coding=UTF-8
+
+# General modules.
+import logging
+
+# Tornado modules.
+import tornado.ioloop
+
+# Import application modules.
+import metrics
+
+
+
+class MessageWriter(object):
+    """
+    Stores and publishes new messages in Redis. Appending a message to its
+    chat room, trimming the room to the retention limit and publishing the
+    message are sent as one MULTI/EXEC transaction in a single round trip.
+    Messages arriving within the same IOLoop iteration are coalesced into one
+    pipelined transaction while every sender still gets its own callback.
+    """
+    # Number of commands queued per message.
+    commands = 3
+
+    def __init__(self, client, retention=1000):
+        self.client = client
+        self.retention = retention
+        # Messages waiting for the next flush as (room, message, callback).
+        self.pending = []
+
+
+    def write(self, room, message_encoded, callback):
+        """
+        Queues the JSON-encoded message for the given chat room. The callback
+        receives None and the replies of the message's commands on success or
+        the exception and None if writing failed.
+        """
+        if not self.pending:
+            tornado.ioloop.IOLoop.instance().add_callback(self.flush)
+        self.pending.append((room, message_encoded, callback))
+
+
+    def flush(self):
+        """
+        Sends all pending messages in one transaction.
+        """
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        try:
+            pipe = self.client.pipeline(transactional=True)
+            for room, message_encoded, callback in batch:
+                self.queue(pipe, room, message_encoded)
+        except Exception, err:
+            self.on_executed(batch, err)
+            return
+        pipe.execute(metrics.timed('pipeline', lambda result: self.on_executed(batch, result)))
+
+
+    def queue(self, pipe, room, message_encoded):
+        """
+        Adds the commands for writing one message to the pipeline.
+        """
+        # Persistently store message.
+        pipe.rpush(room, message_encoded)
+        # Drop the oldest messages beyond the retention limit.
+        pipe.ltrim(room, -self.retention, -1)
+        # Publish message.
+        pipe.publish(room, message_encoded)
+
+
+    def on_executed(self, batch, result):
+        """
+        Callback for the transaction sent in self.flush(). Acknowledges every
+        message of the batch individually.
+        """
+        if isinstance(result, Exception):
+            logging.error("Error writing messages: " + str(result))
+        for i in xrange(len(batch)):
+            room, message_encoded, callback = batch[i]
+            error = None
+            replies = None
+            if isinstance(result, Exception):
+                error = result
+            else:
+                replies = result[self.commands * i:self.commands * (i + 1)]
+                for reply in replies:
+                    if isinstance(reply, Exception):
+                        error = reply
+                        replies = None
+                        break
+            try:
+                callback(error, replies)
+            except:
+                logging.error("Error in writer callback", exc_info=True)
+
+
+
+class StreamWriter(MessageWriter):
+    """
+    Writes new messages to the Redis Stream of their chat room. Appending and
+    trimming is one XADD command, whose reply is the id of the new entry.
+    """
+    commands = 1
+
+    def queue(self, pipe, room, message_encoded):
+        """
+        Adds the command for writing one message to the pipeline.
+        """
+        pipe.execute_command('XADD', None, room, 'MAXLEN', '~', self.retention,
+                             '*', 'm', message_encoded)
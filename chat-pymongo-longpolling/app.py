@@ -1,15 +1,20 @@
 # coding=UTF-8
 
 # General modules.
+import functools
 import os.path
 import logging
+import math
+import time
 
 # Tornado modules.
 import tornado.ioloop
 import tornado.web
 import tornado.auth
 import tornado.options
+import tornado.template
 import tornado.escape
+from tornado import gen
 
 # MongoDb modules.
 import pymongo
@@ -19,9 +24,73 @@ from bson.objectid import ObjectId
 from base import BaseHandler
 from auth import LoginHandler
 from auth import LogoutHandler
+from assets import AssetHandler
+from assets import Assets
+from buffer import MessageBuffers
+from cache import LRUCache
+from executor import Executor
+from fragments import FragmentCache
+import metrics
+from metrics import MetricsHandler
+from ratelimit import RateLimiter
+from ratelimit import slow_down
+from relay import MessageRelay
+from server import serve
+from startup import ReadyHandler
+from startup import Startup
+from startup import precompile
+from timerwheel import TimerWheel
+import tracing
+from waiters import WaiterRegistry
 
 # Define port from command line parameter.
 tornado.options.define("port", default=8888, help="run on the given port", type=int)
+# Define how many processes serve the application and how they listen.
+tornado.options.define("processes", default=1,
+                       help="number of worker processes, 0 for one per CPU", type=int)
+tornado.options.define("reuse_port", default=False,
+                       help="bind a socket per worker with SO_REUSEPORT instead of sharing one", type=bool)
+tornado.options.define("unix_socket", default=None,
+                       help="path of an additional unix socket to listen on, e.g. for a local proxy")
+# Define where chat rooms are stored.
+tornado.options.define("backend", default="mongo",
+                       help="room backend: mongo (capped collection) or memory (this process only)")
+tornado.options.define("relay", default=False,
+                       help="tail the conversation for messages posted by other processes or nodes", type=bool)
+# Define the server-side deadline of long polling requests.
+tornado.options.define("poll_timeout", default=45,
+                       help="seconds a long polling request waits before it is answered without messages", type=int)
+tornado.options.define("poll_jitter", default=10,
+                       help="maximum random seconds added to the poll timeout", type=int)
+# Define the number of latest messages shown when loading a chat room.
+tornado.options.define("history_size", default=50,
+                       help="number of latest messages shown when loading a chat room", type=int)
+# Define size and lifetime of the in-process user cache.
+tornado.options.define("user_cache_size", default=10000,
+                       help="maximum number of cached user objects", type=int)
+tornado.options.define("user_cache_ttl", default=60,
+                       help="seconds a cached user object is valid", type=int)
+# Define the number of recent messages kept in memory per chat room. These are
+# all messages kept by the memory backend.
+tornado.options.define("buffer_size", default=50,
+                       help="number of recent messages buffered per chat room, at least 1", type=int)
+# Define how fast users can post and how many messages a chat room takes.
+tornado.options.define("user_rate", default=1.0,
+                       help="messages per second a user can post on average, 0 for unlimited", type=float)
+tornado.options.define("user_burst", default=5,
+                       help="messages a user can post at once", type=int)
+tornado.options.define("room_rate", default=20.0,
+                       help="messages per second a chat room takes on average, 0 for unlimited", type=float)
+tornado.options.define("room_burst", default=50,
+                       help="messages a chat room takes at once", type=int)
+# Define the fraction of messages whose latency per stage is logged.
+tornado.options.define("trace_sample", default=0.0,
+                       help="fraction of messages traced in the log from ingest to delivery", type=float)
+# Define the threads running the blocking PyMongo calls.
+tornado.options.define("executor_threads", default=8,
+                       help="threads running blocking MongoDB calls", type=int)
+tornado.options.define("executor_queue", default=1000,
+                       help="MongoDB calls waiting for a thread before failing with 503", type=int)
 
 
 
@@ -34,15 +103,17 @@ class MainHandler(BaseHandler):
             self.redirect("/login")
             return
         user = self.current_user
-        # Render Stored Messages
-        content = self.render_string("messages.html", 
-                                 messages=list(self.db.conversation.find()))
+        # Render latest messages from the buffer. Only messages not rendered
+        # before need to be rendered.
+        messages = self.application.buffers['conversation'].recent(
+                                        tornado.options.options.history_size)
+        history = self.application.fragments.render('conversation', messages)
+        content = self.render_string("messages.html", history=history)
         self.render_default("index.html", content=content, chat=1)
         
     
 
 class MessageHandler(BaseHandler):
-    waiters = set()
 
     @tornado.web.asynchronous
     def get(self):
@@ -60,29 +131,75 @@ class MessageHandler(BaseHandler):
         try:
             # Get cursor form request body.
             cursor = self.get_argument("cursor", None)
+            # Validate cursor to be a message id.
+            if cursor:
+                ObjectId(cursor)
         except:
             # Send an error back to client.
             self.finish({'error': 1, 'textStatus': 'Bad input data'})
             return;
         
         # Check if there are new messages.
-        # @todo: Bad, bad performance loading all items each request!
-        messages = list(self.db.conversation.find())
-        # Stringify _id.
-        for i in xrange(len(messages)):
-            messages[i]["_id"] = str(messages[i]["_id"])
-        
-        # Find current message.
+        recent = None
         if cursor:
-            index = 0
-            for i in xrange(len(messages)):
-                index = len(messages) - i - 1
-                if messages[index]["_id"] == cursor: break
-            recent = messages[index + 1:]
-            if recent:
-                self.on_new_messages(recent)
+            buffer = self.application.buffers['conversation']
+            recent = buffer.since(cursor)
+            if recent is None and self.application.memory:
+                # The cursor has been dropped from memory, so send everything.
+                recent = buffer.recent(len(buffer.messages))
+            if recent is None:
+                # The cursor is older than the buffer, so ask MongoDB on the
+                # executor. Remember the position of the buffer to catch
+                # messages delivered meanwhile.
+                future = self.application.executor.submit('find', self.find_since, cursor)
+                tornado.ioloop.IOLoop.instance().add_future(
+                    future, functools.partial(self.on_found, buffer.next))
                 return
-        MessageHandler.waiters.add(self.on_new_messages)
+        self.wait(recent)
+        
+    
+    def on_found(self, mark, future):
+        """
+        Callback for the messages found by self.find_since() in self.get().
+        mark - position of the buffer when the query was submitted.
+        """
+        # Closed client connection
+        if self.request.connection.stream.closed():
+            return
+        recent = future.result()
+        # Add messages delivered while waiting for MongoDB if not found already.
+        buffer = self.application.buffers['conversation']
+        ids = set([message["_id"] for message in recent])
+        for message in buffer.recent(buffer.next - mark):
+            if message["_id"] not in ids:
+                recent.append(message)
+        self.wait(recent)
+        
+    
+    def wait(self, recent):
+        """
+        Answers with the recent messages if there are any, otherwise parks
+        the request until the next message or its deadline.
+        """
+        if recent:
+            self.on_new_messages(recent)
+            return
+        # Wait for the next message in this chat room.
+        self.application.waiters.add('conversation', self, self.on_new_messages)
+        # Answer without messages if none arrive before the deadline.
+        self.application.deadlines.add(self, self.on_poll_timeout)
+        
+    
+    def find_since(self, cursor):
+        """
+        Returns the messages newer than the cursor from MongoDB. Runs on the
+        executor.
+        """
+        messages = list(self.db.conversation.find({'_id': {'$gt': ObjectId(cursor)}}))
+        # Stringify _id.
+        for message in messages:
+            message["_id"] = str(message["_id"])
+        return messages
         
         
     def on_new_messages(self, messages):
@@ -90,22 +207,40 @@ class MessageHandler(BaseHandler):
         Callback called by get() when new message is available.
         messages - a list of message object that are new to the waiter.
         """
+        self.application.deadlines.remove(self)
         # Closed client connection
         if self.request.connection.stream.closed():
             logging.warning("Waiter disappeared")
             return
         # Send messages to client and finish connection.
+        metrics.DELIVERED.inc(('conversation',), len(messages))
         self.finish(dict(messages=messages))
-
+        tracing.stages(messages, 'deliver')
+        
+    
+    def on_poll_timeout(self):
+        """
+        Called by the timer wheel when the deadline of this request passed.
+        The client polls again right away after the empty response.
+        """
+        self.application.waiters.remove('conversation', self)
+        # Closed client connection
+        if self.request.connection.stream.closed():
+            return
+        self.finish(dict(messages=[]))
+        
+    
     def on_connection_close(self):
         """
         Called when connection closed.
         """
-        # Remove waiter.
-        MessageHandler.waiters.discard(self.on_new_messages)
-        logging.info("Removed one waiter")
+        # Remove waiter and its deadline.
+        self.application.deadlines.remove(self)
+        if self.application.waiters.remove('conversation', self):
+            logging.info("Removed one waiter")
         
     
+    @gen.coroutine
     def post(self):
         """
         Handles post request for creating new posts.
@@ -130,25 +265,34 @@ class MessageHandler(BaseHandler):
             self.write({'error': 1, 'textStatus': 'Bad input data'})
             return;
         
-        # Save message.
+        # Reject the message if the user or the chat room is too fast.
+        retry_after = self.application.ratelimit.acquire(self.get_secure_cookie("user"), 'conversation')
+        if retry_after:
+            self.set_header("Retry-After", int(math.ceil(retry_after)))
+            self.write(slow_down(retry_after))
+            return;
+        
+        metrics.INGESTED.inc(('conversation',))
+        tracing.stamp(message)
+        # Save message unless chat rooms are kept in memory only.
         try:
-            self.db.conversation.insert(message, safe=True)
-            # Stringify _id.
-            message["_id"] = str(message["_id"])
+            if self.application.memory:
+                message["_id"] = str(ObjectId())
+            else:
+                # Insert on the executor, PyMongo blocks until MongoDB
+                # acknowledged the write.
+                yield self.application.executor.submit('insert', self.db.conversation.insert,
+                                                       message, safe=True)
+                # Stringify _id.
+                message["_id"] = str(message["_id"])
+                tracing.stage(message, 'persist')
         except:
             # Send an error back to client.
             self.write({'error': 1, 'textStatus': 'Error writing to database'})
             return;
         
-        # Inform waiters about new message.
-        # Waiters are stored in a class attribute.
-        for waiter in MessageHandler.waiters:
-            try: # Send message to waiter.
-                waiter(messages=[message])
-            except:
-                logging.error("Error in waiter callback", exc_info=True)
-        # Reset cache. 
-        MessageHandler.waiters = set()
+        # Buffer and render message and inform waiters about it.
+        self.application.deliver(message)
         
         # Send message to indicate a successful operation.
         message['_id'] = str(message['_id']) # Stringify id.
@@ -163,20 +307,34 @@ class Application(tornado.web.Application):
     """
     def __init__(self):
         
+        # Build the fingerprinted and precompressed static assets, served at /assets/.
+        static_path = os.path.join(os.path.dirname(__file__), "static")
+        self.assets = Assets(static_path, os.path.join(os.path.dirname(__file__), "build"))
+        self.assets.build()
+        
+        # Templates are compiled into this loader at startup.
+        template_path = os.path.join(os.path.dirname(__file__), "templates")
+        self.template_loader = tornado.template.Loader(template_path, autoescape="xhtml_escape")
+        
         # Handlers defining the url routing.
         handlers = [
             (r"/", MainHandler),
             (r"/login", LoginHandler),
             (r"/logout", LogoutHandler),
             (r"/message", MessageHandler),
+            (r"/ready", ReadyHandler),
+            (r"/metrics", MetricsHandler),
+            (r"/assets/(.*)", AssetHandler, {"path": self.assets.build_path}),
         ]
         
         # Settings:
         settings = dict(
             cookie_secret = "43osdETzKXasdQAGaYdkL5gEmGeJJFuYh7EQnp2XdTP1o/Vo=",
             login_url = "/login",
-            template_path=os.path.join(os.path.dirname(__file__), "templates"),
-            static_path=os.path.join(os.path.dirname(__file__), "static"),
+            template_path=template_path,
+            template_loader=self.template_loader,
+            static_path=static_path,
+            ui_methods=self.assets.ui_methods(),
             xsrf_cookies= True,
             autoescape="xhtml_escape",
             # Set this to your desired database name.
@@ -188,23 +346,164 @@ class Application(tornado.web.Application):
         # Call super constructor.
         tornado.web.Application.__init__(self, handlers, **settings)
         
+        # Cache user objects to resolve the user cookie without a database
+        # round trip on every request.
+        self.user_cache = LRUCache(tornado.options.options.user_cache_size,
+                                   tornado.options.options.user_cache_ttl)
+        
+        # Cache the rendered latest messages of each chat room.
+        self.fragments = FragmentCache(self.settings["template_path"],
+                                       tornado.options.options.history_size)
+        
+        # Expire parked long polling requests before the client gives up.
+        self.deadlines = TimerWheel(tornado.options.options.poll_timeout,
+                                    tornado.options.options.poll_jitter)
+        
+        # The database is connected in the startup phase 'datastore'.
+        self.db = None
+        # PyMongo blocks, so its calls run on these threads and the IOLoop
+        # gets their results as Futures.
+        self.executor = Executor(tornado.options.options.executor_threads,
+                                 tornado.options.options.executor_queue)
+        
+        # Keep the latest messages of each chat room in memory so polling
+        # clients can be served without querying MongoDB.
+        self.buffers = MessageBuffers(tornado.options.options.buffer_size)
+        # Index of the parked long polling requests by chat room.
+        self.waiters = WaiterRegistry()
+        # The memory backend keeps chat rooms in the buffers only and uses
+        # MongoDB for the users.
+        options = tornado.options.options
+        self.memory = options.backend == "memory"
+        
+        # Limit the rate of messages per user and chat room in this process.
+        self.ratelimit = RateLimiter(options.user_rate, options.user_burst,
+                                     options.room_rate, options.room_burst)
+        
+        # Log the stages of a sample of the messages.
+        tracing.sample_rate = tornado.options.options.trace_sample
+        
+        # Expose the state of this process at /metrics. These values are read
+        # when scraped.
+        self.metrics = metrics.registry
+        self.metrics.gauge('chat_parked_polls', 'Long polling requests waiting for messages by chat room.',
+                           ['room'], lambda: dict([((room,), count) for room, count
+                                                   in self.waiters.counts().iteritems()]))
+        self.metrics.counter('chat_user_lookups_total',
+                             'User lookups by cache result, misses query the datastore.', ['result'],
+                             lambda: {('hit',): self.user_cache.hits, ('miss',): self.user_cache.misses})
+        self.metrics.gauge('chat_executor_queued', 'Blocking MongoDB calls waiting for a thread.',
+                           callback=self.executor.queued)
+        self.metrics.gauge('chat_executor_running', 'Blocking MongoDB calls running on a thread.',
+                           callback=self.executor.running)
+        
+        # Warm up this process before it takes traffic, /ready tells load
+        # balancers when it is done.
+        self.startup = Startup()
+        self.startup.add_blocking('templates', lambda: precompile(self.template_loader, template_path))
+        self.startup.add('datastore', self.on_executor('connect', self.connect))
+        self.startup.add('rooms', self.warm_rooms)
+        tornado.ioloop.IOLoop.instance().add_callback(self.startup.run)
+        
+    
+    def on_executor(self, command, function):
+        """
+        Returns a startup phase running the blocking function on the
+        executor.
+        """
+        def phase(callback):
+            future = self.executor.submit(command, function)
+            future.add_done_callback(lambda future: callback(future.exception()))
+        return phase
+        
+    
+    def connect(self):
         """
+        Startup phase connecting to MongoDB and creating the chat room
+        collection if needed. Runs on the executor.
+        
         We create a database connection using PyMongo, which is not an
-        asynchronous driver. To to avoid blocking the event loop we follow
-        the following rules:
+        asynchronous driver. To to avoid blocking the event loop its calls
+        run on the threads of the executor, which share the connection:
         http://api.mongodb.org/python/current/faq.html#does-pymongo-support-asynchronous-frameworks-like-gevent-tornado-or-twisted
         """
-        # Configure your MongoDB connection.
-        connection = pymongo.Connection('localhost', 27017)
+        # Configure your MongoDB connection, one socket per executor thread.
+        connection = pymongo.Connection('localhost', 27017,
+                                        max_pool_size=tornado.options.options.executor_threads)
         # Choose your database for this application.
-        self.db = connection['chat']
+        db = connection['chat']
+        # Check the connection before the process takes traffic.
+        db.command('ping')
         # Create collection 'conversation' manually to make it a fixed size
         # capped collection with the natural order being the one order of
         # insertion.
-        if not "conversation" in self.db.collection_names():
+        if not "conversation" in db.collection_names():
             logging.info("Creating capped collection 'conversation'")
-            pymongo.collection.Collection(self.db, "conversation", create=True, 
+            pymongo.collection.Collection(db, "conversation", create=True, 
                                           capped=True, size=20480, max=50)
+        self.db = db
+        
+    
+    @gen.coroutine
+    def warm_rooms(self, callback):
+        """
+        Startup phase loading the latest messages on the executor.
+        """
+        try:
+            messages = []
+            if not self.memory:
+                messages = yield self.executor.submit('find', lambda: list(self.db.conversation.find()))
+            self.fill_rooms(messages)
+        except Exception, err:
+            callback(err)
+        else:
+            callback()
+        
+    
+    def fill_rooms(self, messages):
+        """
+        Puts the latest messages into the buffer and renders them, so the
+        first polls and page loads are served from memory. Then starts
+        tailing the capped collection from the latest message.
+        """
+        options = tornado.options.options
+        latest = None
+        for message in messages:
+            latest = message["_id"]
+            # Stringify _id.
+            message["_id"] = str(message["_id"])
+            self.buffers['conversation'].append(message)
+        self.fragments.render('conversation',
+                              self.buffers['conversation'].recent(options.history_size))
+        
+        # Other processes only learn about a message by tailing the capped
+        # collection, so this is required when running multiple processes.
+        if self.memory:
+            if options.processes != 1:
+                logging.warning("Chat rooms of the memory backend are not shared between processes")
+        elif options.relay or options.processes != 1:
+            self.relay = MessageRelay(self.db.conversation, latest, self.deliver)
+            self.relay.start()
+        
+    
+    def deliver(self, message):
+        """
+        Remembers a new message in the buffer of recent messages, renders it
+        for the next page loads and informs waiters about it. Messages are
+        delivered by the posting handler and again by the relay, so messages
+        already buffered are ignored.
+        """
+        buffer = self.buffers['conversation']
+        if message["_id"] in buffer.index:
+            return
+        tracing.stage(message, 'receive')
+        buffer.append(message)
+        self.fragments.append('conversation', message)
+        
+        # Inform the waiters of this chat room about new message.
+        start = time.time()
+        self.waiters.notify('conversation', [message])
+        metrics.FANOUT_SECONDS.observe(time.time() - start, ('conversation',))
 
 
 
@@ -214,11 +513,11 @@ def main():
     """
      # This line will setup default options.
     tornado.options.parse_command_line()
-    # Create an instance of the main application.
-    application = Application()
-    # Start application by listening to desired port and starting IOLoop.
-    application.listen(tornado.options.options.port)
-    tornado.ioloop.IOLoop.instance().start()
+    # Start the application in the desired number of processes by listening
+    # to desired port and starting IOLoop.
+    options = tornado.options.options
+    serve(Application, options.port, processes=options.processes,
+          reuse_port=options.reuse_port, unix_socket=options.unix_socket)
     
 
 if __name__ == "__main__":
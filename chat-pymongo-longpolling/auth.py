@@ -2,6 +2,7 @@
 
 # Tornado modules.
 import tornado.web
+from tornado import gen
 
 # MongoDb modules.
 import pymongo
@@ -68,6 +69,7 @@ class LoginHandler(BaseHandler, tornado.auth.GoogleMixin):
             + '</form>')
             self.render_default("index.html", content=content)
 
+    @gen.engine
     def _on_auth(self, user):
         """
         Callback for third party authentication (last step).
@@ -80,26 +82,36 @@ class LoginHandler(BaseHandler, tornado.auth.GoogleMixin):
             + '<p>This might be due to a problem in Tornados GoogleMixin.</p>'
             + '</div>')
             self.render_default("index.html", content=content)
-            return None
+            return
         
         # @todo: Validate user data.
         # Save user when authentication was successful.
-        dbuser = self.db.users.find_one({"email": user["email"]})
-        if dbuser == None:
-            # If user does not exist, create a new entry.
-            self.db.users.insert(user)
-        else:
-            # Update existing user.
-            # @todo: Should use $set to update only needed attributes?
-            dbuser.update(user)
-            user = dbuser
-            self.db.users.save(user)
-            
+        user = yield self.application.executor.submit('save_user', self.save_user, user)
+        
+        # Drop the outdated user object from the cache.
+        self.application.user_cache.invalidate(str(user["_id"]))
         # Save user id in cookie.
         user["_id"] = str(user["_id"])
         self.set_secure_cookie("user", user["_id"])
         self.redirect("/")
         
+    
+    def save_user(self, user):
+        """
+        Creates the user or updates the existing user with the same email
+        and returns it. Runs on the executor.
+        """
+        dbuser = self.db.users.find_one({"email": user["email"]})
+        if dbuser == None:
+            # If user does not exist, create a new entry.
+            self.db.users.insert(user)
+            return user
+        # Update existing user.
+        # @todo: Should use $set to update only needed attributes?
+        dbuser.update(user)
+        self.db.users.save(dbuser)
+        return dbuser
+        
 
 
 class LogoutHandler(BaseHandler):
@@ -3,11 +3,15 @@ import tornado.web
 
 # Tornado modules.
 import tornado.web
+from tornado import gen
 
 # MongoDb modules.
 import pymongo
 from bson.objectid import ObjectId
 
+# Import application modules.
+from executor import ExecutorFull
+
 
 class BaseHandler(tornado.web.RequestHandler):
     """
@@ -21,15 +25,41 @@ class BaseHandler(tornado.web.RequestHandler):
         # Call super constructor.
         tornado.web.RequestHandler.__init__(self, application, request, **kwargs)
         
-    def get_current_user(self):
+    @gen.coroutine
+    def prepare(self):
+        # Answer with 503 until the startup phases are done, the datastore
+        # may not be connected yet.
+        if not self.application.startup.ready:
+            self.set_status(503)
+            self.set_header("Retry-After", "1")
+            self.finish()
+            return
+        # Load the user before the request is handled, so current_user
+        # never blocks.
+        self._current_user = yield self.load_current_user()
+        
+    @gen.coroutine
+    def load_current_user(self):
         """
         Returns the user object of the current session or None for anonymous.
         """
         user_id = self.get_secure_cookie("user")
-        if not user_id: return None
-        # Load json based on cookie data.
-        user = self.db.users.find_one({'_id': ObjectId(user_id)})
-        return user
+        if not user_id: raise gen.Return(None)
+        # Serve the user object from the cache if possible.
+        user = self.application.user_cache.get(user_id)
+        if user is not None: raise gen.Return(user)
+        # Load the user on the executor, PyMongo blocks.
+        user = yield self.application.executor.submit('find_one', self.db.users.find_one,
+                                                      {'_id': ObjectId(user_id)})
+        if user: self.application.user_cache.set(user_id, user)
+        raise gen.Return(user)
+    
+    def send_error(self, status_code=500, **kwargs):
+        # A saturated executor is not an error of MongoDB, the client may retry.
+        exc_info = kwargs.get('exc_info')
+        if exc_info is not None and isinstance(exc_info[1], ExecutorFull):
+            status_code = 503
+        tornado.web.RequestHandler.send_error(self, status_code, **kwargs)
     
     def render_default(self, template_name, **kwargs):
         # Set default variables and render template.
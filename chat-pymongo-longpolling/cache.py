@@ -0,0 +1,59 @@
+# coding=UTF-8
+
+# General modules.
+import collections
+import time
+
+
+
+class LRUCache(object):
+    """
+    A bounded in-process cache dropping the least recently used entry when it
+    is full. Entries expire ttl seconds after they were set. Hits and misses
+    are counted, see stats().
+    """
+    def __init__(self, size=10000, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        # Maps keys to (expiry time, value) in order of last use.
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, key):
+        """
+        Returns the value cached for key or None if missing or expired.
+        """
+        entry = self.entries.pop(key, None)
+        if entry is None or entry[0] < time.time():
+            self.misses += 1
+            return None
+        # Re-insert entry to mark it as most recently used.
+        self.entries[key] = entry
+        self.hits += 1
+        return entry[1]
+
+
+    def set(self, key, value):
+        """
+        Caches value for key and drops the least recently used entry if full.
+        """
+        self.entries.pop(key, None)
+        self.entries[key] = (time.time() + self.ttl, value)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+    def invalidate(self, key):
+        """
+        Removes the entry for key, e.g. after the cached object was updated.
+        """
+        self.entries.pop(key, None)
+
+
+    def stats(self):
+        """
+        Returns a dict with the number of entries, hits and misses.
+        """
+        return dict(entries=len(self.entries), hits=self.hits, misses=self.misses)
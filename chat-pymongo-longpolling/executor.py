@@ -0,0 +1,118 @@
+# coding=UTF-8
+
+# General modules.
+import functools
+import Queue
+import sys
+import threading
+import time
+
+# Tornado modules.
+import tornado.concurrent
+import tornado.ioloop
+
+# Import application modules.
+import metrics
+
+
+QUEUE_SECONDS = metrics.registry.histogram('chat_executor_queue_seconds',
+                                           'Time blocking datastore calls waited for a thread.',
+                                           ['command'])
+REJECTED = metrics.registry.counter('chat_executor_rejected_total',
+                                    'Blocking datastore calls rejected because too many were waiting.',
+                                    ['command'])
+
+
+
+class ExecutorFull(Exception):
+    """
+    Raised if too many calls are waiting for a thread of the executor.
+    """
+
+
+
+class Executor(object):
+    """
+    Runs blocking calls like those of PyMongo on a fixed number of threads,
+    so they do not block the IOLoop. submit() returns a Future which is
+    resolved on the IOLoop thread, handlers can yield it in a coroutine. At
+    most max_queue calls wait for a thread, more fail with ExecutorFull
+    instead of piling up behind a slow datastore. The time a call waited and
+    its execution time, as datastore latency, are recorded on the IOLoop
+    thread as well, so the metrics are never touched by the threads.
+    """
+    def __init__(self, threads=8, max_queue=1000):
+        self.max_queue = max_queue
+        self.queue = Queue.Queue()
+        # Calls submitted and not resolved yet, only changed on the IOLoop.
+        self.pending = 0
+        # Grab the IOLoop now, IOLoop.instance() is not meant for other threads.
+        self.io_loop = tornado.ioloop.IOLoop.instance()
+        self.threads = []
+        for i in range(threads):
+            thread = threading.Thread(target=self.work, name="executor-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+
+    def submit(self, command, function, *args, **kwargs):
+        """
+        Calls the function with the arguments on a thread and returns a
+        Future of its result. The command names the call in the metrics.
+        """
+        future = tornado.concurrent.TracebackFuture()
+        if self.queue.qsize() >= self.max_queue:
+            REJECTED.inc((command,))
+            future.set_exception(ExecutorFull("%d calls are waiting for a thread" % self.queue.qsize()))
+            return future
+        self.pending += 1
+        metrics.DATASTORE_IN_FLIGHT.inc((command,))
+        self.queue.put((command, function, args, kwargs, future, time.time()))
+        return future
+
+
+    def work(self):
+        """
+        Runs the calls of the queue forever. Runs on the threads.
+        """
+        while True:
+            command, function, args, kwargs, future, submitted = self.queue.get()
+            start = time.time()
+            result = exc_info = None
+            try:
+                result = function(*args, **kwargs)
+            except Exception:
+                exc_info = sys.exc_info()
+            self.io_loop.add_callback(functools.partial(self.resolve, command, future, result, exc_info,
+                                                        submitted, start, time.time()))
+
+
+    def resolve(self, command, future, result, exc_info, submitted, start, end):
+        """
+        Records the timings of a call and resolves its Future. Runs on the
+        IOLoop.
+        """
+        self.pending -= 1
+        labels = (command,)
+        metrics.DATASTORE_IN_FLIGHT.dec(labels)
+        QUEUE_SECONDS.observe(start - submitted, labels)
+        metrics.DATASTORE_SECONDS.observe(end - start, labels)
+        if exc_info is not None:
+            future.set_exc_info(exc_info)
+        else:
+            future.set_result(result)
+
+
+    def queued(self):
+        """
+        Returns the number of calls waiting for a thread.
+        """
+        return self.queue.qsize()
+
+
+    def running(self):
+        """
+        Returns the number of calls running on a thread.
+        """
+        return max(self.pending - self.queue.qsize(), 0)
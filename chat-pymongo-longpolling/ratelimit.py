@@ -0,0 +1,87 @@
+# coding=UTF-8
+
+# General modules.
+import time
+
+# Import application modules.
+import metrics
+
+
+LIMITED = metrics.registry.counter('chat_messages_rate_limited_total',
+                                   'Messages rejected because a sender or chat room exceeded its rate.',
+                                   ['limit'])
+
+
+def slow_down(retry_after):
+    """
+    Returns the error sent to a client exceeding a rate limit.
+    """
+    return {'error': 1, 'textStatus': 'slow down', 'retry_after': round(retry_after, 3)}
+
+
+
+class RateLimiter(object):
+    """
+    Token buckets limiting the messages per user and per chat room in this
+    process. A bucket holds up to burst tokens and refills with rate tokens
+    per second, every message takes one token from the bucket of its user
+    and of its room. A rate of 0 disables that limit. Full buckets carry no
+    state, so they are dropped whenever the number of buckets exceeds
+    max_buckets.
+    """
+    def __init__(self, user_rate=1.0, user_burst=5, room_rate=20.0, room_burst=50,
+                 max_buckets=100000):
+        self.limits = {'user': (user_rate, user_burst), 'room': (room_rate, room_burst)}
+        self.max_buckets = max_buckets
+        # Maps (limit, name) to [tokens, time of the last update].
+        self.buckets = {}
+
+
+    def acquire(self, user, room):
+        """
+        Takes a token for a message of the user in the chat room. Returns 0 if
+        the message is allowed or the seconds until it would be. Nothing is
+        taken from any bucket if the message is rejected.
+        """
+        now = time.time()
+        states = []
+        retry_after = 0.0
+        for limit, name in (('user', user), ('room', room)):
+            rate, burst = self.limits[limit]
+            if not rate:
+                continue
+            state = self.buckets.get((limit, name))
+            if state is None:
+                state = [burst, now]
+            tokens = min(burst, state[0] + (now - state[1]) * rate)
+            if tokens < 1:
+                retry_after = max(retry_after, (1 - tokens) / rate)
+                LIMITED.inc((limit,))
+            states.append(((limit, name), state, tokens))
+        if retry_after:
+            return retry_after
+        for key, state, tokens in states:
+            state[0] = tokens - 1
+            state[1] = now
+            self.buckets[key] = state
+        if len(self.buckets) > self.max_buckets:
+            self.prune(now)
+        return 0.0
+
+
+    def check(self, user, room, callback):
+        """
+        Like acquire(), but passes the result to the callback.
+        """
+        callback(self.acquire(user, room))
+
+
+    def prune(self, now):
+        """
+        Drops the buckets which have refilled completely.
+        """
+        for key, state in self.buckets.items():
+            rate, burst = self.limits[key[0]]
+            if state[0] + (now - state[1]) * rate >= burst:
+                del self.buckets[key]
+
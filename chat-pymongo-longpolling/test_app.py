@@ -0,0 +1,82 @@
+# coding=UTF-8
+
+# General modules.
+import json
+import time
+import unittest
+
+# Tornado modules.
+import tornado.ioloop
+import tornado.options
+import tornado.testing
+import tornado.web
+
+# MongoDb modules.
+from bson.objectid import ObjectId
+
+# Import application modules.
+import app as chat
+
+
+
+class LongPollingTest(tornado.testing.AsyncHTTPTestCase):
+    """
+    Polls /message of the memory backend with a cached user, so no MongoDB
+    is needed.
+    """
+    user_id = str(ObjectId())
+
+    def get_new_ioloop(self):
+        # The application schedules its startup and deadlines on the instance.
+        return tornado.ioloop.IOLoop.instance()
+
+
+    def get_app(self):
+        tornado.options.options.backend = "memory"
+        tornado.options.options.poll_timeout = 1
+        tornado.options.options.poll_jitter = 0
+        self.chat = chat.Application()
+        self.chat.startup.ready = True
+        self.chat.user_cache.set(self.user_id, {'_id': ObjectId(self.user_id), 'name': 'Ann'})
+        return self.chat
+
+
+    def poll(self, cursor=None):
+        url = '/message' + ('?cursor=' + cursor if cursor else '')
+        cookie = tornado.web.create_signed_value(self.chat.settings['cookie_secret'], 'user', self.user_id)
+        self.http_client.fetch(self.get_url(url), self.stop, headers={'Cookie': 'user=' + cookie})
+
+
+    def deliver(self, body):
+        self.chat.deliver({'_id': str(ObjectId()), 'from': 'Ann', 'body': body})
+
+
+    def test_poll_without_cursor_waits_for_next_message(self):
+        self.poll()
+        self.io_loop.add_timeout(time.time() + 0.1, lambda: self.deliver('hello'))
+        response = self.wait()
+        self.assertEqual(response.code, 200)
+        self.assertEqual([message['body'] for message in json.loads(response.body)['messages']],
+                         ['hello'])
+
+
+    def test_poll_without_cursor_times_out_empty(self):
+        self.poll()
+        response = self.wait(timeout=5)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body), {'messages': []})
+
+
+    def test_poll_with_cursor_gets_newer_messages(self):
+        self.deliver('first')
+        cursor = self.chat.buffers['conversation'].recent(1)[0]['_id']
+        self.deliver('second')
+        self.poll(cursor)
+        response = self.wait()
+        self.assertEqual([message['body'] for message in json.loads(response.body)['messages']],
+                         ['second'])
+
+
+
+if __name__ == "__main__":
+    unittest.main()